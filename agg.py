@@ -8,14 +8,27 @@ from signal import signal, SIGINT
 from threading import Event, Lock
 
 from bundle import Bundle
+from catalog import load_catalog
 from generator.err import errors, error_strings 
 from generator.consts import * 
 from generator.generator import Probe 
 from probes import ProbeHit, ProbeHistory, TimeTable, USDTThread, USDTArg 
+from sink import add_output_args, open_sink
+from targets import add_target_args, open_targets
 from util import WorkerMaster, WorkerThread, Counter
 
 ####################################################################################
 
+# see catalog.json
+AGG_PROBES = [
+    # delimiters to indicate start/end of aggrequest construction
+    "aggRequestParse_start", "aggRequestParse_end",
+    # data provided during construction, some may be hit multiple times
+    "aggRequestParsePipeline", "aggRequestBatchSize", "aggRequestCollation", "aggRequestAllowDiskUse",
+    "aggRequestFromMongos", "aggRequestNeedsMerge", "aggRequestBypassDocumentValidation",
+    "aggRequestMaxTimeMS", "aggRequestReadConcern", "aggRequestUnwrappedReadPref"
+]
+
 class AggTimeTable(TimeTable):
     def __init__(self, view, probes, file_name):
         TimeTable.__init__(self, view)
@@ -95,23 +108,24 @@ class AggTimeTable(TimeTable):
         else:
             print(out)
 
-def sigint_handler_gen(mr, tt):
+def sigint_handler_gen(mr, tt, parquet_dir = None):
     def handler(signal, frame):
         mr.kill_all()
+        if tt.sink != None:
+            tt.sink.close()
         tt.dumps()
+        if parquet_dir:
+            # pyarrow is only needed for exporting
+            from export import export_time_table
+            export_time_table(tt, parquet_dir, [{PROBE_NAME_KEY: name, PROBE_ARGS_KEY: args}
+                                                for name, args in tt.probes.items()])
         mr.dumps()
         exit(0)
     return handler
 
-def mk_USDTThread_from(probe_name, probe_args, args, time_table):
-    return USDTThread(args.pid[0],
-                      [{
-                        PROBE_NAME_KEY: probe_name,
-                        SAMPLES_PROPORTION_KEY: args.sample,
-                        MAX_STR_SZ_KEY: args.chunk,
-                        MAX_MAP_SZ_KEY: args.map,
-                        PROBE_ARGS_KEY: probe_args
-                      }],
+def mk_USDTThread_from(targets, probe_name, args, time_table):
+    return USDTThread(targets,
+                      [load_catalog().spec(probe_name, args.sample, args.chunk, args.map)],
                       time_table)
 
 # Main #
@@ -119,11 +133,7 @@ def mk_USDTThread_from(probe_name, probe_args, args, time_table):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Gather data from aggregation requests." \
         + "On CTRL+C, print out data collected from probes grouped to correspond to their source aggregation requests.")
-    parser.add_argument('pid',
-                        metavar='pid',
-                        type=int,
-                        nargs=1,
-                        help='pid of process emitting probes')
+    add_target_args(parser)
     parser.add_argument('-s', '--sample',
                         metavar='sample',
                         type=float,
@@ -148,38 +158,31 @@ if __name__ == '__main__':
                         nargs='?',
                         default=None,
                         help='output file')
+    parser.add_argument('-p', '--parquet',
+                        metavar='parquet',
+                        type=str,
+                        default=None,
+                        help='directory to export captured hits to as Parquet, one file per probe')
+    add_output_args(parser)
 
     args = parser.parse_args()
+    targets = open_targets(parser, args)
     print(args)
 
-    probes = {
-        # delimiters to indicate start/end of aggrequest construction
-        "aggRequestParse_start": [{ARG_TYPE_KEY: INT_TYPE, ARG_NAME_KEY: "count"}],
-        "aggRequestParse_end": [{ARG_TYPE_KEY: INT_TYPE, ARG_NAME_KEY: "count"}],
-        # data provided during construction, some may be hit multiple times
-        "aggRequestParsePipeline": [{ARG_TYPE_KEY: LONG_STRING_TYPE, ARG_NAME_KEY: "bson"}],
-        "aggRequestBatchSize": [{ARG_TYPE_KEY: INT_TYPE, ARG_NAME_KEY: "batchSize"}],
-        "aggRequestCollation": [{ARG_TYPE_KEY: LONG_STRING_TYPE, ARG_NAME_KEY: "bson"}],
-        "aggRequestAllowDiskUse": [{ARG_TYPE_KEY: INT_TYPE, ARG_NAME_KEY: "allowDiskUse"}],
-        "aggRequestFromMongos": [{ARG_TYPE_KEY: INT_TYPE, ARG_NAME_KEY: "fromMongos"}],
-        "aggRequestNeedsMerge": [{ARG_TYPE_KEY: INT_TYPE, ARG_NAME_KEY: "needsMerge"}],
-        "aggRequestBypassDocumentValidation": [{ARG_TYPE_KEY: INT_TYPE, ARG_NAME_KEY: "bypassDocumentValidation"}],
-        "aggRequestMaxTimeMS": [{ARG_TYPE_KEY: INT_TYPE, ARG_NAME_KEY: "maxTimeMS"}],
-        "aggRequestReadConcern": [{ARG_TYPE_KEY: LONG_STRING_TYPE, ARG_NAME_KEY: "bson"}],
-        "aggRequestUnwrappedReadPref": [{ARG_TYPE_KEY: LONG_STRING_TYPE, ARG_NAME_KEY: "bson"}]
-    }
+    probes = {name: load_catalog().spec(name)[PROBE_ARGS_KEY] for name in AGG_PROBES}
 
     mr = None
     time_table = AggTimeTable(None, probes, args.file)
+    time_table.sink = open_sink(args)
 
     workers = []
     for probe_name in probes:
-        worker = mk_USDTThread_from(probe_name, probes[probe_name], args, time_table)
+        worker = mk_USDTThread_from(targets, probe_name, args, time_table)
         workers.append(worker)
 
     mr = WorkerMaster(workers)
     mr.start_all()
     print("Listening for probes.")
 
-    signal(SIGINT, sigint_handler_gen(mr, time_table))
+    signal(SIGINT, sigint_handler_gen(mr, time_table, args.parquet))
     Event().wait() # wait for keyboard interrupt forever
@@ -0,0 +1,213 @@
+#!/bin/python3
+
+import argparse
+import os
+
+import numpy as np
+
+from util import Timer
+
+# Vectorized statistics over a whole capture. probes.ProbeHistory & util.Timer/StartStopTimer
+# compute their statistics one hit at a time as hits arrive, which does not scale to recomputing
+# over captures of tens of millions of hits. Here a capture is held as columns (one NumPy array
+# per hit field) and everything is computed with sorts, diffs & grouping instead:
+# - interevent times: hits are sorted by (probe, tid, ns) and diffed within each group
+# - start/end pairing per tid, with the semantics of StartStopTimer (an end closes the most
+#   recent open start of its thread, ends without an open start are ignored), see pair_durations()
+# - per cpu hit rates and percentiles
+# Captures are loaded from a TimeTable or from the Parquet files written by export.py.
+
+#####################################################################################
+
+PERCENTILES = [50, 90, 99]
+
+COLUMNS = ["ns", "tid", "pid", "cpu", "size"]
+DTYPES = {"ns": np.int64, "tid": np.uint32, "pid": np.uint32, "cpu": np.uint16, "size": np.uint32}
+
+# Captures #
+
+class Capture:
+    """ Columns of a set of hits: probe holds indices into probe_names. """
+    def __init__(self, probe_names, probe, **columns):
+        self.probe_names = list(probe_names)
+        self.probe = np.asarray(probe, dtype=np.int32)
+        for name in COLUMNS:
+            setattr(self, name, np.asarray(columns.get(name, np.zeros(len(self.probe))), dtype=DTYPES[name]))
+
+    def __len__(self):
+        return len(self.probe)
+
+    def probe_id(self, name):
+        return self.probe_names.index(name)
+
+    def select(self, mask):
+        return Capture(self.probe_names, self.probe[mask], **{name: getattr(self, name)[mask] for name in COLUMNS})
+
+    def concat(captures):
+        if len(captures) == 0:
+            return Capture([], [])
+        names = []
+        for capture in captures:
+            names += [name for name in capture.probe_names if name not in names]
+        probe = [np.asarray([names.index(name) for name in capture.probe_names], dtype=np.int32)[capture.probe]
+                 for capture in captures]
+        columns = {name: np.concatenate([getattr(capture, name) for capture in captures]) for name in COLUMNS}
+        return Capture(names, np.concatenate(probe), **columns)
+
+def from_time_table(time_table):
+    """ Snapshots the hits held by a probes.TimeTable. """
+    with time_table.lock:
+        names = list(time_table.times)
+        hits = [(index, hit) for index, name in enumerate(names) for hit in time_table.times[name].hits]
+    columns = {name: np.fromiter((getattr(hit, name) for _, hit in hits), dtype=DTYPES[name], count=len(hits))
+               for name in COLUMNS}
+    probe = np.fromiter((index for index, _ in hits), dtype=np.int32, count=len(hits))
+    return Capture(names, probe, **columns)
+
+def from_parquet(path):
+    """ Loads the hits of every <probe>.parquet file written by export.py to a directory. """
+    # pyarrow is only needed for loading Parquet
+    import pyarrow.parquet as pq
+
+    captures = []
+    for file_name in sorted(os.listdir(path)):
+        if not file_name.endswith(".parquet"):
+            continue
+        table = pq.read_table(os.path.join(path, file_name), columns=COLUMNS)
+        columns = {name: table.column(name).to_numpy(zero_copy_only=False) for name in COLUMNS}
+        captures.append(Capture([file_name[:-len(".parquet")]], np.zeros(table.num_rows), **columns))
+    return Capture.concat(captures)
+
+# Grouping #
+
+def _group_starts(*keys):
+    """ Given columns sorted by keys, returns a mask of the rows starting a new group. """
+    starts = np.ones(len(keys[0]), dtype=bool)
+    if len(keys[0]) > 0:
+        starts[1:] = False
+        for key in keys:
+            starts[1:] |= key[1:] != key[:-1]
+    return starts
+
+def interevent_times(capture):
+    """ Returns {probe: ns between consecutive hits of a thread}, as ProbeHistory's Timer measures them. """
+    order = np.lexsort((capture.ns, capture.tid, capture.probe))
+    probe = capture.probe[order]
+    tid = capture.tid[order]
+    ns = capture.ns[order]
+
+    same_group = ~_group_starts(probe, tid)[1:]
+    dts = np.diff(ns)[same_group]
+    dt_probe = probe[1:][same_group]
+    return {name: dts[dt_probe == index] for index, name in enumerate(capture.probe_names)}
+
+def pair_durations(capture, start, end):
+    """ Returns (tids, ns) of every start/end probe pair, paired per tid like StartStopTimer does. """
+    start_id = capture.probe_id(start)
+    end_id = capture.probe_id(end)
+    mask = (capture.probe == start_id) | (capture.probe == end_id)
+    order = np.flatnonzero(mask)
+    order = order[np.lexsort((capture.ns[order], capture.tid[order]))]
+    tid = capture.tid[order]
+    ns = capture.ns[order]
+    is_start = capture.probe[order] == start_id
+    n = len(order)
+    if n == 0:
+        return (np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.int64))
+
+    # The open start stack depth of a thread is a walk of +1 (start) / -1 (end) steps clamped at 0,
+    # since unmatched ends are ignored. Its clamped value is C - min(0, running min of C), with C the
+    # unclamped cumulative sum of the thread's steps.
+    steps = np.where(is_start, 1, -1).astype(np.int64)
+    group_start = _group_starts(tid)
+    group = np.cumsum(group_start) - 1
+    cumsum = np.cumsum(steps)
+    offsets = (cumsum - steps)[group_start]
+    unclamped = cumsum - offsets[group]
+    # shift every thread below all the previous ones, so one running min over everything
+    # never looks across threads (|unclamped| <= n < BIG / 2)
+    big = 2 * n + 1
+    running_min = np.minimum.accumulate(unclamped - group * big) + group * big
+    depth = unclamped - np.minimum(running_min, 0)
+
+    # depth before each step, 0 at the start of each thread
+    depth_before = np.empty_like(depth)
+    depth_before[0] = 0
+    depth_before[1:] = depth[:-1]
+    depth_before[group_start] = 0
+    effective = is_start | (depth_before > 0)
+
+    # a start pushed to depth L is closed by the next end popping from depth L, so within a
+    # (tid, level) group effective events alternate start, end, start, end...
+    level = np.where(is_start, depth, depth_before)[effective]
+    positions = np.flatnonzero(effective)
+    by_level = np.lexsort((positions, level, tid[effective]))
+    positions = positions[by_level]
+    level = level[by_level]
+    pair_tid = tid[positions]
+    pair_start = is_start[positions]
+
+    matched = pair_start[:-1] & ~pair_start[1:] & (pair_tid[:-1] == pair_tid[1:]) & (level[:-1] == level[1:])
+    first = np.flatnonzero(matched)
+    return (pair_tid[first], ns[positions[first + 1]] - ns[positions[first]])
+
+# Rates & Distributions #
+
+def per_cpu_rates(capture):
+    """ Returns {cpu: hits per second} over the span of the capture. """
+    if len(capture) == 0:
+        return dict()
+    span = (capture.ns.max() - capture.ns.min()) / 1000000000
+    counts = np.bincount(capture.cpu)
+    cpus = np.flatnonzero(counts)
+    return {int(cpu): counts[cpu] / span if span > 0 else float("inf") for cpu in cpus}
+
+def percentiles(values, pcts = PERCENTILES):
+    if len(values) == 0:
+        return {pct: 0 for pct in pcts}
+    return dict(zip(pcts, np.percentile(values, pcts)))
+
+def value_counts(column):
+    """ Counter.props over a whole column. """
+    values, counts = np.unique(column, return_counts=True)
+    return dict(zip(values.tolist(), counts.tolist()))
+
+def summarize(capture, pcts = PERCENTILES):
+    """ Per probe hit counts and interevent time percentiles (in seconds). """
+    counts = np.bincount(capture.probe, minlength=len(capture.probe_names))
+    summary = dict()
+    for name, dts in interevent_times(capture).items():
+        summary[name] = {"hits": int(counts[capture.probe_id(name)]),
+                         "intervals": len(dts),
+                         "interevent": {pct: v / 1000000000 for pct, v in percentiles(dts, pcts).items()}}
+    return summary
+
+# Main #
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Summarize a capture exported to Parquet by export.py.")
+    parser.add_argument('capture',
+                        metavar='capture',
+                        type=str,
+                        help='directory of Parquet files, one per probe')
+    parser.add_argument('-p', '--pair',
+                        metavar=('start', 'end'),
+                        type=str,
+                        nargs=2,
+                        action='append',
+                        default=[],
+                        help='also report the durations between these start & end probes')
+    args = parser.parse_args()
+
+    capture = from_parquet(args.capture)
+    print("{} hits".format(len(capture)))
+    for name, stats in summarize(capture).items():
+        print("{}: {} hits, interevent {}".format(name, stats["hits"], ", ".join(
+            "p{} {}".format(pct, Timer.get_unit_str(v, "s")) for pct, v in stats["interevent"].items())))
+    for cpu, rate in per_cpu_rates(capture).items():
+        print("cpu {}: {} hits/s".format(cpu, round(rate, 3)))
+    for start, end in args.pair:
+        tids, durations = pair_durations(capture, start, end)
+        print("{} -> {}: {} pairs, {}".format(start, end, len(durations), ", ".join(
+            "p{} {}".format(pct, Timer.get_unit_str(v / 1000000000, "s"))
+            for pct, v in percentiles(durations).items())))
@@ -0,0 +1,281 @@
+#!/bin/python3
+
+import argparse
+import copy
+import ctypes as ct
+import json
+import keyword
+import os
+
+from generator.consts import *
+from generator.generator import Probe
+from util import load_cached
+
+# The mongod USDT probes and their argument layouts, declared once in catalog.json in the same
+# format as the probe dicts of the generator. Tools take their probe specs from here rather than
+# spelling them out, so every tool agrees on the layout of a probe.
+#
+# The catalog is validated once and then compiled: the generated C code of every probe (with and
+# without pid filtering), the layout of its output struct and the source of its Python decoder are
+# cached on disk (see util.load_cached), so launching a tool does not redo any of it. Only that plain
+# data is cached, the Probes are rebuilt from their specs and given it back. The ctypes structures
+# are built from the cached layouts, and the decoders compiled, once per process.
+
+#####################################################################################
+
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.json")
+CATALOG_PROBES_KEY = "probes"
+
+# the code generating what is cached: changing any of it invalidates the cache
+CODE_FILES = [os.path.abspath(__file__)] + \
+    [os.path.join(os.path.dirname(os.path.abspath(__file__)), "generator", name)
+     for name in ["consts.py", "generator.py", "err.py"]]
+
+PROBE_KEYS = [PROBE_NAME_KEY, PROBE_ARGS_KEY]
+ARG_KEYS = [ARG_NAME_KEY, ARG_TYPE_KEY, ARG_STR_LEN_KEY, ARG_STRUCT_FIELDS_KEY, ARG_ARRAY_LEN_KEY,
+            ARG_DEREF_KEY, ARG_PACKED_KEY, ARG_ALIGN_KEY]
+OPTION_DEFAULTS = {SAMPLES_PROPORTION_KEY: 1, MAX_STR_SZ_KEY: MAX_STR_SZ, MAX_MAP_SZ_KEY: MAX_MAP_SZ}
+
+# Validation #
+
+def _check(condition, where, message):
+    if not condition:
+        raise ValueError("{}: {}".format(where, message))
+
+def _validate_args(args, where, depth = 0):
+    _check(isinstance(args, list), where, "args must be a list")
+    names = set()
+    for index, arg in enumerate(args):
+        arg_where = "{}[{}]".format(where, index)
+        _check(isinstance(arg, dict), arg_where, "an arg must be an object")
+        unknown = [key for key in arg if key not in ARG_KEYS]
+        _check(len(unknown) == 0, arg_where, "unknown keys {}".format(unknown))
+
+        name = arg.get(ARG_NAME_KEY)
+        _check(isinstance(name, str) and name.isidentifier(), arg_where, "an arg needs an identifier name")
+        _check(not keyword.iskeyword(name), arg_where, "an arg can not be named {}".format(name))
+        _check(name not in names, arg_where, "duplicate arg {}".format(name))
+        names.add(name)
+        arg_where = "{}.{}".format(where, name)
+
+        arg_type = arg.get(ARG_TYPE_KEY)
+        _check(arg_type in TYPES, arg_where, "unknown type {}".format(arg_type))
+        if arg_type == STRING_TYPE:
+            length = arg.get(ARG_STR_LEN_KEY)
+            _check(isinstance(length, int) and length > 0, arg_where, "a str needs a positive length")
+        else:
+            _check(ARG_STR_LEN_KEY not in arg, arg_where, "only a str has a length")
+        if arg_type == STRUCT_TYPE:
+            fields = arg.get(ARG_STRUCT_FIELDS_KEY)
+            _check(isinstance(fields, list) and len(fields) > 0, arg_where, "a struct needs fields")
+            _validate_args(fields, arg_where, depth + 1)
+            align = arg.get(ARG_ALIGN_KEY, 0)
+            _check(isinstance(align, int) and align >= 0 and align & (align - 1) == 0, arg_where,
+                   "align must be a power of 2")
+            _check(isinstance(arg.get(ARG_PACKED_KEY, False), bool), arg_where, "packed must be a bool")
+        else:
+            for key in [ARG_STRUCT_FIELDS_KEY, ARG_ALIGN_KEY, ARG_PACKED_KEY]:
+                _check(key not in arg, arg_where, "only a struct has {}".format(key))
+        if ARG_DEREF_KEY in arg:
+            _check(arg_type == STRUCT_TYPE and depth > 0, arg_where, "only a struct field can be dereferenced")
+            _check(isinstance(arg[ARG_DEREF_KEY], bool), arg_where, "deref must be a bool")
+        if ARG_ARRAY_LEN_KEY in arg:
+            count = arg[ARG_ARRAY_LEN_KEY]
+            _check(arg_type in ARRAY_TYPES, arg_where, "a {} can not be an array".format(arg_type))
+            _check(isinstance(count, int) and count > 0, arg_where, "an array needs a positive count")
+        _check(arg_type != LONG_STRING_TYPE or depth == 0, arg_where, "a longstr can not be a struct field")
+
+def validate(probes):
+    """ Raises a ValueError describing the first problem of a list of probe specs. """
+    _check(isinstance(probes, list), CATALOG_PROBES_KEY, "must be a list")
+    names = set()
+    for index, probe in enumerate(probes):
+        where = "{}[{}]".format(CATALOG_PROBES_KEY, index)
+        _check(isinstance(probe, dict), where, "a probe must be an object")
+        unknown = [key for key in probe if key not in PROBE_KEYS]
+        _check(len(unknown) == 0, where, "unknown keys {}".format(unknown))
+        name = probe.get(PROBE_NAME_KEY)
+        _check(isinstance(name, str) and name.isidentifier(), where, "a probe needs an identifier name")
+        _check(not keyword.iskeyword(name), where, "a probe can not be named {}".format(name))
+        _check(name not in names, where, "duplicate probe {}".format(name))
+        names.add(name)
+        _validate_args(probe.get(PROBE_ARGS_KEY, []), name)
+
+# Compilation #
+
+def normalize(spec):
+    """ Returns spec without the options that are set to their defaults, so it can be compared. """
+    normalized = {key: value for key, value in spec.items()
+                  if key not in OPTION_DEFAULTS or value != OPTION_DEFAULTS[key]}
+    normalized.setdefault(PROBE_ARGS_KEY, [])
+    return normalized
+
+def compile_probe(spec):
+    """ Returns the Probe of a spec with all of its code generated. """
+    probe = Probe(spec)
+    probe.source(False)
+    probe.source(True)
+    probe.layout = probe.output_layout()
+    probe.decoder_source = probe.decoder_gen()
+    return probe
+
+# the cached data of a compiled probe
+COMPILED_SPEC_KEY = "spec"
+COMPILED_SOURCES_KEY = "sources"
+COMPILED_LAYOUT_KEY = "layout"
+COMPILED_DECODER_KEY = "decoder"
+
+def _build(path):
+    with open(path) as fd:
+        probes = json.load(fd)[CATALOG_PROBES_KEY]
+    validate(probes)
+    compiled = dict()
+    for spec in probes:
+        probe = compile_probe(spec)
+        compiled[spec[PROBE_NAME_KEY]] = {COMPILED_SPEC_KEY: normalize(spec),
+                                          COMPILED_SOURCES_KEY: probe.sources(),
+                                          COMPILED_LAYOUT_KEY: probe.layout,
+                                          COMPILED_DECODER_KEY: probe.decoder_source}
+    return compiled
+
+def _restore(compiled):
+    """ Returns the Probe of the cached data of a compiled probe, without generating anything. """
+    probe = Probe(compiled[COMPILED_SPEC_KEY])
+    probe.add_sources(compiled[COMPILED_SOURCES_KEY])
+    probe.layout = compiled[COMPILED_LAYOUT_KEY]
+    probe.decoder_source = compiled[COMPILED_DECODER_KEY]
+    return probe
+
+def _code_stamp():
+    return ",".join(str(os.stat(path).st_mtime_ns) for path in CODE_FILES)
+
+# Decoding #
+
+def _align_up(offset, align):
+    return offset + (-offset) % align
+
+def _ctype(kind):
+    """ Returns the (ctypes type, alignment) of a layout kind, see LAYOUT_ARRAY. """
+    if isinstance(kind, str):
+        return (CTYPES[kind], ct.alignment(CTYPES[kind]))
+    if kind[0] == LAYOUT_ARRAY:
+        ctype, align = _ctype(kind[1])
+        return (ctype * kind[2], align)
+
+    # ctypes can pack but not align structs, so every struct is laid out here the way the
+    # compiler does, with explicit padding, and given to ctypes packed
+    _, name, layout, packed, struct_align = kind
+    fields = []
+    offset = 0
+    align = 1
+    for member, member_kind in layout:
+        ctype, member_align = _ctype(member_kind)
+        member_align = 1 if packed else member_align
+        if offset % member_align != 0:
+            fields.append(("_pad_{}".format(len(fields)), ct.c_ubyte * ((-offset) % member_align)))
+            offset = _align_up(offset, member_align)
+        fields.append((member, ctype))
+        offset += ct.sizeof(ctype)
+        align = max(align, member_align)
+    align = max(align, struct_align)
+    if offset % align != 0:
+        fields.append(("_pad_{}".format(len(fields)), ct.c_ubyte * ((-offset) % align)))
+    return (type(name, (ct.Structure,), {"_pack_": 1, "_fields_": fields}), align)
+
+def event_type(layout):
+    """ Returns the ctypes structure of an output struct layout. """
+    return _ctype((STRUCT_TYPE, "Event", layout, False, 0))[0]
+
+def compile_decoder(probe):
+    """ Returns the generated decoder of a compiled Probe as a function:
+        decode(event, read_long_str) -> {arg: value}, where read_long_str(sz, start_chunk_idx)
+        reads a long string out of the probe's chunk map. """
+    code = compile(probe.decoder_source, "<{}>".format(probe.decoder_name), "exec")
+    namespace = dict(PY_DECODER_GLOBALS)
+    exec(code, namespace)
+    return namespace[probe.decoder_name]
+
+# Catalog #
+
+class Catalog:
+    """ The probes of a catalog file, see the top of this file. """
+    def __init__(self, path = CATALOG_PATH):
+        self.path = path
+        self._compiled = load_cached(path, _build, "catalog:" + _code_stamp())
+        self._probes = dict()
+        self._event_types = dict()
+        self._decoders = dict()
+
+    def names(self):
+        return list(self._compiled)
+
+    def spec(self, name, samples = 1, max_str_sz = MAX_STR_SZ, max_map_sz = MAX_MAP_SZ):
+        """ Returns the probe dict of a probe, to be given to a probes.USDTThread. """
+        if name not in self._compiled:
+            raise KeyError("{} is not in the probe catalog {}".format(name, self.path))
+        spec = copy.deepcopy(self._compiled[name][COMPILED_SPEC_KEY])
+        spec[SAMPLES_PROPORTION_KEY] = samples
+        spec[MAX_STR_SZ_KEY] = max_str_sz
+        spec[MAX_MAP_SZ_KEY] = max_map_sz
+        return spec
+
+    def specs(self, names, samples = 1, max_str_sz = MAX_STR_SZ, max_map_sz = MAX_MAP_SZ):
+        return [self.spec(name, samples, max_str_sz, max_map_sz) for name in names]
+
+    def probe(self, spec):
+        """ Returns the compiled Probe of a probe dict: the cached one if it is a catalog probe with
+            default options, otherwise it is compiled now. """
+        name = spec.get(PROBE_NAME_KEY)
+        if name not in self._compiled or self._compiled[name][COMPILED_SPEC_KEY] != normalize(spec):
+            return compile_probe(spec)
+        if name not in self._probes:
+            self._probes[name] = _restore(self._compiled[name])
+        return self._probes[name]
+
+    def event_type(self, probe):
+        """ Returns the ctypes structure of the events of a compiled Probe. """
+        key = (probe.name, repr(probe.layout))
+        if key not in self._event_types:
+            self._event_types[key] = event_type(probe.layout)
+        return self._event_types[key]
+
+    def decoder(self, probe):
+        """ Returns the decoder of the events of a compiled Probe, see compile_decoder. """
+        key = (probe.name, probe.decoder_source)
+        if key not in self._decoders:
+            self._decoders[key] = compile_decoder(probe)
+        return self._decoders[key]
+
+_catalogs = dict()
+
+def load_catalog(path = CATALOG_PATH):
+    """ Returns the Catalog of a file, loaded once per process. """
+    if path not in _catalogs:
+        _catalogs[path] = Catalog(path)
+    return _catalogs[path]
+
+# Main #
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Validate a probe catalog and list its probes.")
+    parser.add_argument('catalog',
+                        metavar='catalog',
+                        type=str,
+                        nargs='?',
+                        default=CATALOG_PATH,
+                        help='catalog file')
+    parser.add_argument('-c', '--code',
+                        action='store_true',
+                        help='also print the generated code of every probe')
+    args = parser.parse_args()
+
+    try:
+        catalog = load_catalog(args.catalog)
+    except ValueError as e:
+        parser.error(str(e))
+    for name in catalog.names():
+        probe = catalog.probe(catalog.spec(name))
+        print("{} ({} bytes): {}".format(name, ct.sizeof(catalog.event_type(probe)),
+              ", ".join(arg.name for arg in probe.args)))
+        if args.code:
+            print(probe.source())
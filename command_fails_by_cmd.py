@@ -1,83 +1,193 @@
 #!/usr/bin/python3
-import sys
-from time import sleep
+import argparse
+from datetime import datetime
+from time import sleep, time
 from bcc import BPF, USDT
-ERROR_CODES = dict()
-def error_code(msg, val, **kwargs):
-    ERROR_CODES[val] = msg
+import error_codes
+from sink import add_output_args, open_sink
+from util import DoubleBufferedMaps, parse_interval
 
-def error_class(class_name, error_list):
-    pass
+parser = argparse.ArgumentParser(description="Count failed commands by error code.")
+parser.add_argument('pid',
+                    metavar='pid',
+                    type=int,
+                    help='pid of process emitting probes')
+parser.add_argument('error_codes',
+                    metavar='error_codes',
+                    type=str,
+                    help='path to error_codes.err')
+parser.add_argument('-s', '--samples',
+                    metavar='samples',
+                    type=int,
+                    default=0,
+                    help='also print up to this many example failures per second')
+parser.add_argument('-i', '--interval',
+                    metavar='interval',
+                    type=parse_interval,
+                    default=0,
+                    help='report the failures of each interval (e.g. 10s, 5m) instead of once at CTRL-C')
+add_output_args(parser)
+args = parser.parse_args()
+sink = open_sink(args)
 
 # parse error_codes.err to interpret meaningful error codes
-if len(sys.argv) != 3:
-    print("Usage: " + sys.argv[0] + " <PID to instrument> <path to error_codes.err>")
-    exit(1)
-
-error_codes = open(sys.argv[2], "r").read()
-exec(error_codes, globals(), locals())
-ERROR_CODES[0] = "Unknown failure that doesn't throw"
+ERRORS = error_codes.load(args.error_codes)
+ERRORS.codes[0] = "Unknown failure that doesn't throw"
 
+# Failures are counted in the kernel per (command name, error code), so userspace only reads the
+# counts once per report instead of receiving an event for every failure. Example failures can
+# additionally be streamed through the rate limited failed_sample perf channel.
 text = """
 #include <linux/ptrace.h>
 
-BPF_PERF_OUTPUT(failed);
-BPF_HISTOGRAM(error_hist, int, {NUM_ERR_CODES});
+#define NS_PER_SEC 1000000000
+#define MAX_SAMPLES_PER_SEC {MAX_SAMPLES_PER_SEC}
+
+struct cmd_err_key {{
+    char name[50];
+    int error_code;
+}};
+
+// error codes are sparse, so the histogram is indexed by the dense slots of error_codes.ErrorCodes
+BPF_HASH(code_slots, int, u32, {NUM_SLOTS});
+
+// double buffered, see util.DoubleBufferedMaps
+BPF_HISTOGRAM(error_hist_0, u32, {NUM_SLOTS});
+BPF_HISTOGRAM(error_hist_1, u32, {NUM_SLOTS});
+BPF_HASH(cmd_errors_0, struct cmd_err_key, u64, 10240);
+BPF_HASH(cmd_errors_1, struct cmd_err_key, u64, 10240);
+BPF_ARRAY(control, u32, 1);
+
+#if MAX_SAMPLES_PER_SEC > 0
+struct sample_window {{
+    u64 start;
+    u64 count;
+}};
+
+BPF_PERF_OUTPUT(failed_sample);
+BPF_ARRAY(sample_windows, struct sample_window, 1);
 
 struct failed_out {{
     char name[50];
     int error_code;
+    u32 tid;
+    u64 ns;
 }};
+#endif
 
 int command_failed(struct pt_regs *ctx) {{
-    struct failed_out out = {{}};
-    int err_code = 0;
-    bpf_usdt_readarg(6, ctx, &err_code);
-    error_hist.increment(err_code);
+    struct cmd_err_key key = {{}};
+    bpf_usdt_readarg(6, ctx, &key.error_code);
     const char* addr = NULL;
     bpf_usdt_readarg(2, ctx, &addr);
-    bpf_probe_read_str(out.name, sizeof(out.name), addr);
-    out.error_code = err_code;
-    failed.perf_submit(ctx, &out, sizeof(out));
+    bpf_probe_read_str(key.name, sizeof(key.name), addr);
+
+    u32 *slotp = code_slots.lookup(&key.error_code);
+    u32 slot = slotp ? *slotp : {UNKNOWN_SLOT};
+
+    int zero = 0;
+    u32 *active = control.lookup(&zero);
+    if (active && *active) {{
+        error_hist_1.increment(slot);
+        cmd_errors_1.increment(key);
+    }} else {{
+        error_hist_0.increment(slot);
+        cmd_errors_0.increment(key);
+    }}
+
+#if MAX_SAMPLES_PER_SEC > 0
+    u64 now = bpf_ktime_get_ns();
+    struct sample_window *window = sample_windows.lookup(&zero);
+    if (!window) return 0;
+    if (now - window->start >= NS_PER_SEC) {{
+        window->start = now;
+        window->count = 0;
+    }}
+    if (window->count >= MAX_SAMPLES_PER_SEC) return 0;
+    __sync_fetch_and_add(&window->count, 1);
+
+    struct failed_out out = {{}};
+    __builtin_memcpy(out.name, key.name, sizeof(out.name));
+    out.error_code = key.error_code;
+    out.tid = bpf_get_current_pid_tgid();
+    out.ns = now;
+    failed_sample.perf_submit(ctx, &out, sizeof(out));
+#endif
     return 0;
 }}
-""".format(NUM_ERR_CODES=len(ERROR_CODES))
+""".format(NUM_SLOTS=ERRORS.num_slots, UNKNOWN_SLOT=ERRORS.unknown_slot, MAX_SAMPLES_PER_SEC=args.samples)
 
-command_failed = USDT(pid=int(sys.argv[1]))
+command_failed = USDT(pid=args.pid)
 command_failed.enable_probe(probe="commandFail", fn_name="command_failed")
 
 b = BPF(text = text, usdt_contexts=[command_failed])
 
-command_to_errors = dict()
-def print_event(cpu, data, size):
-    event = b["failed"].event(data)
-    event_name = str(event.name, 'utf-8')
-    if event_name not in command_to_errors:
-        command_to_errors[event_name] = dict()
-    if event.error_code not in command_to_errors[event_name]:
-        command_to_errors[event_name][event.error_code] = 0
-    command_to_errors[event_name][event.error_code] += 1
+code_slots = b["code_slots"]
+for code, slot in ERRORS.slots.items():
+    code_slots[code_slots.Key(code)] = code_slots.Leaf(slot)
+
+def print_sample(cpu, data, size):
+    event = b["failed_sample"].event(data)
+    event_name = str(event.name, 'utf-8', 'replace')
+    error = ERRORS.name(event.error_code)
+    if sink != None:
+        sink.write({"sample": True, "ns": event.ns, "tid": event.tid, "command": event_name,
+                    "error": error, "code": event.error_code})
+    else:
+        print("[{}] {} failed with {}".format(event.tid, event_name, error))
+
+if args.samples > 0:
+    b["failed_sample"].open_perf_buffer(print_sample)
+
+maps = DoubleBufferedMaps(b, "control", ["error_hist", "cmd_errors"])
 
-b["failed"].open_perf_buffer(print_event)
+def report():
+    start, end, tables = maps.snapshot()
+    per_command = dict()
+    for key, count in tables["cmd_errors"]:
+        cmd = str(key.name, 'utf-8', 'replace')
+        per_command.setdefault(cmd, dict())[key.error_code] = count.value
+
+    per_error = dict()
+    for slot, num_occurences in tables["error_hist"]:
+        if num_occurences.value > 0:
+            code = ERRORS.slot_code(slot.value)
+            per_error[code if code != None else "unknown"] = num_occurences.value
+
+    if sink != None:
+        for code, count in per_error.items():
+            sink.write({"start": start, "end": end, "error": ERRORS.name(code), "code": code, "count": count})
+        for cmd, errs in per_command.items():
+            for err_num, count in errs.items():
+                sink.write({"start": start, "end": end, "command": cmd,
+                            "error": ERRORS.name(err_num), "code": err_num, "count": count})
+        return
+
+    print("\n{} - {}".format(datetime.fromtimestamp(start).time(), datetime.fromtimestamp(end).time()))
+    print("{:<30} | Occurrences".format("Commands"))
+    print('-' * 30, '|', '-' * 13)
+    for code, count in per_error.items():
+        print("\r{:>30} | {:5} ".format(ERRORS.name(code), count))
+
+    print("\nSummary of error codes per command")
+    for cmd, errs in per_command.items():
+        print(cmd)
+        for err_num, count in errs.items():
+            print('\t{}\t{}'.format(ERRORS.name(err_num), count))
 
 print('listening until CTRL-C....')
-print("{:<30} | Occurrences".format("Commands"))
-print('-' * 30, '|', '-' * 13) 
-failed_commands_with_error_codes = list()
+next_report = time() + args.interval
 while True:
     try:
-        b.perf_buffer_poll()
+        if args.samples > 0:
+            b.perf_buffer_poll(timeout=100)
+        else:
+            sleep(0.1)
+        if args.interval > 0 and time() >= next_report:
+            report()
+            next_report += args.interval
     except KeyboardInterrupt:
-        failed_commands_with_error_codes += b["error_hist"].items()
-        for error_code, num_occurences in failed_commands_with_error_codes:
-            error_code = error_code.value
-            num_occurences = num_occurences.value
-            if num_occurences > 0 and error_code in ERROR_CODES:
-                print("\r{:>30} | {:5} ".format(ERROR_CODES[error_code], num_occurences))
-
-        print("\nSummary of error codes per command")
-        for cmd, errs in command_to_errors.items():
-            print(cmd)
-            for err_num, count in errs.items():
-                print('\t{}\t{}'.format(ERROR_CODES[err_num], count))
+        report()
+        if sink != None:
+            sink.close()
         exit()
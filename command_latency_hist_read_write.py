@@ -1,83 +1,99 @@
 #!/usr/bin/python3
 from __future__ import print_function
 from bcc import BPF, USDT
-import sys, builtins, time
-from curses import wrapper, curs_set 
-
-if len(sys.argv) < 2:
-    print("Usage: " + sys.argv[0] + " <pid to instrument")
-    exit()
-
-pid = int(sys.argv[1])
-
+import argparse, time
+from datetime import datetime
+from sink import add_output_args, open_sink
+from util import DoubleBufferedMaps, log2_bucket_bounds, log2_percentile, parse_interval
+
+parser = argparse.ArgumentParser(description="Per-command latency percentiles, split by read/write type.")
+parser.add_argument('pid',
+                    metavar='pid',
+                    type=int,
+                    help='pid of process emitting probes')
+parser.add_argument('-i', '--interval',
+                    metavar='interval',
+                    type=parse_interval,
+                    default=0,
+                    help='print the latencies recorded during each interval (e.g. 10s, 5m)')
+add_output_args(parser)
+args = parser.parse_args()
+pid = args.pid
+sink = open_sink(args)
+
+# Latencies are aggregated in the kernel into a single log2 histogram keyed by
+# (command name hash, Command::ReadWriteType, log2 microsecond bucket). The command names
+# are kept in a small side map keyed by their hash so that they can be decoded here.
+# The histogram is double buffered (latency_0/latency_1, selected by the control array) so
+# that each interval can be read and cleared without losing concurrent updates.
 text = """
 #include <linux/ptrace.h>
 
-BPF_HASH(reads);
-BPF_HASH(writes);
+#define MAX_NAME_LEN 32
+#define FNV_OFFSET 2166136261
+#define FNV_PRIME 16777619
 
-BPF_HISTOGRAM(read_out);
-BPF_HISTOGRAM(write_out);
+struct name_t {
+    char name[MAX_NAME_LEN];
+};
 
-#define READ_CMD 1
-#define WRITE_CMD 2
+struct hist_key_t {
+    u32 name_hash;
+    u32 type;
+    u64 slot;
+};
+
+BPF_HASH(starts, u64, u64);
+BPF_HASH(names, u32, struct name_t, 1024);
+BPF_HISTOGRAM(latency_0, struct hist_key_t);
+BPF_HISTOGRAM(latency_1, struct hist_key_t);
+BPF_ARRAY(control, u32, 1);
 
 int command_start(struct pt_regs *ctx) {
-    u64 ts;
-    ts = bpf_ktime_get_ns();
+    u64 ts = bpf_ktime_get_ns();
 
-    u64 opCtx;
+    u64 opCtx = 0;
     bpf_usdt_readarg(4, ctx, &opCtx);
-
-    int type;
-    bpf_usdt_readarg(3, ctx, &type);
-    // type is a value of Command::ReadWriteType
-    switch(type) {
-        case READ_CMD:
-            reads.update(&opCtx, &ts);
-            break;
-        case WRITE_CMD:
-            writes.update(&opCtx, &ts);
-            break;
-        default:
-            break;
-    }
+    starts.update(&opCtx, &ts);
     return 0;
 }
 
 int command_end(struct pt_regs *ctx) {
-    u64 ts, *start = NULL;
-    ts = bpf_ktime_get_ns();
+    u64 ts = bpf_ktime_get_ns();
 
-    u64 opCtx;
+    u64 opCtx = 0;
     bpf_usdt_readarg(4, ctx, &opCtx);
+    u64 *start = starts.lookup(&opCtx);
+    if (!start) return 0;
+    u64 delta = (ts - *start) / 1000; //convert from ns to us
+    starts.delete(&opCtx);
+
+    struct name_t name = {};
+    const char *addr = NULL;
+    bpf_usdt_readarg(2, ctx, &addr);
+    bpf_probe_read_str(name.name, sizeof(name.name), addr);
+
+    // FNV-1a of the command name
+    u32 hash = FNV_OFFSET;
+    #pragma unroll
+    for (int i = 0; i < MAX_NAME_LEN; i++) {
+        if (name.name[i] == 0) break;
+        hash = (hash ^ (unsigned char)name.name[i]) * FNV_PRIME;
+    }
+    names.insert(&hash, &name);
 
-    int type;
-    bpf_usdt_readarg(3, ctx, &type);
+    struct hist_key_t key = {};
+    key.name_hash = hash;
     // type is a value of Command::ReadWriteType
-    switch(type) {
-        case READ_CMD:
-            start = reads.lookup(&opCtx);
-            break;
-        case WRITE_CMD:
-            start = writes.lookup(&opCtx);
-            break;
-        default:
-            break;
-    }
-    if(start) {
-        u64 delta = ts - *start;
-        delta = delta / 1000000; //convert from ns to ms
-        switch(type) {
-            case READ_CMD:
-                read_out.increment(delta);
-                break;
-            case WRITE_CMD:
-                write_out.increment(delta);
-                break;
-            default:
-                break;
-        }
+    bpf_usdt_readarg(3, ctx, &key.type);
+    key.slot = bpf_log2l(delta);
+
+    int zero = 0;
+    u32 *active = control.lookup(&zero);
+    if (active && *active) {
+        latency_1.increment(key);
+    } else {
+        latency_0.increment(key);
     }
     return 0;
 }
@@ -90,18 +106,65 @@ command_end.enable_probe(probe="commandEnd", fn_name="command_end")
 
 b = BPF(text=text, usdt_contexts=[command_start, command_end])
 
+READ_WRITE_TYPES = {0: "command", 1: "read", 2: "write"}
+PERCENTILES = [50, 90, 99]
+
+maps = DoubleBufferedMaps(b, "control", ["latency"])
+
+def snapshot():
+    """ Returns (start, end, {(command name, type): {slot: count}}) of the latencies recorded
+        since the last snapshot, and resets them. """
+    start, end, tables = maps.snapshot()
+
+    names = dict()
+    for k, v in b["names"].items():
+        names[k.value] = str(v.name, 'utf-8', 'replace')
+
+    hists = dict()
+    for k, v in tables["latency"]:
+        if v.value == 0:
+            continue
+        cmd = (names.get(k.name_hash, hex(k.name_hash)), READ_WRITE_TYPES.get(k.type, str(k.type)))
+        hists.setdefault(cmd, dict())[k.slot] = v.value
+    return (start, end, hists)
+
+def report(start, end, hists):
+    if sink != None:
+        for (cmd, rw), buckets in hists.items():
+            record = {"start": start, "end": end, "command": cmd, "type": rw, "count": sum(buckets.values())}
+            for pct in PERCENTILES:
+                record["p{}_us".format(pct)] = log2_percentile(buckets, pct)
+            record["max_us"] = log2_bucket_bounds(max(buckets))[1]
+            sink.write(record)
+        return
+
+    print("{} - {}".format(datetime.fromtimestamp(start).time(), datetime.fromtimestamp(end).time()))
+    print("{:<30} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "Command", "Type", "Count", "p50 (us)", "p90 (us)", "p99 (us)", "max (us)"))
+    by_count = sorted(hists.items(), key=lambda item: sum(item[1].values()), reverse=True)
+    for (cmd, rw), buckets in by_count:
+        print("{:<30} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+            cmd, rw, sum(buckets.values()),
+            *[log2_percentile(buckets, pct) for pct in PERCENTILES],
+            log2_bucket_bounds(max(buckets))[1]))
+    print()
+
 def main():
     try:
-        print("Read time histogram:")
-        b["read_out"].print_linear_hist("Elapsed time in ms")
-        print("Write time histogram:")
-        b["write_out"].print_linear_hist("Elapsed time in ms")
+        while True:
+            if args.interval > 0:
+                time.sleep(args.interval)
+                report(*snapshot())
+            else:
+                time.sleep(100000000)
     except KeyboardInterrupt:
-        exit()
+        report(*snapshot())
+    if sink != None:
+        sink.close()
 
 if __name__ == "__main__":
-    print("recording data...hit Ctrl-C to stop and print histogram")
-    try:
-        time.sleep(100000000)
-    except KeyboardInterrupt:
-        main()
+    if args.interval > 0:
+        print("recording data...printing latencies every {}s, hit Ctrl-C to stop".format(args.interval))
+    else:
+        print("recording data...hit Ctrl-C to stop and print latencies")
+    main()
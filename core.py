@@ -0,0 +1,408 @@
+#!/bin/python3
+
+import argparse
+import ctypes as ct
+import ctypes.util
+import json
+import mmap
+import os
+import platform
+import select
+import struct
+import subprocess
+
+from catalog import load_catalog, normalize
+from generator.consts import *
+from generator.generator import Generator
+from targets import exe_path
+
+# Probes compiled ahead of time to a CO-RE object, so that tracing hosts need neither bcc, nor
+# kernel headers, nor clang: the program is generated in the libbpf dialect (see
+# generator.consts.DIALECTS) and compiled once by build(), then loaded through libbpf by CoreBPF.
+# libbpf relocates the object against the BTF of the running kernel, and locates the USDT args
+# from the notes of the traced binary when attaching, which bcc would otherwise do by compiling
+# them into the program. Startup skips compilation, and the collector never maps LLVM.
+#
+# An object comes with a manifest listing the probe specs it was built from, so that a tool can
+# load any subset of them, as long as it asks for the same options (samples, string sizes...).
+# The programs & maps of the probes it did not ask for are neither loaded nor created.
+
+#####################################################################################
+
+SOURCE_SUFFIX = ".c"
+MANIFEST_SUFFIX = ".json"
+MANIFEST_PID_FILTER_KEY = "pid_filter"
+MANIFEST_PROBES_KEY = "probes"
+
+VMLINUX_BTF = "/sys/kernel/btf/vmlinux"
+VMLINUX_HEADER = "vmlinux.h"
+CLANG_FLAGS = ["-g", "-O2", "-target", "bpf", "-mcpu=v3"]
+# __TARGET_ARCH_* of bpf_tracing.h, by machine
+TARGET_ARCHS = {"x86_64": "x86", "aarch64": "arm64", "ppc64le": "powerpc", "s390x": "s390"}
+
+# Building #
+
+def vmlinux_header(directory, bpftool = "bpftool"):
+    """ Returns the path of a vmlinux.h in directory, dumping the BTF of this kernel there if there
+        is none. Any kernel with BTF will do, the object is relocated when it is loaded. """
+    path = os.path.join(directory, VMLINUX_HEADER)
+    if not os.path.exists(path):
+        with open(path + ".tmp", "w") as fd:
+            subprocess.run([bpftool, "btf", "dump", "file", VMLINUX_BTF, "format", "c"], stdout=fd, check=True)
+        os.replace(path + ".tmp", path)
+    return path
+
+def build(obj_path, specs, pid_filter = False, clang = "clang", include_dirs = []):
+    """ Compiles probe specs to a CO-RE object, writing its generated source & manifest beside it.
+        A vmlinux.h is expected in the directory of the object or in include_dirs. """
+    catalog = load_catalog()
+    generator = Generator(pid_filter=pid_filter, dialect=CORE_DIALECT)
+    for spec in specs:
+        generator.add_probe(catalog.probe(spec))
+
+    source_path = obj_path + SOURCE_SUFFIX
+    with open(source_path, "w") as fd:
+        fd.write(generator.finish())
+
+    includes = []
+    for directory in [os.path.dirname(os.path.abspath(obj_path))] + include_dirs:
+        includes += ["-I", directory]
+    arch = TARGET_ARCHS.get(platform.machine(), platform.machine())
+    subprocess.run([clang] + CLANG_FLAGS + ["-D__TARGET_ARCH_" + arch] + includes +
+                   ["-c", source_path, "-o", obj_path], check=True)
+
+    with open(obj_path + MANIFEST_SUFFIX, "w") as fd:
+        json.dump({MANIFEST_PID_FILTER_KEY: pid_filter,
+                   MANIFEST_PROBES_KEY: [normalize(spec) for spec in specs]}, fd, indent=4)
+
+def read_manifest(obj_path):
+    with open(obj_path + MANIFEST_SUFFIX) as fd:
+        return json.load(fd)
+
+# USDT Notes #
+
+STAPSDT_SECTION = b".note.stapsdt"
+STAPSDT_NOTE_NAME = b"stapsdt\0"
+STAPSDT_NOTE_TYPE = 3
+# by ELF class: e_shoff, e_shentsize/e_shnum/e_shstrndx and section header formats & offsets
+ELF_CLASSES = {
+    1: ("I", 0x20, 0x2E, "IIIIII", 4),
+    2: ("Q", 0x28, 0x3A, "IIQQQQ", 8)
+}
+
+def _align4(offset):
+    return offset + (-offset) % 4
+
+def usdt_notes(path):
+    """ Returns {probe name: [providers]} of the USDT probes of an ELF binary, read from the
+        notes libbpf locates probe args with. """
+    probes = dict()
+    with open(path, "rb") as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as elf:
+        if elf[:4] != b"\x7fELF" or elf[4] not in ELF_CLASSES:
+            raise ValueError("{} is not an ELF binary".format(path))
+        endian = "<" if elf[5] == 1 else ">"
+        addr, shoff_at, shentsize_at, header_fmt, addr_sz = ELF_CLASSES[elf[4]]
+        shoff = struct.unpack_from(endian + addr, elf, shoff_at)[0]
+        shentsize, shnum, shstrndx = struct.unpack_from(endian + "HHH", elf, shentsize_at)
+        sections = [struct.unpack_from(endian + header_fmt, elf, shoff + index * shentsize)
+                    for index in range(shnum)]
+        names_offset = sections[shstrndx][4]
+
+        for name, _, _, _, offset, size in sections:
+            if elf[names_offset + name:elf.find(b"\0", names_offset + name)] != STAPSDT_SECTION:
+                continue
+            end = offset + size
+            while offset < end:
+                namesz, descsz, note_type = struct.unpack_from(endian + "III", elf, offset)
+                name_at = offset + 12
+                desc_at = _align4(name_at + namesz)
+                offset = _align4(desc_at + descsz)
+                if note_type != STAPSDT_NOTE_TYPE or elf[name_at:name_at + namesz] != STAPSDT_NOTE_NAME:
+                    continue
+                # the pc, base & semaphore addresses come before the strings
+                provider, probe = elf[desc_at + 3 * addr_sz:desc_at + descsz].split(b"\0")[:2]
+                providers = probes.setdefault(probe.decode("utf-8"), [])
+                if provider.decode("utf-8") not in providers:
+                    providers.append(provider.decode("utf-8"))
+    return probes
+
+# libbpf #
+
+BPF_MAP_TYPE_ARRAY = 2
+BPF_ANY = 0
+PERF_BUFFER_PAGES = 8
+
+PERF_SAMPLE_FN = ct.CFUNCTYPE(None, ct.c_void_p, ct.c_int, ct.c_void_p, ct.c_uint32)
+PERF_LOST_FN = ct.CFUNCTYPE(None, ct.c_void_p, ct.c_int, ct.c_uint64)
+
+# the libbpf 1.x functions used here: (restype, argtypes)
+LIBBPF_FUNCTIONS = {
+    "bpf_object__open_file": (ct.c_void_p, [ct.c_char_p, ct.c_void_p]),
+    "bpf_object__load": (ct.c_int, [ct.c_void_p]),
+    "bpf_object__close": (None, [ct.c_void_p]),
+    "bpf_object__find_program_by_name": (ct.c_void_p, [ct.c_void_p, ct.c_char_p]),
+    "bpf_object__find_map_by_name": (ct.c_void_p, [ct.c_void_p, ct.c_char_p]),
+    "bpf_program__set_autoload": (ct.c_int, [ct.c_void_p, ct.c_bool]),
+    "bpf_program__attach_usdt": (ct.c_void_p, [ct.c_void_p, ct.c_int, ct.c_char_p, ct.c_char_p, ct.c_char_p,
+                                               ct.c_void_p]),
+    "bpf_map__set_autocreate": (ct.c_int, [ct.c_void_p, ct.c_bool]),
+    "bpf_map__fd": (ct.c_int, [ct.c_void_p]),
+    "bpf_map__type": (ct.c_int, [ct.c_void_p]),
+    "bpf_map__key_size": (ct.c_uint32, [ct.c_void_p]),
+    "bpf_map__value_size": (ct.c_uint32, [ct.c_void_p]),
+    "bpf_map_lookup_elem": (ct.c_int, [ct.c_int, ct.c_void_p, ct.c_void_p]),
+    "bpf_map_update_elem": (ct.c_int, [ct.c_int, ct.c_void_p, ct.c_void_p, ct.c_uint64]),
+    "bpf_map_delete_elem": (ct.c_int, [ct.c_int, ct.c_void_p]),
+    "bpf_map_get_next_key": (ct.c_int, [ct.c_int, ct.c_void_p, ct.c_void_p]),
+    "perf_buffer__new": (ct.c_void_p, [ct.c_int, ct.c_size_t, PERF_SAMPLE_FN, PERF_LOST_FN, ct.c_void_p,
+                                       ct.c_void_p]),
+    "perf_buffer__epoll_fd": (ct.c_int, [ct.c_void_p]),
+    "perf_buffer__consume": (ct.c_int, [ct.c_void_p]),
+    "perf_buffer__free": (None, [ct.c_void_p]),
+    "bpf_link__destroy": (ct.c_int, [ct.c_void_p]),
+    "libbpf_strerror": (ct.c_int, [ct.c_int, ct.c_char_p, ct.c_size_t])
+}
+
+_libbpf = None
+
+def libbpf():
+    """ Returns the libbpf shared library, loaded once per process. """
+    global _libbpf
+    if _libbpf == None:
+        lib = ct.CDLL(ctypes.util.find_library("bpf") or "libbpf.so.1", use_errno=True)
+        for name, (restype, argtypes) in LIBBPF_FUNCTIONS.items():
+            fn = getattr(lib, name)
+            fn.restype = restype
+            fn.argtypes = argtypes
+        _libbpf = lib
+    return _libbpf
+
+def _check(result, what):
+    """ libbpf returns NULL or a negative error, and sets errno. """
+    if result == None or (isinstance(result, int) and result < 0):
+        errno = ct.get_errno()
+        message = ct.create_string_buffer(256)
+        libbpf().libbpf_strerror(errno, message, len(message))
+        raise OSError(errno, "{}: {}".format(what, message.value.decode("utf-8", "replace")))
+    return result
+
+def map_types(probes):
+    """ Returns {map name: (key ctype, leaf ctype)} of the maps generated for probes. """
+    types = {PID_FILTER_MAP_NAME: (ct.c_uint32, ct.c_uint8)}
+    for probe in probes:
+        if probe.has_long_str:
+            chunk = type("Chunk", (ct.Structure,), {"_fields_": [("str", ct.c_ubyte * probe.max_str_sz)]})
+            types[probe.buf_name] = (ct.c_uint32, chunk)
+            types[probe.buf_name + "_index"] = (ct.c_uint32, ct.c_uint64)
+        for arg in probe.long_str_args():
+            types[arg.sz_hist_name] = (ct.c_int, ct.c_uint64)
+    return types
+
+def probe_maps(probe):
+    """ Returns the names of the maps generated for a probe. """
+    return [probe.name] + [name for name in map_types([probe]) if name != PID_FILTER_MAP_NAME]
+
+class CoreTable:
+    """ A map of a CoreBPF, with the part of the interface of bcc's tables that the tools use. """
+    def __init__(self, bpf, bpf_map, key_type = None, leaf_type = None):
+        lib = libbpf()
+        self._bpf = bpf
+        self.fd = lib.bpf_map__fd(bpf_map)
+        self.is_array = lib.bpf_map__type(bpf_map) == BPF_MAP_TYPE_ARRAY
+        self.Key = key_type if key_type != None else ct.c_ubyte * lib.bpf_map__key_size(bpf_map)
+        self.Leaf = leaf_type if leaf_type != None else ct.c_ubyte * lib.bpf_map__value_size(bpf_map)
+
+    def _key(self, key):
+        return key if isinstance(key, self.Key) else self.Key(key)
+
+    def __getitem__(self, key):
+        leaf = self.Leaf()
+        if libbpf().bpf_map_lookup_elem(self.fd, ct.byref(self._key(key)), ct.byref(leaf)) < 0:
+            raise KeyError(key)
+        return leaf
+
+    def __setitem__(self, key, leaf):
+        _check(libbpf().bpf_map_update_elem(self.fd, ct.byref(self._key(key)), ct.byref(leaf), BPF_ANY),
+               "bpf_map_update_elem")
+
+    def __delitem__(self, key):
+        if libbpf().bpf_map_delete_elem(self.fd, ct.byref(self._key(key))) < 0:
+            raise KeyError(key)
+
+    def keys(self):
+        keys = []
+        key = None
+        while True:
+            next_key = self.Key()
+            if libbpf().bpf_map_get_next_key(self.fd, ct.byref(key) if key != None else None,
+                                             ct.byref(next_key)) < 0:
+                return keys
+            keys.append(next_key)
+            key = next_key
+
+    def items(self):
+        items = []
+        for key in self.keys():
+            try:
+                items.append((key, self[key]))
+            except KeyError:
+                # deleted since it was listed
+                pass
+        return items
+
+    def clear(self):
+        # array entries can't be deleted, so they are zeroed like bcc does
+        for key in self.keys():
+            if self.is_array:
+                self[key] = self.Leaf()
+            else:
+                try:
+                    del self[key]
+                except KeyError:
+                    pass
+
+    def open_perf_buffer(self, callback, page_cnt = PERF_BUFFER_PAGES, lost_cb = None):
+        """ Calls callback(cpu, data, size) on every event, and lost_cb(lost) on lost events. """
+        self._bpf._open_perf_buffer(self.fd, page_cnt, callback, lost_cb)
+
+class CoreBPF:
+    """ The probes of a CO-RE object built by build(), loaded & attached to targets (a
+        targets.Targets). Stands in for bcc's BPF: tables are indexed by name, see CoreTable. """
+    def __init__(self, obj_path, probes, targets):
+        manifest = read_manifest(obj_path)
+        catalog = load_catalog()
+        built = {spec[PROBE_NAME_KEY]: spec for spec in manifest[MANIFEST_PROBES_KEY]}
+        for probe in probes:
+            if probe.name not in built:
+                raise ValueError("{} is not built into {}".format(probe.name, obj_path))
+            if catalog.probe(built[probe.name]).source(manifest[MANIFEST_PID_FILTER_KEY], CORE_DIALECT) != \
+                    probe.source(manifest[MANIFEST_PID_FILTER_KEY], CORE_DIALECT):
+                raise ValueError("{} is built into {} with other options".format(probe.name, obj_path))
+        if manifest[MANIFEST_PID_FILTER_KEY] != targets.filtered:
+            raise ValueError("{} is built {} --pid-filter, tracing {} needs the opposite".format(
+                obj_path, "with" if manifest[MANIFEST_PID_FILTER_KEY] else "without", targets))
+
+        self._links = []
+        self._perf_buffers = dict()
+        self._callbacks = []
+        self._map_types = map_types(probes)
+        lib = libbpf()
+        self._obj = _check(lib.bpf_object__open_file(obj_path.encode("utf-8"), None), obj_path)
+        try:
+            # only load what was asked for
+            wanted = set(probe.name for probe in probes)
+            for spec in manifest[MANIFEST_PROBES_KEY]:
+                if spec[PROBE_NAME_KEY] in wanted:
+                    continue
+                other = catalog.probe(spec)
+                lib.bpf_program__set_autoload(self._find_program(other), False)
+                for name in probe_maps(other):
+                    lib.bpf_map__set_autocreate(self._find_map(name), False)
+            _check(lib.bpf_object__load(self._obj), "loading " + obj_path)
+            self._attach(probes, targets)
+        except:
+            self.cleanup()
+            raise
+
+    def _find_program(self, probe):
+        return _check(libbpf().bpf_object__find_program_by_name(self._obj, probe.function_name.encode("utf-8")),
+                      probe.function_name)
+
+    def _find_map(self, name):
+        return _check(libbpf().bpf_object__find_map_by_name(self._obj, name.encode("utf-8")), name)
+
+    def _attach(self, probes, targets):
+        if targets.binary != None:
+            pid, path = -1, targets.binary
+        else:
+            pid, path = targets.pids[0], exe_path(targets.pids[0])
+        providers = usdt_notes(path)
+        for probe in probes:
+            if probe.name not in providers:
+                raise ValueError("{} has no USDT probe {}".format(path, probe.name))
+            for provider in providers[probe.name]:
+                self._links.append(_check(libbpf().bpf_program__attach_usdt(
+                    self._find_program(probe), pid, path.encode("utf-8"), provider.encode("utf-8"),
+                    probe.name.encode("utf-8"), None), "attaching " + probe.name))
+
+    def __getitem__(self, name):
+        key_type, leaf_type = self._map_types.get(name, (None, None))
+        return CoreTable(self, self._find_map(name), key_type, leaf_type)
+
+    def _open_perf_buffer(self, fd, page_cnt, callback, lost_cb):
+        sample_fn = PERF_SAMPLE_FN(lambda ctx, cpu, data, size: callback(cpu, data, size))
+        lost_fn = PERF_LOST_FN(lambda ctx, cpu, lost: lost_cb(lost) if lost_cb != None else None)
+        # libbpf calls back into these as long as the buffer lives
+        self._callbacks += [sample_fn, lost_fn]
+        perf_buffer = _check(libbpf().perf_buffer__new(fd, page_cnt, sample_fn, lost_fn, None, None),
+                             "perf_buffer__new")
+        self._perf_buffers[libbpf().perf_buffer__epoll_fd(perf_buffer)] = perf_buffer
+
+    def perf_buffer_poll(self, timeout = -1):
+        """ Waits up to timeout ms for events on any perf buffer, and calls back on all of them. """
+        ready = select.select(list(self._perf_buffers), [], [], timeout / 1000 if timeout >= 0 else None)[0]
+        for fd in ready:
+            libbpf().perf_buffer__consume(self._perf_buffers[fd])
+
+    def cleanup(self):
+        lib = libbpf()
+        for link in self._links:
+            lib.bpf_link__destroy(link)
+        self._links = []
+        for perf_buffer in self._perf_buffers.values():
+            lib.perf_buffer__free(perf_buffer)
+        self._perf_buffers = dict()
+        if self._obj != None:
+            lib.bpf_object__close(self._obj)
+            self._obj = None
+
+# Main #
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compile catalog probes ahead of time to a CO-RE object, " +
+                                     "to be loaded by tools instead of compiling them with bcc.")
+    parser.add_argument('obj',
+                        metavar='obj',
+                        type=str,
+                        help='object file to write')
+    parser.add_argument('probes',
+                        metavar='probe',
+                        type=str,
+                        nargs='*',
+                        help='catalog probes to build (default: all of them)')
+    parser.add_argument('--pid-filter',
+                        action='store_true',
+                        help='build for several pids or a pid & binary, see targets.py')
+    parser.add_argument('-s', '--sample',
+                        metavar='sample',
+                        type=float,
+                        default=1,
+                        help='proportion of hits to sample')
+    parser.add_argument('--clang',
+                        metavar='clang',
+                        type=str,
+                        default="clang",
+                        help='clang to compile with')
+    parser.add_argument('-I', '--include',
+                        metavar='dir',
+                        type=str,
+                        action='append',
+                        default=[],
+                        help='also look for headers (libbpf\'s, vmlinux.h) here')
+    parser.add_argument('--vmlinux',
+                        action='store_true',
+                        help='dump a vmlinux.h of this kernel next to the object if there is none')
+    args = parser.parse_args()
+
+    catalog = load_catalog()
+    try:
+        specs = catalog.specs(args.probes if len(args.probes) > 0 else catalog.names(), args.sample)
+    except KeyError as e:
+        parser.error(str(e))
+    try:
+        if args.vmlinux:
+            vmlinux_header(os.path.dirname(os.path.abspath(args.obj)))
+        build(args.obj, specs, args.pid_filter, args.clang, args.include)
+    except (OSError, subprocess.CalledProcessError) as e:
+        parser.error(str(e))
+    print("built {} probes into {}".format(len(specs), args.obj))
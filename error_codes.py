@@ -0,0 +1,57 @@
+#!/bin/python3
+
+import ast
+
+from util import load_cached
+
+# Loader for mongod's error_codes.err, which is a list of error_code(name, code, ...) and
+# error_class(name, [error names]) calls. The file is parsed (never executed) and the result is
+# cached on disk keyed by the file's mtime.
+
+#####################################################################################
+
+class ErrorCodes:
+    """ Error code names and classes, plus a dense code -> slot remap table suitable for
+        sizing & indexing BPF arrays, since codes are sparse (e.g. DuplicateKey is 11000). """
+    def __init__(self, codes, classes):
+        self.codes = codes
+        self.classes = classes
+        self.slot_codes = sorted(codes)
+        self.slots = {code: slot for slot, code in enumerate(self.slot_codes)}
+        # codes missing from the file are all counted in this extra slot
+        self.unknown_slot = len(self.slot_codes)
+        self.num_slots = self.unknown_slot + 1
+
+    def name(self, code):
+        return self.codes.get(code, str(code))
+
+    def slot_code(self, slot):
+        """ Returns the code counted in a slot, or None for the unknown slot. """
+        return self.slot_codes[slot] if slot < self.unknown_slot else None
+
+def parse(text):
+    """ Returns ({code: name}, {class name: [error names]}) from error_codes.err contents. """
+    codes = dict()
+    classes = dict()
+    for statement in ast.parse(text).body:
+        if not isinstance(statement, ast.Expr) or not isinstance(statement.value, ast.Call):
+            continue
+        call = statement.value
+        if not isinstance(call.func, ast.Name):
+            continue
+        args = [ast.literal_eval(arg) for arg in call.args]
+        if call.func.id == "error_code":
+            codes[args[1]] = args[0]
+        elif call.func.id == "error_class":
+            classes[args[0]] = args[1]
+    return (codes, classes)
+
+def _parse_file(path):
+    with open(path, "r") as fd:
+        codes, classes = parse(fd.read())
+    # as pairs, since the cache is JSON which only has string keys
+    return (list(codes.items()), classes)
+
+def load(path):
+    codes, classes = load_cached(path, _parse_file, "error_codes")
+    return ErrorCodes({code: name for code, name in codes}, classes)
@@ -0,0 +1,247 @@
+#!/bin/python3
+
+import argparse
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from catalog import CATALOG_PATH, load_catalog
+from generator.consts import *
+from generator.generator import Probe
+from sink import BINARY_EXT, read_records
+
+# Columnar export of probe hits. Hits (either the contents of a TimeTable or a trace recorded
+# through a sink.Sink) are converted to Arrow record batches and written as Parquet, one file per
+# probe. If the probe specs are known (given, or looked up in the probe catalog), columns are
+# derived from the Probe/Arg layout: struct args are flattened into "struct.member" columns and long
+# strings are stored as binary. Otherwise the column types are inferred from the hits: when a later
+# batch brings new columns (or types a column that was all None so far), what was written of the
+# probe is rewritten with the wider schema.
+
+#####################################################################################
+
+DEFAULT_BATCH_SIZE = 65536
+
+# repeated strings are dictionary encoded
+NAME_TYPE = pa.dictionary(pa.int32(), pa.string())
+
+ARROW_TYPES = {
+    INT_TYPE: pa.int32(),
+    UNSIGNED_LONG_TYPE: pa.uint64(),
+    LONG_LONG_TYPE: pa.int64(),
+    CHAR_TYPE: pa.uint8(),
+    STRING_TYPE: pa.string(),
+    POINTER_TYPE: pa.uint64()
+}
+
+HIT_COLUMNS = [
+    ("probe", NAME_TYPE),
+    ("comm", NAME_TYPE),
+    ("pid", pa.uint32()),
+    ("tid", pa.uint32()),
+    ("ns", pa.uint64()),
+    ("cpu", pa.uint16()),
+    ("size", pa.uint32())
+]
+
+# Conversions #
+
+def _as_int(value, hex_encoded):
+    # char members come out of ctypes as single bytes
+    if isinstance(value, str) and hex_encoded:
+        value = bytes.fromhex(value)
+    if isinstance(value, bytes):
+        return value[0] if len(value) > 0 else 0
+    return value
+
+def _as_str(value, hex_encoded):
+    if isinstance(value, str) and hex_encoded:
+        value = bytes.fromhex(value)
+    if isinstance(value, bytes):
+        return value.split(b"\0", 1)[0].decode("utf-8", "replace")
+    return value
+
+def _as_bytes(value, hex_encoded):
+    if isinstance(value, str):
+        return bytes.fromhex(value) if hex_encoded else value.encode("utf-8")
+    return value
+
+def _flatten(args, prefix, out):
+    for key, value in args.items():
+        if isinstance(value, dict):
+            _flatten(value, "{}{}.".format(prefix, key), out)
+        else:
+            out[prefix + str(key)] = value
+    return out
+
+def _arg_columns(arg, prefix = ""):
+    """ Returns the (column name, arrow type) pairs an Arg is stored as. """
+    name = prefix + (arg.name if arg.name != None else arg.output_arg_name)
+    if arg.type == STRUCT_TYPE:
+        columns = []
+        for field in arg.fields:
+            columns += _arg_columns(field, name + ".")
+        return columns
+    elif arg.type == LONG_STRING_TYPE:
+        return [(name, pa.binary()), (name + "_sz", pa.int32()), (name + "_err", pa.int32())]
+    elif arg.count > 0:
+        return [(name, pa.list_(ARROW_TYPES[arg.type]))]
+    return [(name, ARROW_TYPES[arg.type])]
+
+def probe_schema(probe):
+    """ Arrow schema of the table holding the hits of a Probe. """
+    columns = list(HIT_COLUMNS)
+    for arg in probe.args:
+        columns += _arg_columns(arg)
+    return pa.schema(columns)
+
+# Exporter #
+
+class ParquetExporter:
+    """ Buffers hits per probe and writes them out as Parquet in record batches. The schema of a
+        probe missing from probes is taken from catalog if it has the probe. """
+    def __init__(self, out_dir, probes = None, batch_size = DEFAULT_BATCH_SIZE, hex_bytes = False,
+                 catalog = None):
+        self.out_dir = out_dir
+        self.catalog = catalog
+        self.batch_size = batch_size
+        # JSON Lines traces store bytes as hex strings
+        self.hex_bytes = hex_bytes
+        self.schemas = dict()
+        # probes whose schema was inferred, and so may be widened
+        self._inferred = set()
+        if probes:
+            for probe_dict in probes:
+                probe = Probe(probe_dict)
+                self.schemas[probe.name] = probe_schema(probe)
+        self._rows = dict()
+        self._writers = dict()
+        os.makedirs(out_dir, exist_ok=True)
+
+    def add(self, record):
+        """ Add a hit in the format of ProbeHit.to_dict(). """
+        probe = record["probe"]
+        row = _flatten(record.get("args", {}), "", dict())
+        for name, _ in HIT_COLUMNS:
+            row[name] = record.get(name)
+
+        rows = self._rows.setdefault(probe, [])
+        rows.append(row)
+        if len(rows) >= self.batch_size:
+            self._flush(probe)
+
+    def close(self):
+        for probe in list(self._rows):
+            self._flush(probe)
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = dict()
+
+    def _column(self, rows, name, arrow_type):
+        values = [row.get(name) for row in rows]
+        if pa.types.is_integer(arrow_type):
+            values = [_as_int(v, self.hex_bytes) if v != None else None for v in values]
+        elif arrow_type == pa.string() or arrow_type == NAME_TYPE:
+            # the probe name is the only string that is not bytes in the first place
+            values = [_as_str(v, self.hex_bytes and name != "probe") for v in values]
+        elif arrow_type == pa.binary():
+            values = [_as_bytes(v, self.hex_bytes) for v in values]
+        return pa.array(values, type=arrow_type)
+
+    def _infer_schema(self, rows, schema = None):
+        """ Returns schema (by default, the hit columns) extended with the columns of rows it lacks,
+            and with its null columns typed by the values of rows. """
+        fields = list(schema) if schema != None else [pa.field(name, arrow_type) for name, arrow_type in HIT_COLUMNS]
+        positions = {field.name: index for index, field in enumerate(fields)}
+        names = dict.fromkeys(name for row in rows for name in row)
+        for name in names:
+            if name in positions and not pa.types.is_null(fields[positions[name]].type):
+                continue
+            inferred = pa.field(name, pa.array([row.get(name) for row in rows]).type)
+            if name not in positions:
+                positions[name] = len(fields)
+                fields.append(inferred)
+            elif not pa.types.is_null(inferred.type):
+                fields[positions[name]] = inferred
+        return pa.schema(fields)
+
+    def _path(self, probe):
+        return os.path.join(self.out_dir, "{}.parquet".format(probe))
+
+    def _widen(self, probe, schema):
+        """ Switches a probe to a wider schema, rewriting what was already written of it. """
+        self.schemas[probe] = schema
+        writer = self._writers.pop(probe, None)
+        if writer == None:
+            return
+        writer.close()
+        table = pq.read_table(self._path(probe))
+        columns = [table[field.name].cast(field.type) if field.name in table.column_names
+                   else pa.nulls(table.num_rows, field.type) for field in schema]
+        self._writers[probe] = pq.ParquetWriter(self._path(probe), schema)
+        self._writers[probe].write_table(pa.Table.from_arrays(columns, schema=schema))
+
+    def _flush(self, probe):
+        rows = self._rows.pop(probe, [])
+        if len(rows) == 0:
+            return
+        if probe not in self.schemas:
+            if self.catalog != None and probe in self.catalog.names():
+                self.schemas[probe] = probe_schema(self.catalog.probe(self.catalog.spec(probe)))
+            else:
+                self.schemas[probe] = self._infer_schema(rows)
+                self._inferred.add(probe)
+        elif probe in self._inferred:
+            schema = self._infer_schema(rows, self.schemas[probe])
+            if schema != self.schemas[probe]:
+                self._widen(probe, schema)
+        schema = self.schemas[probe]
+
+        batch = pa.RecordBatch.from_arrays([self._column(rows, field.name, field.type) for field in schema],
+                                           schema=schema)
+        if probe not in self._writers:
+            self._writers[probe] = pq.ParquetWriter(self._path(probe), schema)
+        self._writers[probe].write_table(pa.Table.from_batches([batch]))
+
+def export_time_table(time_table, out_dir, probes = None):
+    """ Writes every hit held by a TimeTable to out_dir. """
+    exporter = ParquetExporter(out_dir, probes)
+    with time_table.lock:
+        for history in time_table.times.values():
+            for hit in history.hits:
+                exporter.add(hit.to_dict())
+    exporter.close()
+
+def export_trace(path, out_dir, probes = None, catalog = None):
+    """ Writes every hit of a trace recorded by a sink.Sink to out_dir. """
+    exporter = ParquetExporter(out_dir, probes, hex_bytes=not path.endswith(BINARY_EXT), catalog=catalog)
+    for record in read_records(path):
+        if "probe" in record:
+            exporter.add(record)
+    exporter.close()
+
+# Main #
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert a recorded trace into one Parquet file per probe.")
+    parser.add_argument('trace',
+                        metavar='trace',
+                        type=str,
+                        help='trace written with --output')
+    parser.add_argument('out_dir',
+                        metavar='out_dir',
+                        type=str,
+                        help='directory to write Parquet files to')
+    parser.add_argument('--catalog',
+                        metavar='catalog',
+                        type=str,
+                        default=CATALOG_PATH,
+                        help='probe catalog giving the columns of the probes it has')
+    args = parser.parse_args()
+
+    try:
+        catalog = load_catalog(args.catalog)
+    except ValueError as e:
+        parser.error(str(e))
+    export_trace(args.trace, args.out_dir, catalog=catalog)
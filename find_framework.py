@@ -2,9 +2,12 @@
 
 import argparse
 
+from catalog import load_catalog
 from generator.consts import *
 from generator.generator import Probe
 from probes import ProbeHit, ProbeHistory, TimeTable, USDTThread, USDTArg
+from sink import add_output_args, open_sink
+from targets import add_target_args, open_targets
 from threading import Lock, Condition
 from time import sleep
 from util import WorkerMaster, WorkerThread
@@ -13,6 +16,9 @@ from bsonjs import dumps
 
 ####################################################################################
 
+# sink.Sink that completed requests are written to instead of being printed, if any
+SINK = None
+
 # can hint that the opCtx did or did not tranform to an aggregation pipeline
 # by setting transformedToAgg to True or False
 def clear(opCtx, print_query = False):
@@ -81,6 +87,21 @@ def print_if_ready(opCtx):
 
         clear(opCtx)
 
+        if SINK != None:
+            SINK.write({
+                "opCtx": opCtx,
+                "request": request_body,
+                "nss": nss,
+                "query": query,
+                "ntoreturn": ntoreturn,
+                "ntoskip": ntoskip,
+                "aggQuery": aggQuery,
+                "planSummary": planSummary,
+                "summaryStats": summaryStats,
+                "numResults": numResults
+            })
+            return
+
         #print it all out
         print("Request body: ", request_body)
         print("Namespace: ", nss, ", running query: ", query)
@@ -206,8 +227,14 @@ class FindCmdFailedTimeTable(TimeTable):
 
     def _callback_gen(self, view=None):
         def process_callback(probe, hit):
-            print("find failed!")
             opCtx = hit.args['opCtx']
+            if SINK != None:
+                with FindCmdTimeTable.classLock:
+                    request_body = FindCmdTimeTable.dataDict.get(opCtx)
+                SINK.write({"opCtx": opCtx, "request": request_body, "failed": True})
+                clear(opCtx)
+                return
+            print("find failed!")
             # remove all data collected for this Op
             clear(opCtx, print_query=True)
             print('\n\n\n')
@@ -232,130 +259,10 @@ class QueryOpEndTimeTable(TimeTable):
             print_if_ready(opCtx)
         return process_callback
 
-# Definition of all the probes. The class they are associated to is the key
-PROBES = {
-    FindCmdTimeTable: {
-            PROBE_NAME_KEY: FindCmdTimeTable.probeName,
-            PROBE_ARGS_KEY: [
-                {
-                    ARG_TYPE_KEY: POINTER_TYPE,
-                    ARG_NAME_KEY: "opCtx" #TODO: make this key a constant
-                },
-                {
-                    ARG_TYPE_KEY: LONG_STRING_TYPE,
-                    ARG_NAME_KEY: 'bson'
-                }
-            ]
-    },
-    QueryOpBeginTimeTable:  {
-            PROBE_NAME_KEY: QueryOpBeginTimeTable.probeName,
-            PROBE_ARGS_KEY: [
-                 {
-                     ARG_TYPE_KEY: POINTER_TYPE,
-                     ARG_NAME_KEY: "opCtx"
-                 },{
-                     ARG_TYPE_KEY: STRING_TYPE,
-                     ARG_NAME_KEY: "nss",
-                     ARG_STR_LEN_KEY: 50 #TODO: determine a realistic max length
-                 },{
-                     ARG_TYPE_KEY: LONG_STRING_TYPE,
-                     ARG_NAME_KEY: 'bson'
-                 },{
-                     ARG_TYPE_KEY: LONG_LONG_TYPE,
-                     ARG_NAME_KEY: "ntoreturn"
-                 },{
-                     ARG_TYPE_KEY: LONG_LONG_TYPE,
-                     ARG_NAME_KEY: "ntoskip"
-                 }
-            ]
-    },
-    FindToAggTimeTable: {
-        PROBE_NAME_KEY: FindToAggTimeTable.probeName,
-        PROBE_ARGS_KEY: [
-            {
-                ARG_TYPE_KEY: POINTER_TYPE,
-                ARG_NAME_KEY: 'opCtx'
-            },{
-                ARG_TYPE_KEY: LONG_STRING_TYPE,
-                ARG_NAME_KEY: 'aggQuery'
-            }
-        ]
-    },
-    FindCmdPlanTimeTable: {
-        PROBE_NAME_KEY: FindCmdPlanTimeTable.probeName,
-        PROBE_ARGS_KEY: [
-            {
-                ARG_TYPE_KEY: POINTER_TYPE,
-                ARG_NAME_KEY: 'opCtx'
-            },{
-                ARG_TYPE_KEY: STRING_TYPE,
-                ARG_STR_LEN_KEY: 100, #TODO: determine a realistic max length
-                ARG_NAME_KEY: 'planSummary'
-            },{
-                ARG_TYPE_KEY: LONG_LONG_TYPE,
-                ARG_NAME_KEY: 'planSummary_sz'
-            }
-        ]
-    },
-    FindCmdFailedTimeTable: {
-        PROBE_NAME_KEY: FindCmdFailedTimeTable.probeName,
-        PROBE_ARGS_KEY: [
-            {
-                ARG_TYPE_KEY: POINTER_TYPE,
-                ARG_NAME_KEY: 'opCtx'
-            }
-        ]
-    },
-    QueryOpEndTimeTable: {
-        PROBE_NAME_KEY: QueryOpEndTimeTable.probeName,
-        PROBE_ARGS_KEY: [
-            {
-                ARG_TYPE_KEY: POINTER_TYPE,
-                ARG_NAME_KEY: 'opCtx'
-            },
-            {
-                ARG_TYPE_KEY: STRUCT_TYPE,
-                ARG_NAME_KEY: 'summaryStats',
-                ARG_STRUCT_FIELDS_KEY: [
-                    {
-                        ARG_TYPE_KEY: UNSIGNED_LONG_TYPE,
-                        ARG_NAME_KEY: 'nReturned'
-                    },{
-                        ARG_TYPE_KEY: UNSIGNED_LONG_TYPE,
-                        ARG_NAME_KEY: 'totalKeysExamined'
-                    },{
-                        ARG_TYPE_KEY: UNSIGNED_LONG_TYPE,
-                        ARG_NAME_KEY: 'totalDocsExamined'
-                    },{
-                        ARG_TYPE_KEY: LONG_LONG_TYPE,
-                        ARG_NAME_KEY: 'executionTimeMillis'
-                    },{
-                        ARG_TYPE_KEY: LONG_LONG_TYPE,
-                        ARG_NAME_KEY: 'collectionScans'
-                    },{
-                        ARG_TYPE_KEY: LONG_LONG_TYPE,
-                        ARG_NAME_KEY: 'collectionScansNonTailable'
-                    },{
-                        ARG_TYPE_KEY: CHAR_TYPE,
-                        ARG_NAME_KEY: 'hasSortStage'
-                    },{
-                        ARG_TYPE_KEY: CHAR_TYPE,
-                        ARG_NAME_KEY: 'usedDisk'
-                    },{
-                        ARG_TYPE_KEY: CHAR_TYPE,
-                        ARG_NAME_KEY: 'fromMultiPlanner'
-                    },{
-                        ARG_TYPE_KEY: CHAR_TYPE,
-                        ARG_NAME_KEY: 'replanned'
-                    }
-                ]
-            },{
-                ARG_TYPE_KEY: LONG_LONG_TYPE,
-                ARG_NAME_KEY: 'numResults'
-            }
-        ]
-    }
-}
+# Definition of all the probes, see catalog.json. The class they are associated to is the key
+PROBES = {klass: load_catalog().spec(klass.probeName)
+          for klass in [FindCmdTimeTable, QueryOpBeginTimeTable, FindToAggTimeTable,
+                        FindCmdPlanTimeTable, FindCmdFailedTimeTable, QueryOpEndTimeTable]}
 
 
 ####################################################################################
@@ -364,19 +271,18 @@ PROBES = {
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Gather timing data from WiredTiger.")
-    parser.add_argument('pid',
-                        metavar='pid',
-                        type=int,
-                        nargs=1,
-                        help='pid of process emitting probes')
+    add_target_args(parser)
+    add_output_args(parser)
     args = parser.parse_args()
+    targets = open_targets(parser, args)
     print(args)
+    SINK = open_sink(args)
 
     mr = None
     try:
         workers = []
         for timetable, probe in PROBES.items():
-            worker = USDTThread(args.pid[0], [probe], timetable())
+            worker = USDTThread(targets, [probe], timetable())
             workers.append(worker)
 
         mr = WorkerMaster(workers)
@@ -388,3 +294,5 @@ if __name__ == '__main__':
     except KeyboardInterrupt:
         if mr:
             mr.kill_all()
+        if SINK != None:
+            SINK.close()
@@ -1,62 +1,218 @@
 #!/usr/bin/python3
-import sys
+import argparse
 import errno
-import ctypes as ct
-from bcc import BPF, USDT
+from datetime import datetime
+from time import sleep, time
+from bcc import BPF
+from sink import add_output_args, open_sink
+from symcache import SymbolCache
+from generator.consts import MAX_PIDS
+from targets import add_target_args, open_targets
+from util import DoubleBufferedMaps, Timer, log2_percentile, parse_interval
 
-if len(sys.argv) == 1:
-    print("ERROR: need a pid to instrument")
-    exit(1)
-
-pid = int(sys.argv[1])
+parser = argparse.ArgumentParser(description="Report the backtraces that spend the most time waiting on futexes, " +
+    "and the most contended locks.")
+add_target_args(parser)
+parser.add_argument('-n', '--num',
+                    metavar='num',
+                    type=int,
+                    default=10,
+                    help='number of backtraces to report')
+parser.add_argument('-i', '--interval',
+                    metavar='interval',
+                    type=parse_interval,
+                    default=0,
+                    help='report the waits of each interval (e.g. 10s, 5m) instead of once at CTRL-C')
+parser.add_argument('-f', '--folded',
+                    metavar='folded',
+                    type=str,
+                    default=None,
+                    help='write all stacks as folded stacks ("comm;frame1;frame2 ns") weighted by total ' +
+                         'wait time to this file ("-" for stdout), for flame graphs. With --interval, ' +
+                         'every interval is written to its own file suffixed by its end time (in ms since the epoch)')
+add_output_args(parser)
+args = parser.parse_args()
+targets = open_targets(parser, args)
+sink = open_sink(args)
 
+# Futex waits are aggregated in the kernel per (pid, user stack id) (total & max blocked time, number of
+# waits), so userspace only has to read the waits map once per interval and symbolize each
+# unique stack once. The map is double buffered, see util.DoubleBufferedMaps. The futex syscall
+# is traced system wide, so only the pids in the pid_filter map are kept.
+#
+# Locks are profiled from the lock_enter/lock_exit probe pairs, keyed by the stack id of the
+# lock_enter callsite: the wait time runs from lock_enter until the lock is acquired (or is 0 if
+# it never had to wait), and the hold time from the acquisition until lock_exit. Both are kept as
+# log2 histograms in the kernel. Locks nest, so every thread has a stack of lock states (indexed by
+# its lock depth), and only the innermost lock can be waiting. glibc waits for a contended mutex
+# with FUTEX_WAIT on the mutex word and a value of 2, which condition variables & other futex users
+# don't: the first such wait pins the futex word of the innermost lock, and it is acquired when its
+# last wait on that word returns.
 text = """
 #include <linux/ptrace.h>
 #include <linux/futex.h>
 #include <linux/sched.h> /* For TASK_COMM_LEN */
 
+BPF_HASH(pid_filter, u32, u8, MAX_PIDS);
+
 BPF_HASH(tid_to_start, u32);
 BPF_HASH(tid_to_stackid, u32, int);
 BPF_STACK_TRACE(stacks, 1024);//will spit back stack ids and store the stack trace
 
-BPF_PERF_OUTPUT(futex_out);
-struct futex_out_struct {
-    char comm[2*TASK_COMM_LEN];
-    u64 nanoseconds;
-    int stack_id;
-    u32 tgid;
+// user stacks are only meaningful within the process they were taken in
+struct stack_key {
     u32 pid;
+    int stack_id;
+};
+
+struct wait_stats {
+    u64 total_ns;
+    u64 count;
+    u64 max_ns;
+    char comm[TASK_COMM_LEN]; // of the last waiter
+};
+
+struct lock_state {
+    u64 enter_ns;
+    u64 acquired_ns; // 0 until the lock is acquired
+    u64 uaddr; // the futex word waited on, 0 until the lock is waited for
+    int stack_id;
+};
+
+struct lock_frame {
+    u32 tid;
+    u32 depth;
+};
+
+struct lock_hist_key {
+    struct stack_key stack;
+    u64 slot;
+};
+
+struct lock_totals {
+    u64 wait_ns;
+    u64 hold_ns;
+    u64 count;
 };
 
+BPF_HASH(lock_depths, u32, u32);
+BPF_HASH(lock_states, struct lock_frame, struct lock_state);
+// the contended mutex word a thread is waiting on, see the top of this file
+BPF_HASH(tid_to_uaddr, u32, u64);
+
+BPF_HASH(waits_0, struct stack_key, struct wait_stats);
+BPF_HASH(waits_1, struct stack_key, struct wait_stats);
+BPF_HISTOGRAM(lock_wait_hist_0, struct lock_hist_key);
+BPF_HISTOGRAM(lock_wait_hist_1, struct lock_hist_key);
+BPF_HISTOGRAM(lock_hold_hist_0, struct lock_hist_key);
+BPF_HISTOGRAM(lock_hold_hist_1, struct lock_hist_key);
+BPF_HASH(lock_totals_0, struct stack_key, struct lock_totals);
+BPF_HASH(lock_totals_1, struct stack_key, struct lock_totals);
+BPF_ARRAY(control, u32, 1);
+
 int stdx_mutex_entry(struct pt_regs *ctx) {
     int stack_id = stacks.get_stackid(ctx, BPF_F_USER_STACK | BPF_F_REUSE_STACKID);
     u32 tid = bpf_get_current_pid_tgid();
-    tid_to_stackid.insert(&tid, &stack_id);
+    tid_to_stackid.update(&tid, &stack_id);
+
+    struct lock_frame frame = {};
+    frame.tid = tid;
+    u32 *depth = lock_depths.lookup(&tid);
+    if (depth) frame.depth = *depth;
+    u32 next_depth = frame.depth + 1;
+    lock_depths.update(&tid, &next_depth);
+
+    struct lock_state state = {};
+    state.enter_ns = bpf_ktime_get_ns();
+    state.stack_id = stack_id;
+    lock_states.update(&frame, &state);
     return 0;
 }
 
 int stdx_mutex_exit(struct pt_regs *ctx) {
-    // if this is hit and the start time has not been removed, then the stack will not be read
-    u32 tid = bpf_get_current_pid_tgid();
-    u64 *start = tid_to_start.lookup(&tid);
-    if(start) {
-        int* stackid = tid_to_stackid.lookup(&tid);
-        if(stackid) {
-            tid_to_stackid.delete(&tid);
+    u64 now = bpf_ktime_get_ns();
+    u64 pid_tid = bpf_get_current_pid_tgid();
+    u32 tid = pid_tid;
+    tid_to_stackid.delete(&tid);
+    tid_to_start.delete(&tid);
+
+    // pop the innermost lock of the thread
+    u32 *depth = lock_depths.lookup(&tid);
+    if (!depth || *depth == 0) return 0;
+    struct lock_frame frame = {};
+    frame.tid = tid;
+    frame.depth = *depth - 1;
+    if (frame.depth == 0) lock_depths.delete(&tid);
+    else lock_depths.update(&tid, &frame.depth);
+
+    // futex waits are attributed to the lock that is now innermost, if any
+    if (frame.depth > 0) {
+        struct lock_frame outer = {};
+        outer.tid = tid;
+        outer.depth = frame.depth - 1;
+        struct lock_state *outer_state = lock_states.lookup(&outer);
+        if (outer_state) tid_to_stackid.update(&tid, &outer_state->stack_id);
+    }
+
+    struct lock_state *state = lock_states.lookup(&frame);
+    if (!state) return 0;
+    u64 acquired_ns = state->acquired_ns ? state->acquired_ns : state->enter_ns;
+    u64 wait_ns = acquired_ns - state->enter_ns;
+    u64 hold_ns = now - acquired_ns;
+    struct stack_key stack = {};
+    stack.pid = pid_tid >> 32;
+    stack.stack_id = state->stack_id;
+    lock_states.delete(&frame);
+
+    struct lock_hist_key wait_key = {};
+    wait_key.stack = stack;
+    wait_key.slot = bpf_log2l(wait_ns);
+    struct lock_hist_key hold_key = {};
+    hold_key.stack = stack;
+    hold_key.slot = bpf_log2l(hold_ns);
+
+    struct lock_totals empty = {};
+    struct lock_totals *totals = NULL;
+    u32 zero = 0;
+    u32 *active = control.lookup(&zero);
+    if (active && *active) {
+        lock_wait_hist_1.increment(wait_key);
+        lock_hold_hist_1.increment(hold_key);
+        totals = lock_totals_1.lookup(&stack);
+        if (!totals) {
+            lock_totals_1.insert(&stack, &empty);
+            totals = lock_totals_1.lookup(&stack);
+        }
+    } else {
+        lock_wait_hist_0.increment(wait_key);
+        lock_hold_hist_0.increment(hold_key);
+        totals = lock_totals_0.lookup(&stack);
+        if (!totals) {
+            lock_totals_0.insert(&stack, &empty);
+            totals = lock_totals_0.lookup(&stack);
         }
-        tid_to_start.delete(&tid);
     }
+    if (!totals) return 0;
+    __sync_fetch_and_add(&totals->wait_ns, wait_ns);
+    __sync_fetch_and_add(&totals->hold_ns, hold_ns);
+    __sync_fetch_and_add(&totals->count, 1);
     return 0;
 }
 
-int syscall__futex(struct pt_regs* ctx, int* uaddr, int futex_op) {
+int syscall__futex(struct pt_regs* ctx, int* uaddr, int futex_op, u32 val) {
     u64 pid_tid = bpf_get_current_pid_tgid();
     u32 pid = pid_tid >> 32;
     u32 tid = pid_tid;
-    if(pid != %PID%) return 0; //filter on pid
+    if(!pid_filter.lookup(&pid)) return 0; //filter on pid
     if((futex_op & ~(FUTEX_PRIVATE_FLAG | FUTEX_CLOCK_REALTIME)) != FUTEX_WAIT) return 0;
     u64 start = bpf_ktime_get_ns();
     tid_to_start.insert(&tid, &start);
+    if (val == 2) {
+        u64 addr = (u64)uaddr;
+        tid_to_uaddr.update(&tid, &addr);
+    } else {
+        tid_to_uaddr.delete(&tid);
+    }
     return 0;
 }
 
@@ -64,86 +220,214 @@ int syscall__futex_ret(struct pt_regs* ctx, int* uaddr, int futex_op) {
     u64 pid_tid = bpf_get_current_pid_tgid();
     u32 pid = pid_tid >> 32;
     u32 tid = pid_tid;
-    if(pid != %PID%) return 0; //filter on pid
+    if(!pid_filter.lookup(&pid)) return 0; //filter on pid
     u64 *start = tid_to_start.lookup(&tid);
     if(!start) return 0;
     u64 now = bpf_ktime_get_ns();
+    u64 delta = now - *start;
     tid_to_start.delete(&tid);
 
+    // a wait on the mutex word of the innermost lock may have acquired it
+    u64 *wait_uaddr = tid_to_uaddr.lookup(&tid);
+    u32 *depth = lock_depths.lookup(&tid);
+    if (wait_uaddr && depth && *depth > 0) {
+        struct lock_frame frame = {};
+        frame.tid = tid;
+        frame.depth = *depth - 1;
+        struct lock_state *state = lock_states.lookup(&frame);
+        if (state && !state->uaddr) state->uaddr = *wait_uaddr;
+        if (state && state->uaddr == *wait_uaddr) state->acquired_ns = now;
+    }
+    tid_to_uaddr.delete(&tid);
+
     int* stack_idp = tid_to_stackid.lookup(&tid);
     if(!stack_idp) return 0;
+    struct stack_key stack = {};
+    stack.pid = pid;
+    stack.stack_id = *stack_idp;
     tid_to_stackid.delete(&tid);
 
-    struct futex_out_struct out = {};
-    bpf_get_current_comm(&out.comm, sizeof(out.comm));
-    out.nanoseconds = now - *start;
-    out.stack_id = *stack_idp;
-    out.tgid = tid;
-    out.pid = pid;
-    futex_out.perf_submit(ctx, &out, sizeof(out));
+    struct wait_stats empty = {};
+    struct wait_stats *stats = NULL;
+    u32 zero = 0;
+    u32 *active = control.lookup(&zero);
+    if (active && *active) {
+        stats = waits_1.lookup(&stack);
+        if (!stats) {
+            waits_1.insert(&stack, &empty);
+            stats = waits_1.lookup(&stack);
+        }
+    } else {
+        stats = waits_0.lookup(&stack);
+        if (!stats) {
+            waits_0.insert(&stack, &empty);
+            stats = waits_0.lookup(&stack);
+        }
+    }
+    if (!stats) return 0;
+
+    __sync_fetch_and_add(&stats->total_ns, delta);
+    __sync_fetch_and_add(&stats->count, 1);
+    if (delta > stats->max_ns) stats->max_ns = delta;
+    bpf_get_current_comm(&stats->comm, sizeof(stats->comm));
     return 0;
 }
 
-""".replace("%PID%", str(pid))
-mutex_enter = USDT(pid=pid)
+""".replace("MAX_PIDS", str(MAX_PIDS))
+mutex_enter = targets.usdt()
 mutex_enter.enable_probe(probe="lock_enter", fn_name="stdx_mutex_entry")
 
-mutex_exit = USDT(pid=pid)
+mutex_exit = targets.usdt()
 mutex_exit.enable_probe(probe="lock_exit", fn_name="stdx_mutex_exit")
 
 b = BPF(text=text, usdt_contexts=[mutex_enter, mutex_exit])
 futex_fnname = b.get_syscall_fnname("futex")
 b.attach_kprobe(event=futex_fnname, fn_name="syscall__futex")
 b.attach_kretprobe(event=futex_fnname, fn_name="syscall__futex_ret")
+pids = targets.all_pids()
+targets.fill_filter(b, pids)
 
-NUM_BACKTRACES = 10
-backtraces = [(-1, [''])] * NUM_BACKTRACES
-
-OUTPUT_CHANNEL = 'futex_out'
+maps = DoubleBufferedMaps(b, "control", ["waits", "lock_wait_hist", "lock_hold_hist", "lock_totals"])
+symbols = SymbolCache(b.sym)
 
 out_of_mem = False
 
 
-def walk_backtrace(stack_traces, event):
+def walk_backtrace(stack_traces, pid, stack_id):
     missed_stack = False
     global out_of_mem
-    if event.stack_id < 0 and event.stack_id != -errno.EFAULT:
+    if stack_id < 0 and stack_id != -errno.EFAULT:
         missed_stack = True
-        out_of_mem = out_of_mem or event.stack_id == -errno.ENOMEM
+        out_of_mem = out_of_mem or stack_id == -errno.ENOMEM
 
-    line = [event.comm.decode('utf-8', 'replace')]  # start the line with what COMM it is
     try:
-        user_stack = list(stack_traces.walk(event.stack_id))
+        user_stack = list(stack_traces.walk(stack_id))
     except KeyError:
         missed_stack = True
     if missed_stack:
-        line.append("[Missed User Stack]")
+        return ["[Missed User Stack]"]
+    return symbols.stack(reversed(user_stack), pid, stack_id)
+
+
+def fold(comm, backtrace):
+    return ';'.join(frame.replace(';', ':') for frame in [comm] + backtrace)
+
+
+def write_folded(folded, path):
+    lines = ''.join("{} {}\n".format(stack, ns) for stack, ns in folded.items())
+    if path == '-':
+        print(lines, end='')
     else:
-        line.extend(
-            [b.sym(addr, event.tgid).decode('utf-8', 'replace') for addr in reversed(user_stack)])
-    return line
+        with open(path, 'w') as fd:
+            fd.write(lines)
+
+
+LOCK_PERCENTILES = [50, 99]
+
+
+def report_locks(start, end, tables, stack_traces):
+    """ Reports the locks with the most total wait time, with wait & hold time percentiles. """
+    wait_hists = dict()
+    hold_hists = dict()
+    for hists, table in [(wait_hists, tables["lock_wait_hist"]), (hold_hists, tables["lock_hold_hist"])]:
+        for key, count in table:
+            if count.value > 0:
+                hists.setdefault((key.stack.pid, key.stack.stack_id), dict())[key.slot] = count.value
 
+    locks = sorted(tables["lock_totals"], key=lambda item: item[1].wait_ns, reverse=True)[:args.num]
+    if sink == None and len(locks) > 0:
+        print("Most contended locks:")
+    for stack, totals in locks:
+        wait_hist = wait_hists.get((stack.pid, stack.stack_id), dict())
+        hold_hist = hold_hists.get((stack.pid, stack.stack_id), dict())
+        backtrace = walk_backtrace(stack_traces, stack.pid, stack.stack_id)
+        if sink != None:
+            record = {"start": start, "end": end, "lock": True, "pid": stack.pid, "count": totals.count,
+                      "wait_ns": totals.wait_ns, "hold_ns": totals.hold_ns, "stack": backtrace}
+            for pct in LOCK_PERCENTILES:
+                record["wait_p{}_ns".format(pct)] = log2_percentile(wait_hist, pct)
+                record["hold_p{}_ns".format(pct)] = log2_percentile(hold_hist, pct)
+            sink.write(record)
+            continue
+        print("PID: {} COUNT: {} WAIT: {} (p50 {} p99 {}) HOLD: {} (p50 {} p99 {})".format(
+              stack.pid,
+              totals.count,
+              Timer.get_unit_str(totals.wait_ns / 1000000000, "s"),
+              *[Timer.get_unit_str(log2_percentile(wait_hist, pct) / 1000000000, "s") for pct in LOCK_PERCENTILES],
+              Timer.get_unit_str(totals.hold_ns / 1000000000, "s"),
+              *[Timer.get_unit_str(log2_percentile(hold_hist, pct) / 1000000000, "s") for pct in LOCK_PERCENTILES]))
+        print("BT: ", '\n'.join(backtrace))
 
-def record_backtrace(cpu, data, size):
-    event = b[OUTPUT_CHANNEL].event(data)
-    time_delta = event.nanoseconds
+
+# folded stack -> total wait ns over the whole capture
+capture_folded = dict()
+
+
+def report(final = False):
+    start, end, tables = maps.snapshot()
+    # rank by the total time blocked, not by the single worst wait
+    waits = sorted(tables["waits"], key=lambda item: item[1].total_ns, reverse=True)
     stack_traces = b['stacks']
-    for i in range(NUM_BACKTRACES):
-        if backtraces[i][0] == -1 or backtraces[i][0] < time_delta:
-            bt = walk_backtrace(stack_traces, event)
-            backtraces.insert(i, (time_delta, bt))
-            backtraces.pop()
-            return
+    for pid in pids:
+        symbols.refresh(pid)
+
+    if args.folded != None:
+        folded = dict()
+        for stack, stats in waits:
+            folded_stack = fold(stats.comm.decode('utf-8', 'replace'),
+                                walk_backtrace(stack_traces, stack.pid, stack.stack_id))
+            folded[folded_stack] = folded.get(folded_stack, 0) + stats.total_ns
+        if args.interval > 0:
+            # in ms, since intervals may be shorter than a second
+            path = args.folded if args.folded == '-' else "{}.{}".format(args.folded, int(end * 1000))
+            write_folded(folded, path)
+        else:
+            for stack, ns in folded.items():
+                capture_folded[stack] = capture_folded.get(stack, 0) + ns
+            if final:
+                write_folded(capture_folded, args.folded)
+        return
+
+    if sink == None:
+        print("{} - {}".format(datetime.fromtimestamp(start).time(), datetime.fromtimestamp(end).time()))
+    for stack, stats in waits[:args.num]:
+        comm = stats.comm.decode('utf-8', 'replace')
+        backtrace = walk_backtrace(stack_traces, stack.pid, stack.stack_id)
+        if sink != None:
+            sink.write({"start": start, "end": end, "pid": stack.pid, "comm": comm, "total_ns": stats.total_ns,
+                        "count": stats.count, "max_ns": stats.max_ns, "stack": backtrace})
+            continue
+        print("PID: {} TOTAL: {} COUNT: {} MAX: {}".format(stack.pid,
+                                                   Timer.get_unit_str(stats.total_ns / 1000000000, "s"),
+                                                   stats.count,
+                                                   Timer.get_unit_str(stats.max_ns / 1000000000, "s")))
+        print("BT: ", '\n'.join([comm] + backtrace))
+    report_locks(start, end, tables, stack_traces)
+    if sink == None:
+        print(str(symbols), end='')
+    if out_of_mem:
+        print("WARNING: the stack trace map is full, some backtraces were missed")
+
 
+def watch():
+    exited, started = targets.poll()
+    if len(exited) + len(started) > 0:
+        targets.update_filter(b, exited, started)
+    if len(exited) > 0 and sink != None:
+        sink.flush()
 
-b[OUTPUT_CHANNEL].open_perf_buffer(record_backtrace)
 
 print("listening...")
-while True:
+next_report = time() + args.interval
+while targets.alive:
     try:
-        b.perf_buffer_poll()
+        sleep(0.1)
+        watch()
+        if args.interval > 0 and time() >= next_report:
+            report()
+            next_report += args.interval
     except KeyboardInterrupt:
-        for time, backtrace in backtraces:
-            print("TIME: ", time)
-            print("BT: ", '\n'.join(backtrace))
-        exit()
+        break
+report(final=True)
+if sink != None:
+    sink.close()
@@ -1,6 +1,8 @@
 """ Constants & utilities to be used across USDT test runner and generator """
 
-from .err import errors
+import ctypes as ct
+
+from .err import errors, error_strings
 
 # Keys #
 
@@ -11,19 +13,116 @@ ARG_NAME_KEY = "name"
 PROBE_HIT_KEY = "hits"
 ARG_STR_LEN_KEY = "length"
 ARG_STRUCT_FIELDS_KEY = "fields"
+ARG_ARRAY_LEN_KEY = "count"
+ARG_DEREF_KEY = "deref"
+ARG_PACKED_KEY = "packed"
+ARG_ALIGN_KEY = "align"
 MAX_STR_SZ_KEY = "max_str_sz"
 MAX_MAP_SZ_KEY = "max_map_sz"
 SAMPLES_PROPORTION_KEY = "samples_prop"
 
-# EBPF-C Code #
+# Dialects #
 
-HEADERS = """
+# Programs are generated for bcc, which compiles them on the traced host, or for libbpf, as a
+# CO-RE object compiled ahead of time by clang (see core.py). The generated code is the same but
+# for the few constructs below: bcc rewrites map method calls, libbpf needs plain helper calls.
+# The other bcc-isms are defined for libbpf in its headers.
+BCC_DIALECT = "bcc"
+CORE_DIALECT = "core"
+DIALECTS = [BCC_DIALECT, CORE_DIALECT]
+
+HEADERS = {
+    BCC_DIALECT: """
 #include <linux/ptrace.h>
 #include <linux/sched.h>
+""",
+    CORE_DIALECT: """
+#include "vmlinux.h"
+#include <bpf/bpf_helpers.h>
+#include <bpf/bpf_tracing.h>
+#include <bpf/usdt.bpf.h>
+
+char LICENSE[] SEC("license") = "GPL";
+
+#ifndef TASK_COMM_LEN
+#define TASK_COMM_LEN 16
+#endif
+
+// bcc's map declarations, as libbpf BTF-defined maps
+#define BPF_HASH(_name, _key, _leaf, _size) struct { \\
+\t__uint(type, BPF_MAP_TYPE_HASH); __uint(max_entries, _size); __type(key, _key); __type(value, _leaf); \\
+} _name SEC(".maps")
+#define BPF_ARRAY(_name, _leaf, _size) struct { \\
+\t__uint(type, BPF_MAP_TYPE_ARRAY); __uint(max_entries, _size); __type(key, u32); __type(value, _leaf); \\
+} _name SEC(".maps")
+#define BPF_HISTOGRAM(_name, _key, _size) struct { \\
+\t__uint(type, BPF_MAP_TYPE_ARRAY); __uint(max_entries, _size); __type(key, _key); __type(value, u64); \\
+} _name SEC(".maps"); \\
+static __always_inline void _name##_increment(_key slot) { \\
+\tu64 *count = bpf_map_lookup_elem(&_name, &slot); \\
+\tif (count != NULL) __sync_fetch_and_add(count, 1); \\
+}
+#define BPF_PERF_OUTPUT(_name) struct { \\
+\t__uint(type, BPF_MAP_TYPE_PERF_EVENT_ARRAY); __uint(key_size, sizeof(u32)); __uint(value_size, sizeof(u32)); \\
+} _name SEC(".maps")
+
+// bcc's helpers: USDT args are located by libbpf, from the notes of the traced binary
+#define bpf_usdt_readarg(_num, _ctx, _addr) ({ \\
+\tlong _arg = 0; \\
+\tint _err = bpf_usdt_arg(_ctx, (_num) - 1, &_arg); \\
+\t*(_addr) = (typeof(*(_addr)))_arg; \\
+\t_err; \\
+})
+#define bpf_probe_read bpf_probe_read_user
+#define bpf_probe_read_str bpf_probe_read_user_str
+
+static __always_inline unsigned int bpf_log2(unsigned int v) {
+\tunsigned int r, shift;
+\tr = (v > 0xFFFF) << 4; v >>= r;
+\tshift = (v > 0xFF) << 3; v >>= shift; r |= shift;
+\tshift = (v > 0xF) << 2; v >>= shift; r |= shift;
+\tshift = (v > 0x3) << 1; v >>= shift; r |= shift;
+\treturn r | (v >> 1);
+}
+
+static __always_inline unsigned int bpf_log2l(unsigned long v) {
+\tunsigned int hi = v >> 32;
+\treturn hi ? bpf_log2(hi) + 32 + 1 : bpf_log2(v) + 1;
+}
 """
+}
 
-# Default long string map storage: this caps maximum string size at
-# ~ 67 MB (only one long string supported per probe).
+MAP_LOOKUP = {
+    BCC_DIALECT: "{map}.lookup({key})",
+    CORE_DIALECT: "bpf_map_lookup_elem(&{map}, {key})"
+}
+HIST_INCREMENT = {
+    BCC_DIALECT: "{hist}.increment({slot})",
+    CORE_DIALECT: "{hist}_increment({slot})"
+}
+PERF_SUBMIT = {
+    BCC_DIALECT: "{map}.perf_submit(ctx, {data}, {size})",
+    CORE_DIALECT: "bpf_perf_event_output(ctx, &{map}, BPF_F_CURRENT_CPU, {data}, {size})"
+}
+PROBE_FN_SECTION = {
+    BCC_DIALECT: "",
+    CORE_DIALECT: 'SEC("usdt") '
+}
+
+# EBPF-C Code #
+
+# Hits of processes that are not in this map are dropped when a program serves several
+# processes through a binary, see targets.Targets.
+PID_FILTER_MAP_NAME = "pid_filter"
+MAX_PIDS = 1024
+PID_FILTER_DECL = "\nBPF_HASH(" + PID_FILTER_MAP_NAME + ", u32, u8, " + str(MAX_PIDS) + ");\n"
+PID_FILTER_PRELUDE = """
+\tu32 filter_pid = bpf_get_current_pid_tgid() >> 32;
+\tif ({lookup} == NULL) return 0;
+"""
+
+# Default long string map storage: this caps the total size of the long strings of a hit at
+# ~ 67 MB.
 # NOTE that larger string sizes generate more instructions in the unrolled
 # long-string copying loop, which may result in maximum instruction size being exceeded, even though
 # there is enough space in the string map to store a string of that size.
@@ -32,35 +131,67 @@ MAX_MAP_SZ = 64
 
 LONG_STRING_BUF_NAME = "longstr_buf_{}"
 LONG_STRING_PRELUDE = """
-#define MAX_STR_SZ      {max_str_sz}
-#define MAX_MAP_SZ      {max_map_sz}
-
+#ifndef BAD_CHUNK_IDX
 #define BAD_CHUNK_IDX   """ + str(errors["BAD_CHUNK_IDX"]) + """
 #define BAD_READ_PROBE  """ + str(errors["BAD_READ_PROBE"]) + """
 #define KERNEL_FAULT    """ + str(errors["KERNEL_FAULT"]) + """
 #define LOGICAL_ERROR   """ + str(errors["LOGICAL_ERROR"]) + """
+#endif
 
-struct str_chunk {{
-\tunsigned char str[MAX_STR_SZ];
+struct {longstr_buf_name}_chunk {{
+\tunsigned char str[{max_str_sz}];
 }};
 
-// longstrs are stored here in "chunks", with up to MAX_MAP_SZ chunks per str
-// this array is treated as a ring buffer
-BPF_ARRAY({longstr_buf_name}, struct str_chunk, MAX_MAP_SZ);
-// this is the current index of the chunk ring buffer
-BPF_ARRAY({longstr_buf_name}_index, unsigned int, 1);
+// longstrs are stored here in "chunks", with up to {max_map_sz} chunks per str
+// this array is treated as a ring buffer shared by all the long strings of the probe
+BPF_ARRAY({longstr_buf_name}, struct {longstr_buf_name}_chunk, {max_map_sz});
+// this is the number of chunks ever reserved, the next free chunk is at this index modulo {max_map_sz}
+BPF_ARRAY({longstr_buf_name}_index, u64, 1);
 
 """
 
-LONG_STR_FN_NAME = "read_long_str"
+LONG_STR_FN_NAME = "{longstr_buf_name}_read"
 LONG_STR_FN_DECL = "static inline __attribute__((__always_inline__)) int " \
-    + LONG_STR_FN_NAME + "(char *str, int *idx, int sz) {\n #UNROLLED_LOOP# }\n"
+    + LONG_STR_FN_NAME + "(char *str, unsigned int index, int sz) {{\n #UNROLLED_LOOP# }}\n"
+# sizes of the long strings of a probe are counted in a log2 histogram per argument
+LONG_STRING_SZ_HIST_NAME = "{probe_name}_{arg_name}_sz_hist"
+LONG_STRING_SZ_HIST_DECL = "\nBPF_HISTOGRAM({hist_name}, int, 64);\n"
+
+# All the long strings of a hit are stored in contiguous chunks, reserved at once with an atomic
+# add on the ring index so that concurrent hits never share chunks. {arg_name}_idx first holds the
+# offset of the first chunk of a string within the reservation, then its index in the ring.
+# A hit never reserves more chunks than the ring has: a string that does not fit in the chunks
+# left by the strings before it is truncated to them.
+LONG_STR_RESERVE_INIT = "\n\tu64 longstr_chunks = 0;\n"
 LONG_STR_FN_CALL = """
 \t// get long string
 \tchar *{arg_name}_str = NULL;
 \tbpf_usdt_readarg({arg_num}, ctx, &out.{arg_name}_sz);
+\tif (out.{arg_name}_sz >= 0) {hist_increment};
 \tbpf_usdt_readarg({arg_num_inc}, ctx, &{arg_name}_str);
-\tout.{arg_name}_sz = read_long_str({arg_name}_str, &out.{arg_name}_idx, out.{arg_name}_sz);
+\tout.{arg_name}_idx = longstr_chunks;
+\tif (out.{arg_name}_sz > 0) {{
+\t\tu64 {arg_name}_chunks = {max_map_sz};
+\t\tif (out.{arg_name}_sz < {max_total_sz}) {arg_name}_chunks = (out.{arg_name}_sz + {max_str_sz} - 1) / {max_str_sz};
+\t\tif (longstr_chunks + {arg_name}_chunks > {max_map_sz}) {{
+\t\t\t{arg_name}_chunks = {max_map_sz} - longstr_chunks;
+\t\t\tout.{arg_name}_sz = {arg_name}_chunks * {max_str_sz};
+\t\t}}
+\t\tlongstr_chunks += {arg_name}_chunks;
+\t}}
+"""
+LONG_STR_RESERVE = """
+\t// reserve the chunks of all long strings at once
+\tu32 longstr_index_key = 0;
+\tu64 *longstr_index = {lookup};
+\tu64 longstr_start = 0;
+\tif (longstr_index != NULL) longstr_start = __sync_fetch_and_add(longstr_index, longstr_chunks);
+"""
+LONG_STR_COPY = """
+\t// copy long string
+\tout.{arg_name}_idx = (longstr_start + out.{arg_name}_idx) % {max_map_sz};
+\tif (longstr_index == NULL) out.{arg_name}_sz = BAD_CHUNK_IDX;
+\telse out.{arg_name}_sz = {read_fn}({arg_name}_str, out.{arg_name}_idx, out.{arg_name}_sz);
 """
 
 BPF_OUT_NAME = "out"
@@ -68,8 +199,7 @@ BPF_PERF_OUTPUT = "\nBPF_PERF_OUTPUT({});\n"
 BPF_PERF_OUTPUT_ADDR_NAME = "addr_{}_{}"
 BPF_PERF_OUTPUT_ARG_NAME = "arg_{}_{}"
 BPF_PERF_OUTPUT_STRUCT_NAME = "{}_output"
-BPF_PERF_OUTPUT_MEMBER_ASSN = "\tout.{target} = {source_struct}.{source_struct_member};\n"
-BPF_PERF_SUBMIT_STMT = "\n\t// submit all\n\t{}.perf_submit(ctx, &out, sizeof(out));\n"
+BPF_PERF_SUBMIT_STMT = "\n\t// submit all\n\t{};\n"
 
 BPF_PERF_OUTPUT_BOILERPLATE_MEMBER_DECLS ="""
 \tchar comm[TASK_COMM_LEN];
@@ -78,6 +208,8 @@ BPF_PERF_OUTPUT_BOILERPLATE_MEMBER_DECLS ="""
 \tu64 ns;
 """
 
+TASK_COMM_LEN = 16
+
 BPF_PERF_OUTPUT_BOILERPLATE ="""
 \t// get time
 \tout.ns = bpf_ktime_get_ns();
@@ -99,21 +231,23 @@ BPF_READ_STR = """\n
 \tbpf_probe_read_str(&out.{out_member}, sizeof(out.{out_member}), {addr_name});
 """
 
-BPF_READ_STRUCT_MEMBER_STR = """
-\tconst char* {str_addr_name} = {source};
-\tbpf_probe_read_str(out.{target}, sizeof(out.{target}), {str_addr_name});
+# Structs & arrays passed by pointer are read straight into the output struct, in one read each.
+# Strings & arrays embedded in them come along with that read, so they are never read again.
+BPF_READ_STRUCT = """\n
+\tconst void* {addr_name} = NULL;
+\tbpf_usdt_readarg({arg_num}, ctx, &{addr_name});
+\tbpf_probe_read(&out.{out_member}, sizeof(out.{out_member}), {addr_name});
 """
 
-BPF_READ_STRUCT = """\n
-\tstruct {probe_name}_level_0_{index} {struct_name} = {{}};
-\tconst void* addr_{index} = NULL;
-\tbpf_usdt_readarg({arg_num}, ctx, &addr_{index});
-\tbpf_probe_read(&{struct_name}, sizeof({struct_name}), addr_{index});
+# a struct member pointing to a struct is followed with one more read, once the struct holding
+# the pointer has been read
+BPF_READ_DEREF = """
+\tif (out.{pointer} != NULL) bpf_probe_read(&out.{out_member}, sizeof(out.{out_member}), out.{pointer});
 """
 
 PROBE_FN_NAME = "{}_fn"
 PROBE_ENTRY_FN = """
-int {}(struct pt_regs *ctx) {{
+{}int {}(struct pt_regs *ctx) {{
 {}
 \treturn 0;
 }}
@@ -123,16 +257,21 @@ RANDOM_SAMPLES_PRELUDE = """
 \tif (bpf_get_prandom_u32() >= {}) return 0;
 """
 
-BASE_STRUCT_NAME = "{probe_name}_level_0_{index}_base"
+# structs mirror the layout of the struct in mongod, so their packing & alignment can be given
 STRUCT_NAME = "{probe_name}_level_{depth}_{index}"
+FIELD_STRUCT_NAME = "{struct_name}_{index}"
 STRUCT = """
 struct {} {{
-{}}};\n
+{}}}{};\n
 """
+STRUCT_ATTRIBUTES = " __attribute__(({}))"
+STRUCT_PACKED = "packed"
+STRUCT_ALIGNED = "aligned({})"
 STRUCT_MEMBER = "\t{};\n"
 STRUCT_INIT = "\tstruct {} {} = {{}};\n"
-
-ARG_NAME_CAT = "_{}"
+ARRAY_DECL = "{decl}[{count}]"
+# the output struct member a dereferenced struct is read into: the path to its pointer, joined by
+DEREF_MEMBER_SEP = "__"
 
 # EBPF-C Types & Declarations #
 
@@ -146,6 +285,8 @@ POINTER_TYPE = 'ptr'
 LONG_STRING_TYPE = 'longstr'
 TYPES = [INT_TYPE, UNSIGNED_LONG_TYPE, LONG_LONG_TYPE, CHAR_TYPE, STRING_TYPE, STRUCT_TYPE, \
         POINTER_TYPE, LONG_STRING_TYPE]
+# types that can be fixed arrays (with a count): chars are strings instead
+ARRAY_TYPES = [INT_TYPE, UNSIGNED_LONG_TYPE, LONG_LONG_TYPE, POINTER_TYPE]
 
 TYPE_DECL = {
     INT_TYPE: "int {arg_name}",
@@ -153,7 +294,7 @@ TYPE_DECL = {
     LONG_LONG_TYPE: "long long {arg_name}",
     CHAR_TYPE: 'char {arg_name}',
     STRING_TYPE: "char {arg_name}[{length}]",
-    STRUCT_TYPE: "struct " + STRUCT_NAME + " {arg_name}",
+    STRUCT_TYPE: "struct {struct_name} {arg_name}",
     POINTER_TYPE: "void* {arg_name}",
     # the size & starting chunk index of a long string is stored in the output struct
     # the string itself can be retrieved from string_chunks in the BPF_ARRAY
@@ -161,75 +302,136 @@ TYPE_DECL = {
     LONG_STRING_TYPE: ["int {arg_name}_sz", "unsigned int {arg_name}_idx"]
 }
 
+# Output struct layouts #
+
+# Types that only appear in output structs, not as probe arguments
+UNSIGNED_INT_TYPE = "unsigned int"
+U32_TYPE = "u32"
+U64_TYPE = "u64"
+
+# ctypes of output struct members. A layout is a list of (member name, kind) mirroring a generated
+# struct, where a kind is either one of these types, (LAYOUT_ARRAY, kind, count) or
+# (STRUCT_TYPE, struct name, layout, packed, align).
+LAYOUT_ARRAY = "array"
+CTYPES = {
+    INT_TYPE: ct.c_int,
+    UNSIGNED_INT_TYPE: ct.c_uint,
+    UNSIGNED_LONG_TYPE: ct.c_ulong,
+    LONG_LONG_TYPE: ct.c_longlong,
+    CHAR_TYPE: ct.c_char,
+    STRING_TYPE: ct.c_char,
+    # pointers are only ever used as keys, so they are read as plain integers
+    POINTER_TYPE: ct.c_uint64,
+    U32_TYPE: ct.c_uint32,
+    U64_TYPE: ct.c_uint64
+}
+
+BPF_PERF_OUTPUT_BOILERPLATE_LAYOUT = [
+    ("comm", (LAYOUT_ARRAY, CHAR_TYPE, TASK_COMM_LEN)),
+    ("pid", U32_TYPE),
+    ("tid", U32_TYPE),
+    ("ns", U64_TYPE)
+]
+
+LONG_STRING_LAYOUT = [("{arg_name}_sz", INT_TYPE), ("{arg_name}_idx", UNSIGNED_INT_TYPE)]
+
+# Python Decoders #
+
+# Each probe also gets a Python function turning its output struct (a ctypes structure, see
+# CTYPES) into a dict of its arguments, with every member name resolved at generation time.
+# It runs with the names of PY_DECODER_GLOBALS in scope.
+PY_DECODER_NAME = "decode_{}"
+PY_DECODER_FN = """
+def {fn_name}(event, read_long_str):
+    result = {{}}
+{body}    return result
+"""
+PY_DECODER_GLOBALS = {"KEY_ERROR": errors["KEY_ERROR"]}
+PY_INDENT = "    "
+PY_DECODE_MEMBER = "{indent}{target}[{key!r}] = {source}.{member}\n"
+PY_DECODE_ARRAY = "{indent}{target}[{key!r}] = list({source}.{member})\n"
+PY_DECODE_STRUCT_INIT = "{indent}{var} = {{}}\n"
+PY_DECODE_STRUCT_ASSN = "{indent}{target}[{key!r}] = {var}\n"
+# a dereferenced struct is None if its pointer is
+PY_DECODE_DEREF_IF = "{indent}if {source}.{member}:\n"
+PY_DECODE_DEREF_ELSE = "{indent}else:\n{indent}    {target}[{key!r}] = None\n"
+PY_DECODE_LONG_STR = """{indent}sz_{index} = event.{arg_name}_sz
+{indent}idx_{index} = event.{arg_name}_idx
+{indent}result[{idx_key!r}] = idx_{index}
+{indent}if sz_{index} < 0: # a negative size indicates an error, see generator.err
+{indent}    result[{err_key!r}] = sz_{index}
+{indent}else:
+{indent}    result[{sz_key!r}] = sz_{index}
+{indent}    try:
+{indent}        result[{key!r}] = read_long_str(sz_{index}, idx_{index})
+{indent}    except KeyError:
+{indent}        result[{err_key!r}] = KEY_ERROR
+"""
+
 # Utility functions #
 
 LONGSTR_LOOP_INIT = """
-\t// get last index available in ring buffer
-\tunsigned int index = 0;
-\tunsigned int *index_ptr = NULL;
-\tindex_ptr = {longstr_buf_name}_index.lookup(&index);
-\tif (index_ptr == NULL) return BAD_CHUNK_IDX;
-
-\t// reserve the necessary number of chunks
-\tindex = *index_ptr;
-\t*idx = index; // this is going to be sent back with the output event
-\tif (index >= MAX_MAP_SZ || sz < 0) return LOGICAL_ERROR;
-\t*index_ptr = (index + sz/MAX_STR_SZ);
-\tif (sz % MAX_STR_SZ != 0) (*index_ptr)++;
-\t*index_ptr %= MAX_MAP_SZ;
+\tif (index >= {max_map_sz} || sz < 0) return LOGICAL_ERROR;
 
 \tunsigned int len = sz;
-\tstruct str_chunk* chunk;
+\tstruct {longstr_buf_name}_chunk* chunk;
 """
 
 # WARNING: may (theoretically) be able to cause a segfault
 # since this is technically reading more memory than it should
 LONGSTR_LOOP_READ = """
-\tchunk = {longstr_buf_name}.lookup(&index);
+\tchunk = {chunk_lookup};
 \tif (chunk == NULL) return BAD_CHUNK_IDX;
-\tindex = (index + 1) % MAX_MAP_SZ;
+\tindex = (index + 1) % {max_map_sz};
 
 \tif (len < 0) {{
 \t\treturn LOGICAL_ERROR;
-\t}} if (len < MAX_STR_SZ) {{
+\t}} if (len < {max_str_sz}) {{
 \t\treturn bpf_probe_read(&chunk->str, len, str) ? KERNEL_FAULT : sz;
-\t}} else if (bpf_probe_read(&chunk->str, MAX_STR_SZ, str)) return KERNEL_FAULT;
+\t}} else if (bpf_probe_read(&chunk->str, {max_str_sz}, str)) return KERNEL_FAULT;
 """
 LONGSTR_LOOP_ITER = """
-\tlen -= MAX_STR_SZ;
-\tstr += MAX_STR_SZ;
+\tlen -= {max_str_sz};
+\tstr += {max_str_sz};
 """
 LONGSTR_LOOP_END = "\n\treturn sz;\n"
 
-def generate_longstr_prelude(probe, max_map_sz, max_str_sz):
+def generate_longstr_prelude(probe, max_map_sz, max_str_sz, dialect = BCC_DIALECT):
     longstr_buf_name = LONG_STRING_BUF_NAME.format(probe)
-    prelude = LONG_STRING_PRELUDE.format(max_str_sz = max_str_sz,
-                                         max_map_sz = max_map_sz,
-                                         longstr_buf_name = longstr_buf_name)
-    read_str = LONGSTR_LOOP_READ.format(longstr_buf_name = longstr_buf_name)
+    fmt = dict(max_str_sz = max_str_sz, max_map_sz = max_map_sz, longstr_buf_name = longstr_buf_name,
+               chunk_lookup = MAP_LOOKUP[dialect].format(map=longstr_buf_name, key="&index"))
+    prelude = LONG_STRING_PRELUDE.format(**fmt)
+    read_str = LONGSTR_LOOP_READ.format(**fmt)
 
-    unrolled_loop = LONGSTR_LOOP_INIT.format(longstr_buf_name = longstr_buf_name) + read_str
+    unrolled_loop = LONGSTR_LOOP_INIT.format(**fmt) + read_str
     for index in range(1, max_map_sz):
-         unrolled_loop += LONGSTR_LOOP_ITER + read_str
+         unrolled_loop += LONGSTR_LOOP_ITER.format(**fmt) + read_str
 
-    return prelude + LONG_STR_FN_DECL.replace("#UNROLLED_LOOP#", unrolled_loop + LONGSTR_LOOP_END)
+    return prelude + LONG_STR_FN_DECL.format(**fmt).replace("#UNROLLED_LOOP#", unrolled_loop + LONGSTR_LOOP_END)
 
-def declare_single_member(fmt, arg_name, probe_name, depth, index, length):
-    return STRUCT_MEMBER.format(fmt.format(probe_name = probe_name,
-                                           arg_name = arg_name,
-                                           depth = depth,
-                                           index = index,
-                                           length = length))
+def declare_single_member(fmt, arg_name, probe_name, depth, index, length, struct_name = None, count = 0):
+    decl = fmt.format(probe_name = probe_name,
+                      arg_name = arg_name,
+                      depth = depth,
+                      index = index,
+                      length = length,
+                      struct_name = struct_name)
+    return STRUCT_MEMBER.format(ARRAY_DECL.format(decl=decl, count=count) if count > 0 else decl)
 
-def declare_member(arg_type, arg_name, probe_name, depth, index, length):
+def declare_member(arg_type, arg_name, probe_name, depth, index, length, struct_name = None, count = 0):
     assert arg_type in TYPE_DECL
     if isinstance(TYPE_DECL[arg_type], str):
-        return declare_single_member(TYPE_DECL[arg_type], arg_name, probe_name, depth, index, length)
+        return declare_single_member(TYPE_DECL[arg_type], arg_name, probe_name, depth, index, length,
+                                     struct_name, count)
     else:
         members = ""
         for member in TYPE_DECL[arg_type]:
             members += declare_single_member(member, arg_name, probe_name, depth, index, length)
         return members
 
+def struct_attributes(packed, align):
+    attributes = ([STRUCT_PACKED] if packed else []) + ([STRUCT_ALIGNED.format(align)] if align else [])
+    return STRUCT_ATTRIBUTES.format(", ".join(attributes)) if len(attributes) > 0 else ""
+
 def reduce(fn, items):
     return ''.join(map(fn, items))
@@ -12,31 +12,28 @@ class Probe:
         self.hits = probe_dict[PROBE_HIT_KEY] if PROBE_HIT_KEY in probe_dict else 0
         assert isinstance(self.hits, int)
 
-        self.has_long_str = False
-        if PROBE_ARGS_KEY in probe_dict:
-            self.args = []
-            for index, arg in enumerate(probe_dict[PROBE_ARGS_KEY]):
-                # if we have encountered a long string, we need to offset the argument count by 1
-                # since a long string is technically 2 args
-                arg_num = index + 1 if self.has_long_str else index
-        
-                self.args.append(Arg(arg, self.hits, self.name, arg_num))
-                
-                # check if we have a long string argument
-                if self.args[-1].type == LONG_STRING_TYPE:
-                    # we do not currently support storing > 1 long string in our map
-                    # TODO - ring buffer
-                    assert not self.has_long_str
-                    self.has_long_str = True
-                    self.buf_name = LONG_STRING_BUF_NAME.format(self.name)
-                    self.buf_idx_name = self.args[-1].name + "_idx"
-        else:
-            self.args = []
-
         self.max_str_sz = probe_dict[MAX_STR_SZ_KEY] if MAX_STR_SZ_KEY in probe_dict else MAX_STR_SZ
         self.max_map_sz = probe_dict[MAX_MAP_SZ_KEY] if MAX_MAP_SZ_KEY in probe_dict else MAX_MAP_SZ
 
+        self.has_long_str = False
+        self.buf_name = LONG_STRING_BUF_NAME.format(self.name)
+        self.args = []
+        long_strs = 0
+        for index, arg in enumerate(probe_dict.get(PROBE_ARGS_KEY, [])):
+            # every long string we have encountered offsets the argument count by 1
+            # since a long string is technically 2 args
+            self.args.append(Arg(arg, self.hits, self.name, index + long_strs))
+
+            # long strings share the probe's chunk ring, see LONG_STR_RESERVE
+            if self.args[-1].type == LONG_STRING_TYPE:
+                long_strs += 1
+                self.has_long_str = True
+                self.args[-1].buf_name = self.buf_name
+                self.args[-1].max_str_sz = self.max_str_sz
+                self.args[-1].max_map_sz = self.max_map_sz
+
         self.function_name = PROBE_FN_NAME.format(self.name)
+        self.decoder_name = PY_DECODER_NAME.format(self.name)
         self.output_struct_name = BPF_PERF_OUTPUT_STRUCT_NAME.format(self.name)
 
         # For random sampling, the random number generated is between 0 and 2^32-1 (unsigned).
@@ -47,27 +44,73 @@ class Probe:
             self.random_samples_enabled = True
             self.samples_threshold = int(probe_dict[SAMPLES_PROPORTION_KEY] * (2**32))
 
-    def before_output_gen(self):
-        out = generate_longstr_prelude(self.name, self.max_map_sz, self.max_str_sz) if self.has_long_str else ""
+        # generated code, by whether hits are pid filtered and dialect
+        self._sources = dict()
+
+    def source(self, pid_filter = False, dialect = BCC_DIALECT):
+        """ Returns all the code generated for this probe. """
+        key = (pid_filter, dialect)
+        if key not in self._sources:
+            self._sources[key] = self.before_output_gen(dialect) + self.bpf_perf_output_gen() \
+                + self.entry_fn_gen(pid_filter, dialect)
+        return self._sources[key]
+
+    def sources(self):
+        """ Returns the code generated so far, as [pid_filter, dialect, source] lists. """
+        return [[pid_filter, dialect, source] for (pid_filter, dialect), source in self._sources.items()]
+
+    def add_sources(self, sources):
+        """ Takes over code generated for the same probe by another Probe, see sources. """
+        for pid_filter, dialect, source in sources:
+            self._sources[(pid_filter, dialect)] = source
+
+    def decoder_gen(self):
+        """ Returns the Python source of the function decoding the output struct, see PY_DECODER_FN. """
+        body = reduce(lambda arg: arg.decoder_gen("result", PY_INDENT), self.args)
+        return PY_DECODER_FN.format(fn_name=self.decoder_name, body=body)
+
+    def output_layout(self):
+        """ Returns the (member name, kind) of every member of the output struct, in order. """
+        layout = list(BPF_PERF_OUTPUT_BOILERPLATE_LAYOUT)
+        for arg in self.args:
+            layout += arg.output_layout()
+        return layout
+
+    def before_output_gen(self, dialect = BCC_DIALECT):
+        out = generate_longstr_prelude(self.name, self.max_map_sz, self.max_str_sz, dialect) if self.has_long_str else ""
+        for arg in self.long_str_args():
+            out += LONG_STRING_SZ_HIST_DECL.format(hist_name=arg.sz_hist_name)
         return out + reduce(Arg.before_output_gen, self.args)
 
+    def long_str_args(self):
+        return [arg for arg in self.args if arg.type == LONG_STRING_TYPE]
+
     def bpf_perf_output_gen(self):
         c_prog = BPF_PERF_OUTPUT.format(self.name)
         fields = BPF_PERF_OUTPUT_BOILERPLATE_MEMBER_DECLS + reduce(Arg.get_output_struct_def, self.args)
-        c_prog += STRUCT.format(self.output_struct_name, fields)
+        c_prog += STRUCT.format(self.output_struct_name, fields, "")
         return c_prog
 
-    def entry_fn_gen(self):
-        fn_content = RANDOM_SAMPLES_PRELUDE.format(self.samples_threshold) if self.random_samples_enabled else ""
+    def entry_fn_gen(self, pid_filter = False, dialect = BCC_DIALECT):
+        lookup = MAP_LOOKUP[dialect]
+        fn_content = PID_FILTER_PRELUDE.format(lookup=lookup.format(map=PID_FILTER_MAP_NAME, key="&filter_pid")) \
+            if pid_filter else ""
+        fn_content += RANDOM_SAMPLES_PRELUDE.format(self.samples_threshold) if self.random_samples_enabled else ""
         fn_content += STRUCT_INIT.format(self.output_struct_name, BPF_OUT_NAME)
         fn_content += BPF_PERF_OUTPUT_BOILERPLATE
-        fn_content += reduce(Arg.fill_output_struct, self.args)
-        fn_content += BPF_PERF_SUBMIT_STMT.format(self.name)
-        return PROBE_ENTRY_FN.format(self.function_name, fn_content)
+        fn_content += LONG_STR_RESERVE_INIT if self.has_long_str else ""
+        fn_content += reduce(lambda arg: arg.fill_output_struct(dialect), self.args)
+        if self.has_long_str:
+            fn_content += LONG_STR_RESERVE.format(lookup=lookup.format(map=self.buf_name + "_index",
+                                                                       key="&longstr_index_key"))
+            fn_content += reduce(Arg.long_str_copy_gen, self.long_str_args())
+        fn_content += BPF_PERF_SUBMIT_STMT.format(PERF_SUBMIT[dialect].format(map=self.name, data="&out",
+                                                                              size="sizeof(out)"))
+        return PROBE_ENTRY_FN.format(PROBE_FN_SECTION[dialect], self.function_name, fn_content)
 
 class Arg:
     """ Representation of an argument to a Probe holding information about where it can be located. """
-    def __init__(self, arg_dict, num_hits, probe_name, index, depth=0):
+    def __init__(self, arg_dict, num_hits, probe_name, index, depth=0, parent_struct_name=None):
         assert isinstance(arg_dict, dict)
 
         self.type = arg_dict[ARG_TYPE_KEY]
@@ -91,35 +134,137 @@ class Arg:
             self.output_arg_name = BPF_PERF_OUTPUT_ARG_NAME.format(self.depth, self.index)
             self.output_addr_name = BPF_PERF_OUTPUT_ADDR_NAME.format(self.depth, self.index)
 
+        if self.type == LONG_STRING_TYPE:
+            self.sz_hist_name = LONG_STRING_SZ_HIST_NAME.format(probe_name = self.probe_name,
+                                                                arg_name = self.output_arg_name)
+
         if self.type == STRING_TYPE:
             self.length = arg_dict[ARG_STR_LEN_KEY]
             assert isinstance(self.length, int)
         else:
             self.length = 0
 
-        if self.type == STRUCT_TYPE:
-            self.output_struct_name = STRUCT_NAME.format(arg_name = self.output_arg_name,
-                                                         probe_name = self.probe_name,
-                                                         depth = self.depth,
-                                                         index = self.index)
+        # a fixed array of count values, read through a pointer at the top level
+        self.count = arg_dict.get(ARG_ARRAY_LEN_KEY, 0)
+        assert isinstance(self.count, int)
+        assert self.count == 0 or self.type in ARRAY_TYPES
 
-            self.fields = [Arg(val, num_hits, probe_name, child_index, depth=depth+1)
+        # a struct field that is a pointer to the struct, rather than the struct itself
+        self.deref = arg_dict.get(ARG_DEREF_KEY, False)
+        assert not self.deref or (self.type == STRUCT_TYPE and self.depth > 0)
+
+        if self.type == STRUCT_TYPE:
+            if parent_struct_name == None:
+                self.output_struct_name = STRUCT_NAME.format(probe_name = self.probe_name,
+                                                             depth = self.depth,
+                                                             index = self.index)
+            else:
+                self.output_struct_name = FIELD_STRUCT_NAME.format(struct_name = parent_struct_name,
+                                                                   index = self.index)
+            self.packed = arg_dict.get(ARG_PACKED_KEY, False)
+            self.align = arg_dict.get(ARG_ALIGN_KEY, 0)
+
+            self.fields = [Arg(val, num_hits, probe_name, child_index, depth=depth+1,
+                               parent_struct_name=self.output_struct_name)
                             for child_index, val in enumerate(arg_dict[ARG_STRUCT_FIELDS_KEY])]
 
-            for field in self.fields:
-                if field.name != None:
-                    field.output_arg_name += ARG_NAME_CAT.format(self.index)
-                    field.output_addr_name += ARG_NAME_CAT.format(self.index)
+            if self.depth == 0:
+                self._place_derefs(self.output_arg_name)
+
+    def _place_derefs(self, path):
+        """ Names the output struct member that every struct dereferenced from this one is read into,
+            given the path of this struct in the output struct. """
+        for field in self.fields:
+            if field.type != STRUCT_TYPE:
+                continue
+            field_path = path + "." + field.output_arg_name
+            if field.deref:
+                field.pointer_path = field_path
+                field.deref_member = field_path.replace(".", DEREF_MEMBER_SEP)
+                field._place_derefs(field.deref_member)
+            else:
+                field._place_derefs(field_path)
+
+    def derefs(self):
+        """ Returns the dereferenced structs of this struct, each after the struct holding its pointer. """
+        result = []
+        for field in self.fields:
+            if field.type == STRUCT_TYPE:
+                result += ([field] if field.deref else []) + field.derefs()
+        return result
 
     def get_c_decl(self):
         """ Returns the type and name of this argument in a C program.
             The name should be unique to an instance but the same across instances. """
+        if self.deref:
+            # only the pointer is part of the struct holding it
+            return declare_member(arg_type = POINTER_TYPE,
+                                  probe_name = self.probe_name,
+                                  arg_name = self.output_arg_name,
+                                  depth = self.depth,
+                                  index = self.index,
+                                  length = self.length)
         return declare_member(arg_type = self.type,
                               probe_name = self.probe_name,
                               arg_name = self.output_arg_name,
                               depth = self.depth,
                               index = self.index,
-                              length = self.length)
+                              length = self.length,
+                              struct_name = self.output_struct_name if self.type == STRUCT_TYPE else None,
+                              count = self.count)
+
+    def layout(self):
+        """ Returns the kind of this arg in a layout, see LAYOUT_ARRAY. """
+        if self.type == STRUCT_TYPE:
+            fields = [(field.output_arg_name, POINTER_TYPE if field.deref else field.layout())
+                      for field in self.fields]
+            return (STRUCT_TYPE, self.output_struct_name, fields, self.packed, self.align)
+        if self.type == STRING_TYPE:
+            return (LAYOUT_ARRAY, CHAR_TYPE, self.length)
+        if self.count > 0:
+            return (LAYOUT_ARRAY, self.type, self.count)
+        return self.type
+
+    def output_layout(self):
+        """ Returns the (member name, kind) of the output struct members this arg is responsible for. """
+        if self.type == STRUCT_TYPE:
+            return [(self.output_arg_name, self.layout())] + \
+                [(deref.deref_member, deref.layout()) for deref in self.derefs()]
+        if self.type == LONG_STRING_TYPE:
+            return [(name.format(arg_name=self.output_arg_name), member_type)
+                    for name, member_type in LONG_STRING_LAYOUT]
+        return [(self.output_arg_name, self.layout())]
+
+    def decoder_gen(self, target, indent, source = "event"):
+        """ Returns the Python statements setting this arg in the dict named target, reading it from
+            the struct named source. """
+        if self.type == STRUCT_TYPE:
+            if self.deref:
+                # the struct was read into its own output struct member
+                result = PY_DECODE_DEREF_IF.format(indent=indent, source=source, member=self.output_arg_name)
+                result += self._struct_decoder_gen(target, indent + PY_INDENT, "event." + self.deref_member)
+                return result + PY_DECODE_DEREF_ELSE.format(indent=indent, target=target, key=self.name)
+            return self._struct_decoder_gen(target, indent, source + "." + self.output_arg_name)
+
+        elif self.type == LONG_STRING_TYPE:
+            assert self.depth == 0
+            return PY_DECODE_LONG_STR.format(indent=indent,
+                                             index=self.index,
+                                             arg_name=self.output_arg_name,
+                                             key=self.name,
+                                             sz_key=self.output_arg_name + "_sz",
+                                             idx_key=self.output_arg_name + "_idx",
+                                             err_key=self.output_arg_name + "_err")
+
+        fmt = PY_DECODE_ARRAY if self.count > 0 else PY_DECODE_MEMBER
+        return fmt.format(indent=indent, target=target, key=self.name, source=source, member=self.output_arg_name)
+
+    def _struct_decoder_gen(self, target, indent, source):
+        var = self.output_struct_name
+        result = PY_DECODE_STRUCT_INIT.format(indent=indent, var=var)
+        for field in self.fields:
+            result += field.decoder_gen(var, indent, source)
+        return result + PY_DECODE_STRUCT_ASSN.format(indent=indent, target=target, key=self.name, var=var)
 
     def before_output_gen(self):
         """ Returns a string of any code that needs to be emitted before the output struct
@@ -133,7 +278,7 @@ class Arg:
         for member in self.fields:
             result += member.before_output_gen()
             members += member.get_c_decl()
-        result += STRUCT.format(self.output_struct_name, members)
+        result += STRUCT.format(self.output_struct_name, members, struct_attributes(self.packed, self.align))
 
         return result
 
@@ -142,46 +287,16 @@ class Arg:
         if self.type != STRUCT_TYPE:
             return self.get_c_decl()
 
-        return reduce(Arg.get_output_struct_def, self.fields)
+        result = self.get_c_decl()
+        for deref in self.derefs():
+            result += STRUCT_MEMBER.format(TYPE_DECL[STRUCT_TYPE].format(struct_name=deref.output_struct_name,
+                                                                      arg_name=deref.deref_member))
+        return result
 
-    def fill_output_struct(self, source_struct_name=None):
+    def fill_output_struct(self, dialect = BCC_DIALECT):
         """ Returns the code necessary to fill the members of the output struct this arg is responsible for. """
-        if source_struct_name:
-            # we should be reading our value out of a struct
-            if self.type == STRING_TYPE:
-                # Can't access C runtime (strcpy, etc) and there are no loops.
-                # Thus, to copy strings from embedded structs to the output struct, the offset within the passed
-                # in struct is determined, and then a bpf_probe_read_str is issued, reading the string from
-                # userspace once more.
-                # See https://github.com/iovisor/bcc/issues/691 for updates on string builtin functions
-                result = BPF_READ_STRUCT_MEMBER_STR.format(
-                            source = source_struct_name + "." + self.output_arg_name,
-                            target = self.output_arg_name,
-                            str_addr_name = self.output_addr_name)
-                return result
-
-            elif self.type == STRUCT_TYPE:
-                # add ourselves to the source struct name for our fields to read out of
-                result = ''
-                source_struct_name = source_struct_name + "." + self.output_arg_name
-                for arg in self.fields:
-                    result += arg.fill_output_struct(source_struct_name) + '\n'
-
-                return result
-
-            elif self.type == LONG_STRING_TYPE:
-                assert self.depth == 0
-                return LONG_STR_FN_CALL.format(arg_name=self.output_arg_name,
-                                               arg_num = self.index + 1,
-                                               arg_num_inc = self.index + 2)
-
-            return BPF_PERF_OUTPUT_MEMBER_ASSN.format(
-                        target=self.output_arg_name,
-                        source_struct=source_struct_name,
-                        source_struct_member=self.output_arg_name)
-
-        elif self.type == STRING_TYPE:
-            assert self.depth == 0
+        assert self.depth == 0
+        if self.type == STRING_TYPE:
             # read the addr out of the USDT arg and read the C-string into our output struct
             return BPF_READ_STR.format(
                         probe_name=self.probe_name,
@@ -189,33 +304,50 @@ class Arg:
                         addr_name=self.output_addr_name,
                         out_member=self.output_arg_name)
 
-        elif self.type == STRUCT_TYPE:
-            assert self.depth == 0
-            # read in the struct from the USDT arg pointer
-            struct_name = BASE_STRUCT_NAME.format(probe_name=self.probe_name, index=self.index)
-            result = BPF_READ_STRUCT.format(probe_name=self.probe_name,
-                                            index=self.index,
-                                            struct_name=struct_name,
-                                            arg_num=self.index + 1)
-
-            for arg in self.fields:
-                result += arg.fill_output_struct(struct_name) + '\n'
+        elif self.type == STRUCT_TYPE or self.count > 0:
+            # read in the struct (or array) from the USDT arg pointer, then follow its pointers
+            result = BPF_READ_STRUCT.format(addr_name=BPF_PERF_OUTPUT_ADDR_NAME.format(self.depth, self.index),
+                                            arg_num=self.index + 1,
+                                            out_member=self.output_arg_name)
+            for deref in (self.derefs() if self.type == STRUCT_TYPE else []):
+                result += BPF_READ_DEREF.format(pointer=deref.pointer_path, out_member=deref.deref_member)
             return result
 
         elif self.type == LONG_STRING_TYPE:
-            assert self.depth == 0
-            return LONG_STR_FN_CALL.format(arg_name=self.output_arg_name,
-                                           arg_num = self.index + 1,
-                                           arg_num_inc = self.index + 2)
+            return self.long_str_fn_call_gen(dialect)
 
         else:
             # read the argument directly
             return BPF_READ_ARG.format(num=self.index + 1, output_member_name=self.output_arg_name)
 
+    def long_str_fn_call_gen(self, dialect = BCC_DIALECT):
+        """ Returns the code reading the size & address of this long string, and counting its chunks. """
+        slot = "bpf_log2l(out.{}_sz)".format(self.output_arg_name)
+        return LONG_STR_FN_CALL.format(arg_name=self.output_arg_name,
+                                       hist_increment = HIST_INCREMENT[dialect].format(hist=self.sz_hist_name,
+                                                                                      slot=slot),
+                                       arg_num = self.index + 1,
+                                       arg_num_inc = self.index + 2,
+                                       max_str_sz = self.max_str_sz,
+                                       max_map_sz = self.max_map_sz,
+                                       max_total_sz = self.max_str_sz * self.max_map_sz)
+
+    def long_str_copy_gen(self):
+        """ Returns the code copying this long string into its reserved chunks. """
+        return LONG_STR_COPY.format(arg_name=self.output_arg_name,
+                                    max_map_sz = self.max_map_sz,
+                                    read_fn = LONG_STR_FN_NAME.format(longstr_buf_name=self.buf_name))
+
 class Generator:
     """ Responsible for orchestrating the generation of code for each probe that gets added to it. """
-    def __init__(self):
-        self.c_prog = HEADERS
+    def __init__(self, pid_filter = False, dialect = BCC_DIALECT):
+        assert dialect in DIALECTS
+        self.c_prog = HEADERS[dialect]
+        self.dialect = dialect
+        # only emit hits of the pids in the pid filter map
+        self.pid_filter = pid_filter
+        if pid_filter:
+            self.c_prog += PID_FILTER_DECL
 
     def finish(self):
         """ Do any clean up work and then provide the generated C program. """
@@ -225,6 +357,4 @@ class Generator:
         """ Add a probe and generate code to attach that probe to its own output channel and function. """
         assert isinstance(probe, Probe)
 
-        self.c_prog += probe.before_output_gen()
-        self.c_prog += probe.bpf_perf_output_gen()
-        self.c_prog += probe.entry_fn_gen()
+        self.c_prog += probe.source(self.pid_filter, self.dialect)
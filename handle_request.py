@@ -1,17 +1,72 @@
 #!/usr/bin/python3
-import sys
-import os
-from bcc import BPF, USDT
+import argparse
+from bcc import BPF
 import ctypes as ct
-
-pid = int(sys.argv[1])
-text = """
+from generator.consts import MAX_PIDS
+from sink import add_output_args, open_sink
+from targets import add_target_args, open_targets
+
+parser = argparse.ArgumentParser(description="Print information about every request handled. " +
+    "If any of the filters are given, only requests matching at least one of them are printed.")
+add_target_args(parser)
+parser.add_argument('--slow-ms',
+                    metavar='ms',
+                    type=int,
+                    default=-1,
+                    help='report requests that took at least this many ms (excluding pauses)')
+parser.add_argument('--used-disk',
+                    action='store_true',
+                    help='report requests that used disk')
+parser.add_argument('--has-sort',
+                    action='store_true',
+                    help='report requests with an in-memory sort stage')
+add_output_args(parser)
+args = parser.parse_args()
+targets = open_targets(parser, args)
+sink = open_sink(args)
+
+# requests are filtered in end_request, before anything is copied out of mongod or submitted
+filters = """
+#define SLOW_MS {slow_ms}
+#define FILTER_USED_DISK {used_disk}
+#define FILTER_HAS_SORT {has_sort}
+#define FILTER_ENABLED (SLOW_MS >= 0 || FILTER_USED_DISK || FILTER_HAS_SORT)
+#define PID_FILTERED {pid_filtered}
+#define MAX_PIDS {max_pids}
+""".format(slow_ms=args.slow_ms, used_disk=int(args.used_disk), has_sort=int(args.has_sort),
+           pid_filtered=int(targets.filtered), max_pids=MAX_PIDS)
+
+text = filters + """
 #include <linux/ptrace.h>
 
+#define REQUESTS_REPORTED 0
+#define REQUESTS_FILTERED 1
+
+#define COMMAND_NAME_LEN 64
+
+struct command_name_t {
+    char name[COMMAND_NAME_LEN];
+};
+
 BPF_PERF_OUTPUT(debug_info);
 BPF_HASH(request, void*);
+// name of the command run by an opCtx, joined into its debug_out in end_request
+BPF_HASH(command_names, void*, struct command_name_t);
+BPF_ARRAY(request_counts, u64, 2);
+
+// see targets.Targets
+#if PID_FILTERED
+BPF_HASH(pid_filter, u32, u8, MAX_PIDS);
+#define FILTER_PID() do { \
+    u32 filter_pid = bpf_get_current_pid_tgid() >> 32; \
+    if (!pid_filter.lookup(&filter_pid)) return 0; \
+} while (0)
+#else
+#define FILTER_PID() do {} while (0)
+#endif
 
 int start_request(struct pt_regs *ctx) {
+    FILTER_PID();
     u64 ktime = bpf_ktime_get_ns();
     void* opCtx = NULL;
     bpf_usdt_readarg(1, ctx, &opCtx);
@@ -35,17 +90,44 @@ struct debug_out {
     bool hasPlanCacheKey;
     char planSummary[100];
     u64 totalElapsedNs;
+    char command_name[COMMAND_NAME_LEN];
 };
 
 int end_request(struct pt_regs *ctx) {
+    FILTER_PID();
     u64 ktime = bpf_ktime_get_ns();
     u64* old_ktime = NULL;
     void* opCtx = NULL;
     bpf_usdt_readarg(1, ctx, &opCtx);
+    struct command_name_t *command_name = NULL;
     if(opCtx) {
         old_ktime = request.lookup(&opCtx);
+        command_name = command_names.lookup(&opCtx);
     }
     struct debug_out out = {}; 
+    if(command_name) {
+        __builtin_memcpy(out.command_name, command_name->name, sizeof(out.command_name));
+        command_names.delete(&opCtx);
+    }
+    bpf_usdt_readarg(7, ctx, &out.elapsedMsExcludingPauses);
+    bpf_usdt_readarg(8, ctx, &out.usedDisk);
+    bpf_usdt_readarg(9, ctx, &out.hasSortStage);
+    if(old_ktime) {
+        out.totalElapsedNs = ktime - *old_ktime;
+        request.delete(&opCtx);
+    } else {
+        out.totalElapsedNs = 0;
+    }
+#if FILTER_ENABLED
+    if (!((SLOW_MS >= 0 && out.elapsedMsExcludingPauses >= SLOW_MS)
+          || (FILTER_USED_DISK && out.usedDisk)
+          || (FILTER_HAS_SORT && out.hasSortStage))) {
+        request_counts.increment(REQUESTS_FILTERED);
+        return 0;
+    }
+#endif
+    request_counts.increment(REQUESTS_REPORTED);
+
     bpf_usdt_readarg(1, ctx, &out.opCtx);
     bpf_usdt_readarg(2, ctx, &out.isCommand);
     bpf_usdt_readarg(3, ctx, &out.networkOp);
@@ -60,9 +142,6 @@ int end_request(struct pt_regs *ctx) {
         out.namespace[0] = 0;
     }
     bpf_usdt_readarg(6, ctx, &out.error_code);
-    bpf_usdt_readarg(7, ctx, &out.elapsedMsExcludingPauses);
-    bpf_usdt_readarg(8, ctx, &out.usedDisk);
-    bpf_usdt_readarg(9, ctx, &out.hasSortStage);
     bpf_usdt_readarg(10, ctx, &out.upsert);
     bpf_usdt_readarg(11, ctx, &out.hasPlanCacheKey);
     const char* planSummaryAddr = NULL;
@@ -72,29 +151,20 @@ int end_request(struct pt_regs *ctx) {
     } else {
         out.planSummary[0] = 0;
     }
-    if(old_ktime) {
-        out.totalElapsedNs = ktime - *old_ktime;
-    } else {
-        out.totalElapsedNs = 0;
-    }
     debug_info.perf_submit(ctx, &out, sizeof(out));
     return 0;
 }
 
-BPF_PERF_OUTPUT(command_op_map);
-
-struct command_op {
-    char command_name[64];
-    void* opCtx;
-};
-
 int start_command(struct pt_regs *ctx) {
-    struct command_op out = {};
+    FILTER_PID();
+    void* opCtx = NULL;
+    bpf_usdt_readarg(4, ctx, &opCtx);
+    if(!opCtx) return 0;
+    struct command_name_t command_name = {};
     const char* addr = NULL;
     bpf_usdt_readarg(2, ctx, &addr);
-    bpf_probe_read_str(out.command_name, sizeof(out.command_name), addr);
-    bpf_usdt_readarg(4, ctx, &out.opCtx);
-    command_op_map.perf_submit(ctx, &out, sizeof(out));
+    bpf_probe_read_str(command_name.name, sizeof(command_name.name), addr);
+    command_names.update(&opCtx, &command_name);
     return 0;
 }
 """
@@ -113,60 +183,73 @@ class DebugOut(ct.Structure):
         ('upsert', ct.c_bool),
         ('hasPlanCacheKey', ct.c_bool),
         ('planSummary', ct.c_char * 100),
-        ('totalElapsedNs', ct.c_uint64)
+        ('totalElapsedNs', ct.c_uint64),
+        ('command_name', ct.c_char * 64)
             ]
 
-    op_cmd_name = dict()
+    def name(self):
+        # the command name is only set for requests that ran a command
+        return str(self.command_name or self.networkOpStr, 'utf-8', 'replace')
+
+    def to_dict(self):
+        record = dict()
+        for name, _ in DebugOut._fields_:
+            value = getattr(self, name)
+            record[name] = str(value, 'utf-8', 'replace') if isinstance(value, bytes) else value
+        record['command'] = self.name()
+        return record
 
     def __str__(self):
-        # look within dict for optional name instad of networkOpStr
         res = "{}:\n" \
-              "--------------------------\n".format(
-                      DebugOut.op_cmd_name.get(
-                          self.opCtx, str(self.networkOpStr, 'utf-8')
-                          )
-                      )
+              "--------------------------\n".format(self.name())
         for name, _ in DebugOut._fields_:
-            if name not in ('networkOpStr', 'opCtx'):
+            if name not in ('networkOpStr', 'opCtx', 'command_name'):
                 res += '\t{}: {}'.format(name, getattr(self, name))
         return res
 
-handle_request_start = USDT(pid=pid)
+handle_request_start = targets.usdt()
 handle_request_start.enable_probe('handleRequestStart', 'start_request')
 
-handle_request_end = USDT(pid=pid)
+handle_request_end = targets.usdt()
 handle_request_end.enable_probe('handleRequestEnd', 'end_request')
 
-start_command = USDT(pid=pid)
+start_command = targets.usdt()
 start_command.enable_probe('commandStart', 'start_command')
 
 b = BPF(text=text, usdt_contexts=[handle_request_start, handle_request_end, start_command])
+if targets.filtered:
+    targets.fill_filter(b)
 
 def print_info(cpu, data, size):
     assert size >= ct.sizeof(DebugOut)
     ct_cast =ct.cast(data, ct.POINTER(DebugOut))
     event = ct_cast.contents
-    print(event)
-
-def add_command_name(cpu, data, size):
-    event = b['command_op_map'].event(data)
-    DebugOut.op_cmd_name[event.opCtx] = str(event.command_name, 'utf-8')
+    if sink != None:
+        # the event is only valid for the duration of this callback, so copy it out
+        sink.write(event.to_dict())
+    else:
+        print(event)
 
 b['debug_info'].open_perf_buffer(print_info)
-b['command_op_map'].open_perf_buffer(add_command_name)
 
 print("listening")
 
-def is_alive(pid):
+while targets.alive:
     try:
-        os.kill(pid, 0)
-        return True
-    except ProcessLookupError:
-        return False
-
-while is_alive(pid):
-    try:
-        b.perf_buffer_poll(timeout=1000)
+        b.perf_buffer_poll(timeout=100)
+        exited, started = targets.poll()
+        if targets.filtered and len(exited) + len(started) > 0:
+            targets.update_filter(b, exited, started)
+        if len(exited) > 0 and sink != None:
+            sink.flush()
     except KeyboardInterrupt:
         print("exiting")
-        exit()
+        break
+
+counts = b['request_counts']
+reported = counts[counts.Key(0)].value
+filtered = counts[counts.Key(1)].value
+print("{} requests reported, {} filtered out".format(reported, filtered))
+
+if sink != None:
+    sink.close()
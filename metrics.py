@@ -0,0 +1,212 @@
+#!/bin/python3
+
+import json
+import os
+import socketserver
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import time
+
+from util import log2_bucket_bounds
+
+# Serves the state of running collectors (anything with a snapshot() like probes.TimeTable) to
+# scrapers, over localhost HTTP or a Unix socket:
+# - /metrics in the Prometheus text format
+# - /json as JSON
+# Snapshots are taken and serialized by the server threads, never on the event path, and are
+# cached for a short TTL so that frequent scrapes do not contend with ingestion for the table locks.
+
+#####################################################################################
+
+DEFAULT_ADDRESS = "localhost:9464"
+DEFAULT_TTL = 1
+UNIX_PREFIX = "unix:"
+PREFIX = "mongo_ebpf_"
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+JSON_CONTENT_TYPE = "application/json"
+
+# Serialization #
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(labels):
+    return "{" + ",".join('{}="{}"'.format(k, _label_value(v)) for k, v in labels.items()) + "}"
+
+class _Family:
+    def __init__(self, name, kind, help):
+        self.name = PREFIX + name
+        self.kind = kind
+        self.help = help
+        self.samples = []
+
+    def add(self, labels, value, suffix = ""):
+        self.samples.append("{}{}{} {}\n".format(self.name, suffix, _labels(labels), value))
+
+    def __str__(self):
+        if len(self.samples) == 0:
+            return ""
+        return "# HELP {} {}\n# TYPE {} {}\n".format(self.name, self.help, self.name, self.kind) + \
+            "".join(self.samples)
+
+def _add_histogram(family, labels, buckets):
+    seen = 0
+    total = 0
+    for slot in sorted(buckets):
+        low, high = log2_bucket_bounds(slot)
+        seen += buckets[slot]
+        # the kernel only counts hits per slot, so the sum is estimated from the slot midpoints
+        total += buckets[slot] * (max(low, 0) + high) / 2
+        family.add(dict(labels, le=high), seen, "_bucket")
+    family.add(dict(labels, le="+Inf"), seen, "_bucket")
+    family.add(labels, total, "_sum")
+    family.add(labels, seen, "_count")
+
+def to_prometheus(snapshots):
+    """ Renders {source: TimeTable.snapshot()} in the Prometheus text format. """
+    hits = _Family("hits_total", "counter", "Probe hits received.")
+    lost = _Family("lost_total", "counter", "Probe hits lost by the perf buffers.")
+    samples = _Family("interevent_samples_total", "counter", "Intervals measured between hits of a thread.")
+    interevent = _Family("interevent_seconds_total", "counter", "Total time between hits of a thread.")
+    values = _Family("values_total", "counter", "Hits per value of a hit field.")
+    histograms = _Family("histogram", "histogram",
+                         "Log2 histograms kept by the collector, with sums estimated from the buckets.")
+
+    for source, snapshot in snapshots.items():
+        for name, counter in snapshot["counters"].items():
+            for value, count in counter["props"].items():
+                values.add({"source": source, "field": name, "value": value}, count)
+        for name, buckets in snapshot.get("histograms", {}).items():
+            _add_histogram(histograms, {"source": source, "name": name}, buckets)
+        for probe, history in snapshot["probes"].items():
+            labels = {"source": source, "probe": probe}
+            hits.add(labels, history["hits"])
+            lost.add(labels, history["lost"])
+            samples.add(labels, history["timer"]["count"])
+            interevent.add(labels, history["timer"]["total_interevent_time"])
+            for name, buckets in history.get("histograms", {}).items():
+                _add_histogram(histograms, dict(labels, name=name), buckets)
+
+    return "".join(str(family) for family in [hits, lost, samples, interevent, values, histograms])
+
+def _json_key(value):
+    return value if isinstance(value, str) else str(value)
+
+def _jsonable(value):
+    # counters are keyed by ints/bytes, which JSON objects can't hold
+    if isinstance(value, dict):
+        return {_json_key(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    return value
+
+def to_json(snapshots):
+    return json.dumps(_jsonable(snapshots))
+
+# Server #
+
+class _CachedSnapshot:
+    """ Renders the snapshots of all sources at most once per TTL. """
+    def __init__(self, sources, ttl):
+        self._sources = sources
+        self._ttl = ttl
+        self._lock = Lock()
+        self._taken = 0
+        self._snapshots = None
+        self._rendered = dict()
+
+    def get(self, render):
+        with self._lock:
+            now = time()
+            if self._snapshots == None or now - self._taken >= self._ttl:
+                self._snapshots = {name: source.snapshot() for name, source in self._sources.items()}
+                self._taken = now
+                self._rendered = dict()
+            if render not in self._rendered:
+                self._rendered[render] = render(self._snapshots).encode("utf-8")
+            return self._rendered[render]
+
+class _Handler(BaseHTTPRequestHandler):
+    ROUTES = {
+        "/metrics": (to_prometheus, PROMETHEUS_CONTENT_TYPE),
+        "/json": (to_json, JSON_CONTENT_TYPE)
+    }
+
+    def do_GET(self):
+        route = self.ROUTES.get(self.path.split("?", 1)[0])
+        if route == None:
+            self.send_error(404)
+            return
+        render, content_type = route
+        body = self.server.cache.get(render)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes would flood the terminal of the collector
+        pass
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return str(self.client_address)
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+
+class MetricsServer:
+    """ Serves {name: source} where every source has a snapshot(), see the top of this file.
+        address is "host:port" for HTTP or "unix:/path" for a Unix socket. """
+    def __init__(self, sources, address = DEFAULT_ADDRESS, ttl = DEFAULT_TTL):
+        self.address = address
+        if address.startswith(UNIX_PREFIX):
+            self._server = _UnixHTTPServer(address[len(UNIX_PREFIX):], _Handler)
+        else:
+            host, port = address.rsplit(":", 1)
+            self._server = ThreadingHTTPServer((host, int(port)), _Handler)
+            self._server.daemon_threads = True
+        self._server.cache = _CachedSnapshot(sources, ttl)
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        if self.address.startswith(UNIX_PREFIX):
+            try:
+                os.unlink(self.address[len(UNIX_PREFIX):])
+            except OSError:
+                pass
+
+def add_metrics_args(parser):
+    parser.add_argument('--listen',
+                        metavar='address',
+                        type=str,
+                        default=None,
+                        help='serve metrics on this "host:port" or "unix:/path" (Prometheus text at ' +
+                             '/metrics, JSON at /json)')
+    parser.add_argument('--metrics-ttl',
+                        metavar='seconds',
+                        type=float,
+                        default=DEFAULT_TTL,
+                        help='how long a metrics snapshot is reused for')
+
+def open_metrics(args, sources):
+    """ Returns the started MetricsServer requested on the command line, or None. """
+    if args.listen == None:
+        return None
+    server = MetricsServer(sources, args.listen, args.metrics_ttl)
+    server.start()
+    return server
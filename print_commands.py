@@ -1,10 +1,16 @@
 #!/usr/bin/python3
 from bcc import BPF, USDT
-import sys
+import argparse
+from sink import add_output_args, open_sink
 
-if len(sys.argv) < 2:
-    print("Need to pass along pid")
-    exit()
+parser = argparse.ArgumentParser(description="Print every command and how long it took to complete.")
+parser.add_argument('pid',
+                    metavar='pid',
+                    type=int,
+                    help='pid of process emitting probes')
+add_output_args(parser)
+args = parser.parse_args()
+sink = open_sink(args)
 
 text = """
 #include <linux/ptrace.h>
@@ -44,10 +50,9 @@ int end_command(struct pt_regs *ctx) {
 }
 """
 print(text)
-pid = sys.argv[1]
+pid = args.pid
 
-print(int(pid))
-pid = int(pid)
+print(pid)
 time_start = USDT(pid=pid)
 time_start.enable_probe(probe="commandStart", fn_name="start_command")
 time_end = USDT(pid=pid)
@@ -58,7 +63,10 @@ b = BPF(text=text, usdt_contexts=[time_start, time_end])
 def print_command(cpu, data, size):
     event = b["timings"].event(data)
     name = str(event.buf, 'utf-8')
-    print('{}\t{}'.format(name, event.delta))
+    if sink != None:
+        sink.write({"command": name, "ns": event.delta})
+    else:
+        print('{}\t{}'.format(name, event.delta))
 
 b["timings"].open_perf_buffer(print_command)
 print("Commands and length of completion in ns:")
@@ -66,4 +74,6 @@ while 1:
     try:
         b.perf_buffer_poll()
     except KeyboardInterrupt:
+        if sink != None:
+            sink.close()
         exit()
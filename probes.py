@@ -2,21 +2,33 @@
 
 import ctypes as ct
 
-from bcc import BPF, USDT
 from math import ceil
 from threading import RLock
 from time import sleep
 
+from catalog import load_catalog
+from core import CoreBPF
 from generator.generator import Generator, Probe
 from generator.consts import *
 from generator.err import *
 from table import *
-from util import WorkerThread, Counter, Timer
+from targets import Targets
+from util import WorkerThread, Counter, Log2Histogram, Timer
 
 #####################################################################################
 
 # Probes & Probe History Tracking #
 
+# Fields that can take unboundedly many values (thousands of connection threads) are counted by
+# Counters bounded to this many heavy hitters, see util.Counter.
+COUNTER_CAPACITY = 64
+HIGH_CARDINALITY_FIELDS = ["comm", "pid", "tid"]
+# Fields counted in log2 histograms instead, see util.Log2Histogram.
+HISTOGRAM_FIELDS = ["size"]
+
+def new_counter(field, capacity = COUNTER_CAPACITY):
+    return Counter(capacity if field in HIGH_CARDINALITY_FIELDS else None)
+
 class ProbeHit:
     def __init__(self, name, comm, pid, tid, ns, cpu, size):
         self.name = name
@@ -30,12 +42,12 @@ class ProbeHit:
         self.fields = ["comm", "pid", "tid", "ns", "cpu", "size"]
         self.args = dict()
 
-    def update_counters(self, counters):
+    def update_counters(self, counters, capacity = COUNTER_CAPACITY):
         for field in self.fields:
-            if field == "ns":
+            if field == "ns" or field in HISTOGRAM_FIELDS:
                 continue
             if field not in counters:
-                counters[field] = Counter()
+                counters[field] = new_counter(field, capacity)
             counters[field].encounter(getattr(self, field))
 
     def __str__(self):#prettyprint(self):
@@ -49,11 +61,21 @@ class ProbeHit:
     def row_str(self):
         return " | ".join(str(getattr(self, field)) for field in self.fields)
 
+    def to_dict(self):
+        record = {"probe": self.name}
+        for field in self.fields:
+            record[field] = getattr(self, field)
+        # copy, since callbacks may rewrite args after the record has been queued
+        record["args"] = dict(self.args)
+        return record
+
 class ProbeHistory:
-    def __init__(self):
+    def __init__(self, counter_capacity = COUNTER_CAPACITY):
+        self.counter_capacity = counter_capacity
         self.hits = []
         self.hits_lookup = dict()
         self.counters = dict()
+        self.histograms = {field: Log2Histogram() for field in HISTOGRAM_FIELDS}
         self.timer = Timer()
         self.lost = 0
 
@@ -66,7 +88,21 @@ class ProbeHistory:
             hit.prev = None
         self.hits.append(hit)
         self.hits_lookup[key] = hit
-        hit.update_counters(self.counters)
+        hit.update_counters(self.counters, self.counter_capacity)
+        for field in HISTOGRAM_FIELDS:
+            self.histograms[field].add(getattr(hit, field))
+
+    def snapshot(self):
+        return {"hits": len(self.hits),
+                "lost": self.lost,
+                "timer": self.timer.snapshot(),
+                "counters": {name: counter.snapshot() for name, counter in self.counters.items()},
+                "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()}}
+
+    def detach(self, pid):
+        """ Forget the last hits of a process, so no intervals are measured across its restart. """
+        for key in [key for key, hit in self.hits_lookup.items() if hit.pid == pid]:
+            del self.hits_lookup[key]
 
     def last_hit(self, key):
         return self.hits_lookup.get(key)
@@ -82,16 +118,16 @@ class ProbeHistory:
             last = last.prev
         return all_hits
 
+    def snapshot_str(snapshot):
+        """ Formats a snapshot() like str() formats the history, without holding any lock. """
+        out = str(Timer.from_snapshot(snapshot["timer"]))
+        return out + TimeTable.snapshot_str(snapshot)
+
     def __str__(self):
-        out = str(self.timer)
-        for key in self.counters:
-            counter = self.counters[key]
-            out += "{}: {}".format(key, str(counter))
-        out += "lost: {}".format(self.lost)
-        return out
+        return ProbeHistory.snapshot_str(self.snapshot())
 
 class TimeTable:
-    def __init__(self, view):
+    def __init__(self, view, counter_capacity = COUNTER_CAPACITY):
         # multiple threads often modify a single timetable
         self.lock = RLock()
 
@@ -99,20 +135,24 @@ class TimeTable:
         self.global_history = SortedTable("tid", "ns") # tid dictionary
         self.on_add = self._callback_gen(view)
         self.lost = 0
+        # optional sink.Sink that every hit is recorded to
+        self.sink = None
+        # changes on every hit, see snapshot()
+        self.version = 0
 
         # generate additional stats counters
+        self.counter_capacity = counter_capacity
         self.counters = dict();
         self.counters["probe"] = Counter()
-        self.counters["size"] = Counter()
+        # hit sizes, and the sizes of long string args (named "<probe>.<arg>_sz") as counted in the kernel
+        self.histograms = dict()
+        self.histograms["size"] = Log2Histogram()
 
     def _callback_gen(self, view):
         def _on_add(probe, hit):
-            with self.lock:
-                if view != None:
-                    view.on_probe_hit("{} | {}\n".format(probe, hit.row_str()),
-                                      str(self),
-                                      probe,
-                                      str(self.get(probe)))
+            # called under self.lock for every hit: the view only gets the hit, any formatting is up to it
+            if view != None:
+                view.on_probe_hit(probe, hit)
         return _on_add
 
     def add(self, probe, hit):
@@ -121,24 +161,60 @@ class TimeTable:
                 # TODO: this may not report correct time due to potentially out of order events
                 self.times[probe].append(hit)
             else:
-                ph = ProbeHistory()
+                ph = ProbeHistory(self.counter_capacity)
                 ph.append(hit)
                 self.times[probe] = ph
 
             # update counters
             self.counters["probe"].encounter(probe)
-            self.counters["size"].encounter(hit.size)
-            hit.update_counters(self.counters)
+            self.histograms["size"].add(hit.size)
+            hit.update_counters(self.counters, self.counter_capacity)
 
             self.global_history.add(hit)
+            self.version += 1
+
+            if self.sink != None:
+                self.sink.write(hit.to_dict())
 
             # callback
             self.on_add(probe, hit)
 
+    def detach(self, pid):
+        """ Called once a traced process exited: drops its in-flight state and flushes the sink. """
+        with self.lock:
+            for history in self.times.values():
+                history.detach(pid)
+            if self.sink != None:
+                self.sink.flush()
+
     def add_lost(self, probe, lost):
         with self.lock:
             self.times[probe].add_lost(lost)
             self.lost += lost
+            self.version += 1
+
+    def snapshot(self, probes = None):
+        """ Returns a copy of the counters and timers as plain data, so that they can be rendered
+            or serialized without holding the lock. Compare its version to skip unchanged tables.
+            probes limits the probe histories copied. """
+        with self.lock:
+            return {"version": self.version,
+                    "lost": self.lost,
+                    "counters": {name: counter.snapshot() for name, counter in self.counters.items()},
+                    "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+                    "probes": {probe: history.snapshot() for probe, history in self.times.items()
+                               if probes == None or probe in probes}}
+
+    def merge_histogram(self, name, histogram):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Log2Histogram()
+            self.histograms[name].merge(histogram)
+            self.version += 1
+
+    def close(self):
+        """ Stop any background work, called once no more hits will be added. """
+        pass
 
     def has(self, probe):
         with self.lock:
@@ -148,14 +224,19 @@ class TimeTable:
         with self.lock:
             return self.times[probe]
 
-    def __str__(self):
+    def snapshot_str(snapshot):
+        """ Formats a snapshot() like str() formats the table, without holding any lock. """
         out = ""
-        for key in self.counters:
-            counter = self.counters[key]
-            out += "{}: {}".format(key, str(counter))
-        out += "lost: {}".format(self.lost)
+        for key, counter in snapshot["counters"].items():
+            out += "{}: {}".format(key, str(Counter.from_snapshot(counter)))
+        for key, buckets in snapshot["histograms"].items():
+            out += "{}: {}".format(key, str(Log2Histogram(buckets)))
+        out += "lost: {}".format(snapshot["lost"])
         return out
 
+    def __str__(self):
+        return TimeTable.snapshot_str(self.snapshot(probes=[]))
+
 # USDT Thread #
 
 class USDTArg:
@@ -168,24 +249,77 @@ class USDTArg:
         return "{} {};\n".format(self.c_type, self.name)
 
 class USDTThread(WorkerThread):
-    def __init__(self, pid, probes, time_table):
+    """ Polls the hits of probes in one or more processes, see targets.Targets.
+        targets may be a Targets, a pid or a list of pids. With verify_decoders, every event is also
+        decoded by args_2_dict, and mismatches with the generated decoder are reported to log. With obj_path,
+        the probes are loaded from an object built ahead of time by core.py instead of compiled by bcc. """
+    def __init__(self, targets, probes, time_table, verify_decoders = False, obj_path = None, log = print):
         WorkerThread.__init__(self, target=lambda: self._bpf.perf_buffer_poll(100), on_die=lambda: self._bpf.cleanup())
-        self._pid = pid
-        self._probes = [Probe(probe) for probe in probes]
-        self._generator = Generator()
+        self._targets = targets if isinstance(targets, Targets) else Targets(targets)
+        # probes of the catalog come with their code already generated
+        catalog = load_catalog()
+        self._probes = [catalog.probe(probe) for probe in probes]
+        self._event_types = {probe.name: ct.POINTER(catalog.event_type(probe)) for probe in self._probes}
+        self._decoders = {probe.name: catalog.decoder(probe) for probe in self._probes}
+        self.verify_decoders = verify_decoders
+        self.decoder_mismatches = 0
+        self.log = log
+        self.obj_path = obj_path
+        self._generator = Generator(pid_filter=self._targets.filtered)
         self._lost = dict()
         self.time_table = time_table
         self._init_bpf()
-        WorkerThread.__init__(self, target=self._work_gen())
+        WorkerThread.__init__(self, target=self._work_gen(), on_die=self._on_die)
+
+    def _on_die(self):
+        # the kernel histograms go away with the program
+        try:
+            self.collect_size_histograms()
+        finally:
+            self._bpf.cleanup()
+
+    def size_histograms(self, reset = False):
+        """ Returns {"<probe>.<arg>_sz": Log2Histogram} of the long string sizes counted in the kernel. """
+        histograms = dict()
+        for probe in self._probes:
+            for arg in probe.long_str_args():
+                table = self._bpf[arg.sz_hist_name]
+                histogram = Log2Histogram()
+                histogram.add_table(table)
+                if reset:
+                    table.clear()
+                histograms["{}.{}_sz".format(probe.name, arg.output_arg_name)] = histogram
+        return histograms
+
+    def collect_size_histograms(self):
+        """ Merges the long string size histograms into the time table, and resets them. """
+        for name, histogram in self.size_histograms(reset=True).items():
+            self.time_table.merge_histogram(name, histogram)
 
     def _work_gen(self):
         def work():
             self._bpf.perf_buffer_poll(100)
+            self._watch()
         return work
 
+    def _watch(self):
+        exited, started = self._targets.poll()
+        for pid in exited:
+            self.time_table.detach(pid)
+        if self._targets.filtered and len(exited) + len(started) > 0:
+            # the program stays attached to the binary, only the filter changes
+            self._targets.update_filter(self._bpf, exited, started)
+        if not self._targets.alive:
+            self.should_work = False
+
     def _callback_gen(self, probe):
+        event_type = self._event_types[probe.name]
+        decode = self._decoders[probe.name]
+        def read_long_str(sz, start_chunk_idx):
+            return self.read_long_str(sz, probe, start_chunk_idx)
+
         def process_callback(cpu, data, size):
-            event = self._bpf[probe.name].event(data)
+            event = ct.cast(data, event_type).contents
 
             # gather generic probe data
             hit = ProbeHit(name = probe.name,
@@ -195,29 +329,34 @@ class USDTThread(WorkerThread):
                            ns = event.ns,
                            cpu = cpu,
                            size = size)
-            start_chunk_idx = getattr(event, probe.buf_idx_name) if probe.has_long_str else 0
-            
+
             # parse probe arguments
-            hit.args = self.args_2_dict(event, hit.args, probe, start_chunk_idx)
+            hit.args = decode(event, read_long_str)
+            if self.verify_decoders:
+                self._verify(probe, event, hit.args)
             self.time_table.add(probe.name, hit)
 
         return process_callback
 
-    def args_2_dict(self, event, args, probe, start_chunk_idx, level = 0):
+    def args_2_dict(self, event, probe, args = None, source = None):
+        """ Decodes the args of an event by walking the probe's args. This is the reference the
+            generated decoders (see generator.Probe.decoder_gen) are verified against. """
         result = dict()
+        source = source if source != None else event
 
-        for arg in probe.args:
+        for arg in (args if args != None else probe.args):
             if arg.type == LONG_STRING_TYPE:
                 # passing structs containing long strings is not supported by the generator
-                assert level == 0
+                assert arg.depth == 0
 
-                sz_name = arg.name + "_sz"
-                err_name = arg.name + "_err"
+                sz_name = arg.output_arg_name + "_sz"
+                idx_name = arg.output_arg_name + "_idx"
+                err_name = arg.output_arg_name + "_err"
                 sz = getattr(event, sz_name)
-                result[probe.buf_idx_name] = start_chunk_idx
+                start_chunk_idx = getattr(event, idx_name)
+                result[idx_name] = start_chunk_idx
 
-                if sz < 0: # a negative size indicates an error
-                    print(error_strings[sz])
+                if sz < 0: # a negative size indicates an error, see generator.err
                     result[err_name] = sz
 
                 else:
@@ -227,24 +366,39 @@ class USDTThread(WorkerThread):
                     except KeyError:
                         result[err_name] = errors["KEY_ERROR"]
 
+            elif arg.type == STRUCT_TYPE and arg.deref:
+                # dereferenced structs are read into their own member of the output struct
+                if getattr(source, arg.output_arg_name):
+                    result[arg.name] = self.args_2_dict(event, probe, arg.fields, getattr(event, arg.deref_member))
+                else:
+                    result[arg.name] = None
+
             elif arg.type == STRUCT_TYPE:
-                result[arg.name] = self.args_2_dict(event, arg.fields, level + 1)
+                result[arg.name] = self.args_2_dict(event, probe, arg.fields, getattr(source, arg.output_arg_name))
+
+            elif arg.count > 0:
+                result[arg.name] = list(getattr(source, arg.output_arg_name))
 
             else:
-                result[arg.name] = getattr(event, arg.name if level == 0 else arg.name + '_' + str(level))
+                result[arg.name] = getattr(source, arg.output_arg_name)
 
         return result
 
+    def _verify(self, probe, event, args):
+        expected = self.args_2_dict(event, probe)
+        if args != expected:
+            self.decoder_mismatches += 1
+            self.log("{} decoder mismatch: {} != {}".format(probe.name, args, expected))
+
     def read_long_str(self, sz, probe, start_chunk_idx):
-        # get index of starting chunk
-        i = start_chunk_idx
+        # the chunks of a string are contiguous in the probe's chunk ring, wrapping around its end
+        table = self._bpf[probe.buf_name]
         sz_remaining = sz
         out = []
-        while i < probe.max_map_sz and sz_remaining > 0:
+        for offset in range(min(ceil(sz / probe.max_str_sz), probe.max_map_sz)):
             chunk_sz = min(sz_remaining, probe.max_str_sz)
-            out += self._bpf[probe.buf_name][i].str[:chunk_sz]
+            out += table[(start_chunk_idx + offset) % probe.max_map_sz].str[:chunk_sz]
             sz_remaining -= chunk_sz
-            i = i + 1
         return bytes(out)
 
     def _lost_callback_gen(self, probe):
@@ -261,14 +415,23 @@ class USDTThread(WorkerThread):
         # print(self.bpf_code)
 
     def _init_bpf(self):
-        self.gen_code()
+        if self.obj_path != None:
+            # compiled ahead of time, see core.py
+            self._bpf = CoreBPF(self.obj_path, self._probes, self._targets)
+        else:
+            # bcc (and the LLVM it compiles with) is only loaded when compiling here
+            from bcc import BPF
+
+            self.gen_code()
 
-        # enable probes
-        usdt_probes = [USDT(pid=self._pid) for p in self._probes]
-        for index, probe in enumerate(self._probes):
-            usdt_probes[index].enable_probe(probe=probe.name, fn_name=probe.function_name)
+            # enable probes
+            usdt_probes = [self._targets.usdt() for p in self._probes]
+            for index, probe in enumerate(self._probes):
+                usdt_probes[index].enable_probe(probe=probe.name, fn_name=probe.function_name)
+            self._bpf = BPF(text=self.bpf_code, usdt_contexts=usdt_probes)
 
         # register callbacks on probe hits
-        self._bpf = BPF(text=self.bpf_code, usdt_contexts=usdt_probes)
+        if self._targets.filtered:
+            self._targets.fill_filter(self._bpf)
         for probe in self._probes:
             self._bpf[probe.name].open_perf_buffer(self._callback_gen(probe), lost_cb=self._lost_callback_gen(probe))
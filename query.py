@@ -4,11 +4,14 @@ import argparse
 import bson.raw_bson as raw_bson
 
 from bsonjs import dumps
+from catalog import load_catalog
 from generator.err import errors, error_strings
 from generator.consts import *
 from generator.generator import Probe
 from probes import ProbeHit, ProbeHistory, TimeTable, USDTThread, USDTArg
 from signal import signal, SIGINT
+from sink import add_output_args, open_sink
+from targets import add_target_args, open_targets
 from threading import Event, Lock
 from util import WorkerMaster, WorkerThread
 
@@ -30,13 +33,17 @@ class QueryTimeTable(TimeTable):
         def process_callback(probe, hit):
             if __name__ == "__main__":
                 self.lk.acquire()
-                print("----", probe, "----")
+                # with a sink attached, hits are already recorded by TimeTable.add
+                verbose = self.sink == None
+                if verbose:
+                    print("----", probe, "----")
 
                 # check for errors:
                 errname = "bson_err"
                 if errname in hit.args:
                     err = hit.args[errname]
-                    print("ERROR", error_strings[err])
+                    if verbose:
+                        print("ERROR", error_strings[err])
                     if err == errors["KERNEL_FAULT"]:
                         self.kernel_faults = self.kernel_faults + 1
                     elif err == errors["KEY_ERROR"]:
@@ -48,17 +55,21 @@ class QueryTimeTable(TimeTable):
                     ptr = hit.args["ptr"]
                     bson = hit.args["bson"]
                     sz = hit.args["bson_sz"]
-                    print("BSON REC'VED: [{}] [{}/{} bytes]".format(ptr, len(bson), sz))
+                    if verbose:
+                        print("BSON REC'VED: [{}] [{}/{} bytes]".format(ptr, len(bson), sz))
                     try:
                         rbson = raw_bson.RawBSONDocument(bson)
-                        print(dumps(rbson.raw))
+                        sbson = dumps(rbson.raw)
+                        if verbose:
+                            print(sbson)
                         self.successful = self.successful + 1
                     except Exception as e:
-                        out = ""
-                        for b in bson:
-                            out += str(hex(b))
-                        print(out)
-                        print(e)
+                        if verbose:
+                            out = ""
+                            for b in bson:
+                                out += str(hex(b))
+                            print(out)
+                            print(e)
                         self.bad_bson = self.bad_bson + 1
 
                 self.lk.release()
@@ -80,31 +91,23 @@ class QueryTimeTable(TimeTable):
 def sigint_handler_gen(mr, tt):
     def handler(signal, frame):
         mr.kill_all()
+        if tt.sink != None:
+            tt.sink.close()
         print("-----------------------------------")
         print(str(tt))
         tt.dump_stats()
         exit(0)
     return handler
 
-def ptr_and_bson_probe(name, samples, chunk_sz, map_sz):
-    return {PROBE_NAME_KEY: name,
-                 SAMPLES_PROPORTION_KEY: samples,
-                 MAX_STR_SZ_KEY: chunk_sz,
-                 MAX_MAP_SZ_KEY: map_sz,
-                 PROBE_ARGS_KEY: [
-                    {ARG_TYPE_KEY: POINTER_TYPE, ARG_NAME_KEY: "ptr"},
-                    {ARG_TYPE_KEY: LONG_STRING_TYPE, ARG_NAME_KEY: "bson"}
-                 ]}
+# probes passing a pointer & a bson, see catalog.json
+QUERY_REQUEST_PROBES = ["queryRequestFilter", "queryRequestProj", "queryRequestSort", "queryRequestHint",
+                        "queryRequestReadConcern", "queryRequestCollation", "queryRequestUnwrappedReadPref"]
 
 # Main #
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Gather data from QueryRequests.")
-    parser.add_argument('pid',
-                        metavar='pid',
-                        type=int,
-                        nargs=1,
-                        help='pid of process emitting probes')
+    add_target_args(parser)
     parser.add_argument('-s', '--sample',
                         metavar='sample',
                         type=float,
@@ -123,17 +126,19 @@ if __name__ == '__main__':
                         nargs='?',
                         default=MAX_MAP_SZ,
                         help='maximum map size')
+    add_output_args(parser)
 
     args = parser.parse_args()
+    targets = open_targets(parser, args)
     print(args)
 
     mr = None
     time_table = QueryTimeTable(None)
+    time_table.sink = open_sink(args)
 
     workers = []
-    for probe_name in ["queryRequestFilter", "queryRequestProj", "queryRequestSort", "queryRequestHint",
-                       "queryRequestReadConcern", "queryRequestCollation", "queryRequestUnwrappedReadPref"]:
-        worker = USDTThread(args.pid[0], [ptr_and_bson_probe(probe_name, args.sample, args.chunk, args.map)], time_table)
+    for probe_name in QUERY_REQUEST_PROBES:
+        worker = USDTThread(targets, [load_catalog().spec(probe_name, args.sample, args.chunk, args.map)], time_table)
         workers.append(worker)
 
     mr = WorkerMaster(workers)
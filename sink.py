@@ -0,0 +1,189 @@
+#!/bin/python3
+
+import json
+import os
+import pickle
+import struct
+import sys
+
+from threading import Lock
+from time import time
+
+from util import WorkerThread
+
+# Output sinks shared by all tools. Records (plain dicts) are queued by the perf callbacks and
+# encoded + written in batches by a background writer thread, so a slow terminal or disk never
+# stalls perf buffer polling. The queue is bounded, so that records are dropped (and counted)
+# rather than piling up in memory when the writer can't keep up, and a writer that failed makes
+# write() & close() raise rather than records silently going nowhere.
+#
+# Two formats are supported:
+# - newline-delimited JSON (default), bytes values are written as hex strings
+# - length-prefixed binary (selected by a ".bin" output path): every record is a 4 byte little
+#   endian length followed by a pickled dict, which keeps raw bytes (e.g. BSON) intact
+
+#####################################################################################
+
+STDOUT_PATH = "-"
+BINARY_EXT = ".bin"
+RECORD_LEN = struct.Struct("<I")
+MAX_PENDING = 65536
+
+# Sinks #
+
+def _json_default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    return str(value)
+
+class Sink:
+    """Buffers records and writes them out in batches from a background writer thread, as one JSON
+    document per line unless a subclass encodes them otherwise."""
+    def __init__(self, path, rotate_size = 0, rotate_interval = 0, flush_interval = 0.1,
+                 max_pending = MAX_PENDING):
+        self.path = path
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.max_pending = max_pending
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+        self._lock = Lock()
+        # serializes writing batches out, which flush() may do besides the writer thread
+        self._io_lock = Lock()
+        self._pending = []
+        self._fd = None
+        self._opened_at = 0
+        self._open()
+        self._writer = WorkerThread(self._flush, flush_interval)
+        self._writer.start()
+
+    def encode(self, record):
+        return (json.dumps(record, default=_json_default) + "\n").encode("utf-8")
+
+    def write(self, record):
+        """Queue a record; this is the only work done on the event path. The record is dropped if
+        the queue is full."""
+        self._check_writer()
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+            else:
+                self._pending.append(record)
+
+    def flush(self):
+        """Write out everything queued so far, without waiting for the writer thread."""
+        self._check_writer()
+        self._flush()
+
+    def close(self):
+        self._writer.should_work = False
+        self._writer.join()
+        try:
+            self._check_writer()
+            self._flush()
+        finally:
+            if self.path != STDOUT_PATH:
+                self._fd.close()
+            else:
+                self._fd.flush()
+
+    def _check_writer(self):
+        # the writer thread stops on its first error, see util.WorkerThread
+        error = self._writer.cause_of_death
+        if error != None:
+            raise RuntimeError("writing to {} failed: {}".format(self.path, error)) from error
+
+    def _open(self):
+        if self.path == STDOUT_PATH:
+            self._fd = sys.stdout.buffer
+        else:
+            self._fd = open(self.path, "ab")
+        self._opened_at = time()
+
+    def _should_rotate(self):
+        if self.path == STDOUT_PATH:
+            return False
+        if self.rotate_size > 0 and self._fd.tell() >= self.rotate_size:
+            return True
+        return self.rotate_interval > 0 and time() - self._opened_at >= self.rotate_interval
+
+    def _rotated_path(self):
+        # the number goes before the extension, which selects the format of the file (e.g.
+        # trace.1.bin), and after the rotations of earlier runs rather than overwriting them
+        directory, name = os.path.split(os.path.abspath(self.path))
+        root, ext = os.path.splitext(name)
+        prefix = root + "."
+        numbers = [entry[len(prefix):len(entry) - len(ext)] for entry in os.listdir(directory)
+                   if entry.startswith(prefix) and entry.endswith(ext)]
+        number = max([int(number) for number in numbers if number.isdigit()], default=0) + 1
+        return "{}.{}{}".format(os.path.splitext(self.path)[0], number, ext)
+
+    def _rotate(self):
+        self._fd.close()
+        self.rotations += 1
+        os.rename(self.path, self._rotated_path())
+        self._open()
+
+    def _flush(self):
+        with self._io_lock:
+            # swap out the pending batch so producers are only blocked for the swap
+            with self._lock:
+                batch = self._pending
+                self._pending = []
+            if len(batch) > 0:
+                self._fd.write(b"".join(self.encode(record) for record in batch))
+                self._fd.flush()
+                self.written += len(batch)
+            if self._should_rotate():
+                self._rotate()
+
+class BinarySink(Sink):
+    """Writes length-prefixed pickled records."""
+    def encode(self, record):
+        payload = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        return RECORD_LEN.pack(len(payload)) + payload
+
+# Reading traces back #
+
+def read_records(path):
+    """Yields the records of a trace written by a Sink, in the order they were written."""
+    if path.endswith(BINARY_EXT):
+        with open(path, "rb") as fd:
+            while True:
+                header = fd.read(RECORD_LEN.size)
+                if len(header) < RECORD_LEN.size:
+                    return
+                yield pickle.loads(fd.read(RECORD_LEN.unpack(header)[0]))
+    else:
+        with open(path, "r") as fd:
+            for line in fd:
+                if line.strip():
+                    yield json.loads(line)
+
+# Command line #
+
+def add_output_args(parser):
+    parser.add_argument('-o', '--output',
+                        metavar='output',
+                        type=str,
+                        default=None,
+                        help='write records to this file instead of printing them ' +
+                             '("-" for stdout, a ".bin" suffix selects the binary format)')
+    parser.add_argument('--rotate-size',
+                        metavar='bytes',
+                        type=int,
+                        default=0,
+                        help='rotate the output file once it reaches this many bytes')
+    parser.add_argument('--rotate-interval',
+                        metavar='seconds',
+                        type=float,
+                        default=0,
+                        help='rotate the output file after this many seconds')
+
+def open_sink(args):
+    """Returns the Sink requested on the command line, or None if output should be printed."""
+    if args.output is None:
+        return None
+    klass = BinarySink if args.output.endswith(BINARY_EXT) else Sink
+    return klass(args.output, rotate_size=args.rotate_size, rotate_interval=args.rotate_interval)
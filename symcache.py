@@ -0,0 +1,92 @@
+#!/bin/python3
+
+import hashlib
+
+from collections import OrderedDict
+from time import perf_counter
+
+from util import Timer
+
+# Caches in front of bcc's symbol resolution, which is the dominant cost of reporting deep mongod
+# backtraces. Addresses are cached in an LRU keyed by (pid, addr) and fully symbolized stacks are
+# cached by (pid, stack id). Since BPF_F_REUSE_STACKID lets a stack id be taken over by another
+# stack, a cached stack is only reused if its addresses are unchanged.
+
+#####################################################################################
+
+DEFAULT_CAPACITY = 65536
+
+class SymbolCache:
+    """ Caches symbol lookups of a resolver like BPF.sym, per process. Call refresh() before a
+        batch of lookups to drop everything cached for a pid whose memory mappings changed. """
+    def __init__(self, resolve, capacity = DEFAULT_CAPACITY):
+        self._resolve = resolve
+        self._capacity = capacity
+        self._symbols = OrderedDict()
+        self._stacks = dict()
+        self._mappings = dict()
+        self.hits = 0
+        self.misses = 0
+        self.resolve_time = 0
+
+    def refresh(self, pid):
+        # only file-backed code mappings matter to symbols: the others (heap, stacks, anonymous
+        # memory) come and go all the time in mongod
+        mappings = hashlib.sha1()
+        try:
+            with open("/proc/{}/maps".format(pid), "rb") as fd:
+                for line in fd:
+                    fields = line.split(maxsplit=5)
+                    if len(fields) == 6 and fields[1] == b"r-xp":
+                        mappings.update(line)
+            mappings = mappings.digest()
+        except OSError:
+            mappings = None
+        if self._mappings.get(pid) != mappings:
+            self.invalidate(pid)
+            self._mappings[pid] = mappings
+
+    def invalidate(self, pid):
+        for key in [key for key in self._symbols if key[0] == pid]:
+            del self._symbols[key]
+        for key in [key for key in self._stacks if key[0] == pid]:
+            del self._stacks[key]
+
+    def sym(self, addr, pid):
+        key = (pid, addr)
+        symbol = self._symbols.get(key)
+        if symbol != None:
+            self.hits += 1
+            self._symbols.move_to_end(key)
+            return symbol
+
+        self.misses += 1
+        start = perf_counter()
+        symbol = self._resolve(addr, pid).decode('utf-8', 'replace')
+        self.resolve_time += perf_counter() - start
+
+        self._symbols[key] = symbol
+        if len(self._symbols) > self._capacity:
+            self._symbols.popitem(last=False)
+        return symbol
+
+    def stack(self, addrs, pid, stack_id):
+        """ Returns the symbols of a stack (given root first), reusing the symbolization of the
+            stack id if its addresses did not change. """
+        key = (pid, stack_id)
+        addrs = tuple(addrs)
+        cached = self._stacks.get(key)
+        if cached != None and cached[0] == addrs:
+            self.hits += len(addrs)
+            return cached[1]
+        symbols = [self.sym(addr, pid) for addr in addrs]
+        self._stacks[key] = (addrs, symbols)
+        return symbols
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0
+
+    def __str__(self):
+        return "symbol cache: {}% hits, {} spent symbolizing\n".format(
+                round(100 * self.hit_rate(), 1), Timer.get_unit_str(self.resolve_time, "s"))
@@ -0,0 +1,222 @@
+#!/bin/python3
+
+import os
+import select
+
+from time import time
+
+from generator.consts import PID_FILTER_MAP_NAME, MAX_PIDS
+
+# The processes a tool attaches to, shared by all tools. A single pid that is not followed (see
+# below) is attached to directly. Several pids (e.g. every mongod of a replica set running on one host) or a binary path are
+# attached to through the binary instead, so that one BPF program and one poll loop serve all of
+# them, and a pid filter map in the program keeps only the requested processes. Every hit still
+# carries the pid of the process that emitted it.
+#
+# Targets are watched through pidfds. When following (the default), a target that exits is
+# replaced by the next new process running the same binary (and listening on the same port, if
+# the target was given by --port). Since the program is then attached through the binary, a
+# restart only takes a pid filter update: the loaded program is reused as is.
+
+#####################################################################################
+
+# how often a missing target is searched for
+RESOLVE_INTERVAL = 0.05
+
+def exe_path(pid):
+    return os.path.realpath("/proc/{}/exe".format(pid))
+
+def _listening_inodes(port):
+    inodes = set()
+    for table in ["/proc/net/tcp", "/proc/net/tcp6"]:
+        try:
+            with open(table) as fd:
+                lines = fd.readlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            fields = line.split()
+            # fields: sl local_address rem_address st ... inode, 0A is TCP_LISTEN
+            if fields[3] == "0A" and int(fields[1].rsplit(":", 1)[1], 16) == port:
+                inodes.add(fields[9])
+    return inodes
+
+def port_pids(port, candidates = None):
+    """Returns the pids (among candidates, default: all) listening on a TCP port."""
+    sockets = set("socket:[{}]".format(inode) for inode in _listening_inodes(port))
+    if len(sockets) == 0:
+        return []
+    if candidates == None:
+        candidates = [int(entry) for entry in os.listdir("/proc") if entry.isdigit()]
+    pids = []
+    for pid in candidates:
+        fd_dir = "/proc/{}/fd".format(pid)
+        try:
+            if any(os.readlink(os.path.join(fd_dir, fd)) in sockets for fd in os.listdir(fd_dir)):
+                pids.append(pid)
+        except OSError:
+            pass
+    return pids
+
+def binary_pids(binary):
+    """Returns the pids of every running process executing binary."""
+    binary = os.path.realpath(binary)
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            if exe_path(entry) == binary:
+                pids.append(int(entry))
+        except OSError:
+            pass
+    return sorted(pids)
+
+class Targets:
+    """Pids and/or binary to attach to. If both are given, only the listed pids running the binary
+    are traced. If only a binary is given, every process running it is traced."""
+    def __init__(self, pids, binary = None, port = None, follow = False):
+        self.pids = [pids] if isinstance(pids, int) else list(pids)
+        self.binary = os.path.realpath(binary) if binary != None else None
+        self.port = port
+        self.follow = follow
+        if port != None and len(self.pids) == 0:
+            self.pids = port_pids(port)
+            if len(self.pids) == 0:
+                raise ValueError("no process is listening on port {}".format(port))
+        if self.binary == None:
+            if len(self.pids) == 0:
+                raise ValueError("no pid or binary to attach to")
+            # a followed pid is attached through its binary so that restarts keep the program
+            if len(self.pids) > 1 or follow:
+                binaries = set(exe_path(pid) for pid in self.pids)
+                if len(binaries) > 1:
+                    raise ValueError("pids run different binaries: {}".format(", ".join(sorted(binaries))))
+                self.binary = binaries.pop()
+        if len(self.pids) > MAX_PIDS:
+            raise ValueError("at most {} pids are supported".format(MAX_PIDS))
+        # whether the program has to filter hits by pid, otherwise every process of the binary is traced
+        self.filtered = self.binary != None and len(self.pids) > 0
+
+        # processes that already existed cannot be the restart of a target
+        self._known = set(binary_pids(self.binary)) if follow else set()
+        self._known.update(self.pids)
+        self._missing = 0
+        self._next_resolve = 0
+        self._pidfds = dict()
+        for pid in self.pids:
+            self._watch(pid)
+
+    def _watch(self, pid):
+        try:
+            self._pidfds[pid] = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            # no pidfd support, fall back to signalling the pid
+            self._pidfds[pid] = None
+
+    def _exited(self, pid):
+        pidfd = self._pidfds[pid]
+        if pidfd == None:
+            try:
+                os.kill(pid, 0)
+                return False
+            except ProcessLookupError:
+                return True
+        # a pidfd becomes readable once the process exits
+        return len(select.select([pidfd], [], [], 0)[0]) > 0
+
+    def _find_restarted(self):
+        candidates = [pid for pid in binary_pids(self.binary) if pid not in self._known]
+        if self.port != None:
+            candidates = port_pids(self.port, candidates)
+        return candidates[:self._missing]
+
+    def poll(self):
+        """Returns the (exited, started) targets since the last poll. Started targets replace
+        exited ones, and are only searched for when following."""
+        exited = [pid for pid in self.pids if self._exited(pid)]
+        for pid in exited:
+            self.pids.remove(pid)
+            pidfd = self._pidfds.pop(pid)
+            if pidfd != None:
+                os.close(pidfd)
+        started = []
+        if not self.follow:
+            return (exited, started)
+
+        self._missing += len(exited)
+        if self._missing > 0 and time() >= self._next_resolve:
+            self._next_resolve = time() + RESOLVE_INTERVAL
+            started = self._find_restarted()
+            self._missing -= len(started)
+            self._known.update(started)
+            for pid in started:
+                self.pids.append(pid)
+                self._watch(pid)
+        return (exited, started)
+
+    @property
+    def alive(self):
+        """Whether there is anything left to trace. Only a binary given without pids traces
+        whatever runs it, and so never runs out of targets."""
+        return len(self.pids) > 0 or self._missing > 0 or (self.binary != None and not self.filtered)
+
+    def all_pids(self):
+        return self.pids if len(self.pids) > 0 else binary_pids(self.binary)
+
+    def usdt(self):
+        """Returns a new USDT context for these targets."""
+        # bcc is not needed to trace with objects built ahead of time, see core.py
+        from bcc import USDT
+
+        if self.binary == None:
+            return USDT(pid=self.pids[0])
+        return USDT(path=self.binary)
+
+    def fill_filter(self, bpf, pids = None):
+        """Allows the given pids (default: the requested ones) through the program's pid filter."""
+        pid_filter = bpf[PID_FILTER_MAP_NAME]
+        for pid in (pids if pids != None else self.pids):
+            pid_filter[pid_filter.Key(pid)] = pid_filter.Leaf(1)
+
+    def update_filter(self, bpf, exited, started):
+        pid_filter = bpf[PID_FILTER_MAP_NAME]
+        for pid in exited:
+            try:
+                del pid_filter[pid_filter.Key(pid)]
+            except KeyError:
+                pass
+        self.fill_filter(bpf, started)
+
+    def __str__(self):
+        out = self.binary if self.binary != None else ""
+        if len(self.pids) > 0:
+            out += " [{}]".format(", ".join(str(pid) for pid in self.pids))
+        return out.strip()
+
+def add_target_args(parser):
+    parser.add_argument('pid',
+                        metavar='pid',
+                        type=int,
+                        nargs='*',
+                        help='pids of processes emitting probes')
+    parser.add_argument('-b', '--binary',
+                        metavar='binary',
+                        type=str,
+                        default=None,
+                        help='attach to every process running this binary (only the given pids, if any)')
+    parser.add_argument('--port',
+                        metavar='port',
+                        type=int,
+                        default=None,
+                        help='attach to the process listening on this TCP port')
+    parser.add_argument('--no-follow',
+                        action='store_true',
+                        help='stop tracing a process when it exits, instead of reattaching to its restart')
+
+def open_targets(parser, args):
+    """Returns the Targets requested on the command line, exiting with a usage error if there are none."""
+    try:
+        return Targets(args.pid, args.binary, port=args.port, follow=not args.no_follow)
+    except ValueError as e:
+        parser.error(str(e))
@@ -5,14 +5,17 @@ import curses
 import json
 import math
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from curses import textpad
 from datetime import datetime
-from threading import Lock
+from threading import Event, Lock
 
 from generator.consts import PROBE_NAME_KEY
+from metrics import DEFAULT_ADDRESS, add_metrics_args, open_metrics
 from wiredtimer import WiredTimeTable
-from probes import TimeTable, USDTThread 
+from probes import COUNTER_CAPACITY, ProbeHistory, TimeTable, USDTThread
+from sink import add_output_args, open_sink
+from targets import add_target_args, open_targets
 from util import WorkerThread
 
 #################################################################################################################
@@ -23,13 +26,13 @@ def format_output(stdscr, string, color = curses.COLOR_WHITE):
 # Commands #
 
 class Commands:
-    def __init__(self, pid, window, stdscr, time_table = None):
+    def __init__(self, targets, window, stdscr, time_table = None):
         self.history = []
         assert isinstance(window, Window)
         self.time_table = time_table
         self._result_win = window
         self._stdscr = stdscr
-        self.pid = pid
+        self.targets = targets
         self.ptr = 0
         self.workerThread = None
         self.command_table = {
@@ -61,6 +64,9 @@ class Commands:
             self.workerThread.should_work = False
             format_output(self._result_win, "Joining worker...\n")
             self.workerThread.join()
+            time_table = getattr(self.workerThread, "time_table", None)
+            if time_table != None:
+                time_table.close()
             self._stdscr.erase()
 
     # Commands #
@@ -103,7 +109,9 @@ class Commands:
         del tokens
         format_output(self._result_win, "Initializing WiredTiger tool...\n")
         tt = WiredTimeTable(self._stdscr)
-        self._thread(USDTThread(self.pid, tt.probes, tt))
+        worker = USDTThread(self.targets, tt.probes, tt)
+        tt.start()
+        self._thread(worker)
 
     def push(self, command):
         assert isinstance(command, str)
@@ -149,15 +157,63 @@ class Commands:
 # garbage output.
 lock = Lock()
 
+FRAME_RATE = 10
+
 class EventView:
-    def __init__(self, event_win, pct_win):
+    """ Renders probe hits from its own UI thread at a fixed frame rate. Probe hits only queue the
+        hit and mark its probe dirty, so no formatting or drawing happens on the event path. """
+    def __init__(self, event_win, pct_win, time_table = None, frame_rate = FRAME_RATE):
         self.event_win = event_win
         self.pct_win = pct_win
+        self.time_table = time_table
+        self._lock = Lock()
+        # rows that no longer fit in the event window would be scrolled off right away
+        self._max_pending = max(event_win.height, 1)
+        self._pending = deque(maxlen=self._max_pending)
+        self._dirty = set()
+        # the time table version last rendered, stats are only formatted again once it changed
+        self._rendered_version = None
+        self._renderer = WorkerThread(self.render, 1 / frame_rate)
+
+    def on_probe_hit(self, probe, hit):
+        with self._lock:
+            self._pending.append((probe, hit))
+            self._dirty.add(probe)
+
+    def start(self):
+        self._renderer.start()
+
+    def stop(self):
+        self._renderer.should_work = False
+        if self._renderer.is_alive():
+            self._renderer.join()
+
+    def render(self):
+        # skip the frame if there were no hits and the time table did not change since the last one
+        version = self.time_table.version if self.time_table != None else None
+        with self._lock:
+            if len(self._dirty) == 0 and version == self._rendered_version:
+                return
+            pending = self._pending
+            dirty = self._dirty
+            self._pending = deque(maxlen=self._max_pending)
+            self._dirty = set()
+
+        now = datetime.now().time()
+        for probe, hit in pending:
+            self.event_win.add_row("{} | {} | {}".format(now, probe, hit.row_str()), refresh=False)
+
+        if self.time_table != None:
+            # the lock is only held to copy the stats, they are formatted without it
+            snapshot = self.time_table.snapshot([probe for probe in dirty if probe in self.pct_win.cols])
+            self._rendered_version = snapshot["version"]
+            self.pct_win.fill_col("SUMMARY", TimeTable.snapshot_str(snapshot), refresh=False)
+            for probe, history in snapshot["probes"].items():
+                self.pct_win.fill_col(probe, ProbeHistory.snapshot_str(history), refresh=False)
 
-    def on_probe_hit(self, event, summary, probe, probe_content):
-        format_output(self.event_win, event)
-        self.pct_win.fill_col("SUMMARY", summary)
-        self.pct_win.fill_col(probe, probe_content)
+        lock.acquire()
+        curses.doupdate()
+        lock.release()
 
 class Window:
     def __init__(self, begin_x, begin_y, width, height):
@@ -192,21 +248,25 @@ class Window:
         self._window.attron(curses.A_BOLD)
         self._draw_borders()
 
-    def _add_str(self, line, color):
+    def _add_str(self, line, color, refresh=True):
         assert isinstance(line, str)
         lock.acquire()
         try:
             self._window.addstr(line, curses.color_pair(color))
         except curses.error:
             self._window.scroll(1)
-        self._window.refresh()
+        # without refresh, the caller batches the screen update with curses.doupdate()
+        if refresh:
+            self._window.refresh()
+        else:
+            self._window.noutrefresh()
         lock.release()
 
-    def add_str(self, line, color=curses.COLOR_WHITE):
-        self._add_str(line, color)
+    def add_str(self, line, color=curses.COLOR_WHITE, refresh=True):
+        self._add_str(line, color, refresh)
 
-    def add_line(self, line, color=curses.COLOR_WHITE):
-        self._add_str(line + "\n", color)
+    def add_line(self, line, color=curses.COLOR_WHITE, refresh=True):
+        self._add_str(line + "\n", color, refresh)
 
     def erase(self):
         lock.acquire()
@@ -250,7 +310,7 @@ class TallTable(Window):
 
             self.cols[titles[i]].overlay(self)
 
-    def add_row(self, string, color=curses.COLOR_WHITE):
+    def add_row(self, string, color=curses.COLOR_WHITE, refresh=True):
         # string must be formatted with column entries separates by " | "
         tokens = string.split(" | ")
         newlns = 0
@@ -260,19 +320,19 @@ class TallTable(Window):
             if len(token) >= self._colw:
                 newlns = max(newlns, int(len(token) / self._colw))
         for i in range(0, len(self.cols)):
-            self.cols[self.titles[i]].add_line(tokens[i])
+            self.cols[self.titles[i]].add_line(tokens[i], refresh=refresh)
             for n in range(0, min(newlns, newlns - int(len(tokens[i]) / self._colw))):
-                self.cols[self.titles[i]].add_line("")
+                self.cols[self.titles[i]].add_line("", refresh=refresh)
 
-    def add_str(self, string, color=curses.COLOR_WHITE):
-        self.add_row(string, color)
+    def add_str(self, string, color=curses.COLOR_WHITE, refresh=True):
+        self.add_row(string, color, refresh)
 
-    def add_line(self, string, color=curses.COLOR_WHITE):
-        self.add_row(string, color)
+    def add_line(self, string, color=curses.COLOR_WHITE, refresh=True):
+        self.add_row(string, color, refresh)
 
-    def fill_col(self, name, string, color=curses.COLOR_WHITE):
+    def fill_col(self, name, string, color=curses.COLOR_WHITE, refresh=True):
         self.cols[name].erase()
-        self.cols[name].add_str(string, color)
+        self.cols[name].add_str(string, color, refresh)
 
 class TextBox(Window):
     def __init__(self, begin_x, begin_y, width, height, commands = None):
@@ -314,7 +374,7 @@ def init_colors():
 
 # Main #
 
-def main(pid, probes, stdscr):
+def main(targets, probes, sink, args, stdscr):
     """ Collects information about threads from USDT probes. """
     H = curses.LINES
     W = curses.COLS
@@ -339,7 +399,7 @@ def main(pid, probes, stdscr):
                      width = left_w,
                      height = int(0.75*(H - MIN_H - 1)))
 
-    tb.commands = Commands(pid, cmd_out_win, out_win)
+    tb.commands = Commands(targets, cmd_out_win, out_win)
 
     # colors
     init_colors()
@@ -363,39 +423,93 @@ def main(pid, probes, stdscr):
     tt_view = EventView(event_win, pct_win)
 
     # init probes time_table
-    time_table = TimeTable(tt_view)
+    time_table = TimeTable(tt_view, args.counter_capacity)
+    time_table.sink = sink
+    tt_view.time_table = time_table
     tb.commands.time_table = time_table
-    
-    # poll usdt
+
+    # poll usdt: no thread is started until BPF is initialized, so a failure leaves none running
     format_output(cmd_out_win, "Initializing BPF...\n")
-    worker = USDTThread(pid, probes, time_table)
+    # printing would corrupt the UI
+    log = lambda line: format_output(cmd_out_win, line + "\n", curses.COLOR_RED)
+    worker = USDTThread(targets, probes, time_table, args.verify_decoders, args.obj, log)
     format_output(cmd_out_win, "BPF Initialized.\n", curses.COLOR_GREEN)
-    worker.start()
 
-    # while parent is accepting user input
+    metrics = None
     try:
+        tt_view.start()
+        metrics = open_metrics(args, {"threads": time_table})
+        worker.start()
+        # while parent is accepting user input
         tb.user_edit()
     finally:
         worker.should_work = False
-        worker.join()
+        if worker.is_alive():
+            worker.join()
+        tt_view.stop()
         tb.commands.close()
+        if metrics != None:
+            metrics.close()
+
+def headless(targets, probes, sink, args):
+    """ Collects the same information without the UI, only serving it as metrics. """
+    time_table = TimeTable(None, args.counter_capacity)
+    time_table.sink = sink
+    worker = USDTThread(targets, probes, time_table, args.verify_decoders, args.obj)
+    if args.listen == None:
+        args.listen = DEFAULT_ADDRESS
+
+    metrics = None
+    try:
+        metrics = open_metrics(args, {"threads": time_table})
+        worker.start()
+        print("Serving metrics on {} until CTRL-C.".format(args.listen))
+        Event().wait() # wait for keyboard interrupt forever
+    finally:
+        worker.should_work = False
+        if worker.is_alive():
+            worker.join()
+        if metrics != None:
+            metrics.close()
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Gather generic data about USDT probes and " +
     "run tools to display specific information about certain probes.")
 
-    parser.add_argument('pid',
-                        metavar='pid',
+    add_target_args(parser)
+    add_output_args(parser)
+    add_metrics_args(parser)
+    parser.add_argument('--counter-capacity',
+                        metavar='capacity',
                         type=int,
-                        nargs=1,
-                        help='pid of process emitting probes')
+                        default=COUNTER_CAPACITY,
+                        help='number of distinct comm/pid/tid/size values counted (the most frequent ones)')
+    parser.add_argument('--headless',
+                        action='store_true',
+                        help='run without the UI as a long lived collector, serving metrics on --listen ' +
+                             '(default {})'.format(DEFAULT_ADDRESS))
+    parser.add_argument('--verify-decoders',
+                        action='store_true',
+                        help='also decode every hit generically and report where the generated decoders disagree')
+    parser.add_argument('--obj',
+                        metavar='obj',
+                        type=str,
+                        default=None,
+                        help='load the probes from this object built by core.py, instead of compiling them with bcc')
 
     args = parser.parse_args()
-    pid = args.pid[0]
+    targets = open_targets(parser, args)
     probes = WiredTimeTable.get_wiredtiger_probes()
+    sink = open_sink(args)
 
     try:
-        curses.wrapper(lambda stdscr: main(pid, probes, stdscr))
+        if args.headless:
+            headless(targets, probes, sink, args)
+        else:
+            curses.wrapper(lambda stdscr: main(targets, probes, sink, args, stdscr))
     except KeyboardInterrupt:
         print("User exited.")
+    finally:
+        if sink != None:
+            sink.close()
@@ -4,10 +4,13 @@ import argparse
 import bson.raw_bson as raw_bson
 
 from bsonjs import dumps
+from catalog import load_catalog
 from generator.consts import *
 from generator.generator import Probe
 from probes import ProbeHit, ProbeHistory, TimeTable, USDTThread, USDTArg
 from signal import signal, SIGINT
+from sink import add_output_args, open_sink
+from targets import add_target_args, open_targets
 from threading import Event, Lock
 from util import WorkerMaster, WorkerThread
 
@@ -29,13 +32,17 @@ class BSONTimeTable(TimeTable):
         def process_callback(probe, hit):
             if __name__ == "__main__":
                 self.lk.acquire()
-                print("----", probe, "----")
+                # with a sink attached, hits are already recorded by TimeTable.add
+                verbose = self.sink == None
+                if verbose:
+                    print("----", probe, "----")
 
                 # check for errors:
                 errname = "objdata_{}_err".format(probe)
                 if errname in hit.args:
                     err = hit.args[errname]
-                    print("ERROR", err)
+                    if verbose:
+                        print("ERROR", err)
                     if err == -3:
                         self.kernel_faults = self.kernel_faults + 1
                     elif err == -4:
@@ -46,16 +53,20 @@ class BSONTimeTable(TimeTable):
                 else:
                     bson = hit.args["objdata_{}".format(probe)]
                     sz = hit.args["objdata_{}_sz".format(probe)]
-                    print("printing", sz)
+                    if verbose:
+                        print("printing", sz)
                     try:
                         rbson = raw_bson.RawBSONDocument(bson)
-                        print(dumps(rbson.raw))
+                        sbson = dumps(rbson.raw)
+                        if verbose:
+                            print(sbson)
                         self.successful = self.successful + 1
                     except:
-                        out = ""
-                        for b in bson:
-                            out += str(hex(b))
-                        print(out)
+                        if verbose:
+                            out = ""
+                            for b in bson:
+                                out += str(hex(b))
+                            print(out)
                         self.bad_bson = self.bad_bson + 1
 
                 self.lk.release()
@@ -77,6 +88,9 @@ class BSONTimeTable(TimeTable):
 def sigint_handler_gen(mr, tt):
     def handler(signal, frame):
         mr.kill_all()
+        if tt.sink != None:
+            tt.sink.close()
+        print(str(tt))
         tt.dump_stats()
         exit(0)
     return handler
@@ -85,11 +99,7 @@ def sigint_handler_gen(mr, tt):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Gather timing data from WiredTiger.")
-    parser.add_argument('pid',
-                        metavar='pid',
-                        type=int,
-                        nargs=1,
-                        help='pid of process emitting probes')
+    add_target_args(parser)
     parser.add_argument('-s', '--sample',
                         metavar='sample',
                         type=float,
@@ -108,22 +118,20 @@ if __name__ == '__main__':
                         nargs='?',
                         default=MAX_MAP_SZ,
                         help='maximum map size')
+    add_output_args(parser)
 
     args = parser.parse_args()
+    targets = open_targets(parser, args)
     print(args)
 
     mr = None
     time_table = BSONTimeTable(None)
+    time_table.sink = open_sink(args)
 
     workers = []
     for probe_name in ["updateQuery", "updateProj", "updateSort"]:
-        probe = {PROBE_NAME_KEY: probe_name,
-                 SAMPLES_PROPORTION_KEY: args.sample,
-                 MAX_STR_SZ_KEY: args.chunk,
-                 MAX_MAP_SZ_KEY: args.map,
-                 PROBE_ARGS_KEY: [{ARG_TYPE_KEY: LONG_STRING_TYPE,
-                                   ARG_NAME_KEY: "objdata_{}".format(probe_name)}]}
-        worker = USDTThread(args.pid[0], [probe], time_table)
+        probe = load_catalog().spec(probe_name, args.sample, args.chunk, args.map)
+        worker = USDTThread(targets, [probe], time_table)
         workers.append(worker)
 
     mr = WorkerMaster(workers)
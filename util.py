@@ -1,8 +1,13 @@
 #!/bin/python3
 
+import hashlib
+import json
+import os
+import re
+
 from sys import exit
 from threading import Lock, Thread
-from time import sleep
+from time import sleep, time
 
 #####################################################################################
 
@@ -55,17 +60,82 @@ class WorkerMaster:
             print(report)
 
 class Counter:
-    """Tracks the proportion of values recieved for a property, like a pie chart."""
-    def __init__(self):
+    """Tracks the proportion of values recieved for a property, like a pie chart.
+    version changes on every update, so views can skip rendering unchanged counters.
+
+    With a capacity, at most that many values are kept using the Space-Saving heavy hitters
+    algorithm: a new value evicts the least counted one and takes over its count (+1), so the
+    counts are upper bounds that overestimate by at most errors[val]. Every value occurring more
+    than total/capacity times is guaranteed to be kept."""
+    def __init__(self, capacity = None):
         self.props = dict()
         self.total = 0
+        self.version = 0
+        self.capacity = capacity
+        if capacity != None:
+            assert capacity > 0
+            self.errors = dict()
+            # count -> values with that count (a dict used as an ordered set), for O(1) eviction
+            self._buckets = dict()
+            self._min = 0
 
     def encounter(self, val):
-        if val not in self.props:
+        if self.capacity != None:
+            self._encounter_bounded(val)
+        elif val not in self.props:
             self.props[val] = 1
         else:
             self.props[val] = self.props[val] + 1
         self.total = self.total + 1
+        self.version = self.version + 1
+
+    def _move(self, val, count):
+        old = self.props.get(val)
+        if old != None:
+            bucket = self._buckets[old]
+            del bucket[val]
+            if len(bucket) == 0:
+                del self._buckets[old]
+                if self._min == old:
+                    self._min = count
+        self.props[val] = count
+        self._buckets.setdefault(count, dict())[val] = None
+
+    def _encounter_bounded(self, val):
+        if val in self.props:
+            self._move(val, self.props[val] + 1)
+            return
+        count = 0
+        if len(self.props) >= self.capacity:
+            # evict a least counted value, whose count the new value takes over
+            count = self._min
+            bucket = self._buckets[count]
+            evicted = next(iter(bucket))
+            del bucket[evicted]
+            if len(bucket) == 0:
+                del self._buckets[count]
+            del self.props[evicted]
+            del self.errors[evicted]
+            self._min = count if count in self._buckets else count + 1
+        else:
+            self._min = 1
+        self._move(val, count + 1)
+        self.errors[val] = count
+
+    def top(self, k):
+        """The k most counted values, with their counts."""
+        return sorted(self.props.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def snapshot(self):
+        return {"version": self.version, "total": self.total, "props": dict(self.props)}
+
+    def from_snapshot(snapshot):
+        """A counter holding the counts of a snapshot(), to format it."""
+        counter = Counter()
+        counter.props = dict(snapshot["props"])
+        counter.total = snapshot["total"]
+        counter.version = snapshot["version"]
+        return counter
 
     def probability(self, val):
         if val in self.props:
@@ -83,24 +153,48 @@ class Counter:
         return out
 
 class Timer:
-    """Tracks time between hits for a single probe."""
+    """Tracks time between hits for a single probe. A tick only updates integers, the averages
+    are derived when read. version changes on every tick."""
     def __init__(self):
-        self.avg_frequency = 0
-        self.avg_interevent_time = 0
-        self.total_interevent_time = 0
+        self.total_interevent_ns = 0
         self.count = 0
+        self.version = 0
 
     def tick(self, hit, prev = None):
         if prev == None:
             prev = hit.prev
         ns = prev.ns if prev != None else hit.ns
-        # ns -> s
-        last_dt = (hit.ns - ns)/1000000000
-        self.total_interevent_time = self.total_interevent_time + last_dt
+        self.total_interevent_ns = self.total_interevent_ns + hit.ns - ns
         self.count = self.count + 1
+        self.version = self.version + 1
+
+    @property
+    def total_interevent_time(self):
+        # ns -> s
+        return self.total_interevent_ns / 1000000000
+
+    @property
+    def avg_interevent_time(self):
         # rolling avg, unweighted
-        self.avg_interevent_time = self.total_interevent_time / self.count
-        self.avg_frequency = self.count / self.total_interevent_time
+        return self.total_interevent_time / self.count if self.count > 0 else 0
+
+    @property
+    def avg_frequency(self):
+        return self.count / self.total_interevent_time if self.total_interevent_ns > 0 else 0
+
+    def snapshot(self):
+        return {"version": self.version,
+                "count": self.count,
+                "total_interevent_time": self.total_interevent_time,
+                "avg_interevent_time": self.avg_interevent_time,
+                "avg_frequency": self.avg_frequency}
+
+    def from_snapshot(snapshot):
+        timer = Timer()
+        timer.count = snapshot["count"]
+        timer.total_interevent_ns = round(snapshot["total_interevent_time"] * 1000000000)
+        timer.version = snapshot["version"]
+        return timer
 
     def get_unit_str(v, unit):
         if v <= 0.01:
@@ -114,9 +208,8 @@ class Timer:
         tt = Timer()
         for timer in timers:
             tt.count += timer.count
-            tt.total_interevent_time += timer.total_interevent_time
-            tt.avg_interevent_time = tt.total_interevent_time / tt.count
-            tt.avg_frequency = tt.count / tt.total_interevent_time
+            tt.total_interevent_ns += timer.total_interevent_ns
+            tt.version += timer.version
         return tt
 
     def __str__(self):
@@ -140,3 +233,163 @@ class StartStopTimer(Timer):
             prev = self.start_stack[-1]
             self.start_stack.pop(len(self.start_stack) - 1)
             super().tick(hit, prev)
+
+def log2_bucket_bounds(slot):
+    """Range of values counted in a slot of a bcc log2 histogram (bpf_log2l)."""
+    low = (1 << slot) >> 1
+    high = (1 << slot) - 1
+    if low == high:
+        low -= 1
+    return (low, high)
+
+def log2_percentile(buckets, pct):
+    """Upper bound of the slot holding the pct-th percentile of a {slot: count} log2 histogram."""
+    total = sum(buckets.values())
+    if total == 0:
+        return 0
+    seen = 0
+    for slot in sorted(buckets):
+        seen += buckets[slot]
+        if seen * 100 >= pct * total:
+            return log2_bucket_bounds(slot)[1]
+    return log2_bucket_bounds(max(buckets))[1]
+
+class Log2Histogram:
+    """Power of two histogram with the slots of bcc's log2 histograms (bpf_log2l), so that it can
+    be filled in userspace or from a BPF_HISTOGRAM, and merged with other histograms."""
+    def __init__(self, buckets = None):
+        self.buckets = dict(buckets) if buckets != None else dict()
+        self.total = sum(self.buckets.values())
+        self.version = 0
+
+    def add(self, value, count = 1):
+        # bpf_log2l(v) is the bit length of v, and 1 for 0 (which shares its slot with 1)
+        slot = int(value).bit_length() if value > 0 else 1
+        self.buckets[slot] = self.buckets.get(slot, 0) + count
+        self.total = self.total + count
+        self.version = self.version + 1
+
+    def add_table(self, table):
+        """Merge in a BPF_HISTOGRAM keyed by slot."""
+        for slot, count in table.items():
+            if count.value > 0:
+                self.buckets[slot.value] = self.buckets.get(slot.value, 0) + count.value
+                self.total = self.total + count.value
+        self.version = self.version + 1
+
+    def merge(self, other):
+        for slot, count in other.buckets.items():
+            self.buckets[slot] = self.buckets.get(slot, 0) + count
+        self.total = self.total + other.total
+        self.version = self.version + 1
+
+    def percentile(self, pct):
+        return log2_percentile(self.buckets, pct)
+
+    def snapshot(self):
+        return dict(self.buckets)
+
+    def __str__(self):
+        out = "[total {}]\n".format(self.total)
+        if self.total == 0:
+            return out
+        widest = max(self.buckets.values())
+        for slot in range(min(self.buckets), max(self.buckets) + 1):
+            low, high = log2_bucket_bounds(slot)
+            count = self.buckets.get(slot, 0)
+            out += " {:>10} -> {:<10}: {:<8} |{:<40}|\n".format(max(low, 0), high, count, "*" * (40 * count // widest))
+        return out
+
+INTERVAL_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+def parse_interval(value):
+    """argparse type for durations such as "250ms", "10s" or "5m". Bare numbers are seconds."""
+    match = re.fullmatch(r"\s*([0-9]*\.?[0-9]+)\s*(ms|s|m|h)?\s*", value)
+    if match == None:
+        raise ValueError("invalid interval: {}".format(value))
+    return float(match.group(1)) * INTERVAL_UNITS[match.group(2) or "s"]
+
+class DoubleBufferedMaps:
+    """Snapshot-and-reset for maps that a BPF program keeps two copies of, "<name>_0" and
+    "<name>_1". The program writes to the copy selected by the first slot of a control array,
+    so flipping that slot lets the copy that was active be read and cleared without racing
+    against (and losing) updates made by the program in the meantime."""
+    def __init__(self, bpf, control, names, settle = 0.001):
+        self._bpf = bpf
+        self._control = bpf[control]
+        self._names = names
+        # time given to program invocations that started before the flip to finish
+        self._settle = settle
+        self.last_snapshot = time()
+
+    def snapshot(self):
+        """Returns (start, end, {name: [(key, leaf)]}) of everything recorded since the last snapshot."""
+        key = self._control.Key(0)
+        active = self._control[key].value
+        self._control[key] = self._control.Leaf(1 - active)
+        sleep(self._settle)
+
+        start = self.last_snapshot
+        self.last_snapshot = time()
+        maps = dict()
+        for name in self._names:
+            table = self._bpf["{}_{}".format(name, active)]
+            maps[name] = list(table.items())
+            table.clear()
+        return (start, self.last_snapshot, maps)
+
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "mongo-ebpf-tools")
+
+def _trusted(stat):
+    # the tools run as root, often under sudo with the HOME of the invoking user: only what no
+    # other user could have written is trusted
+    return stat.st_uid == os.geteuid() and not stat.st_mode & 0o022
+
+def _open_cache_dir():
+    """Returns an fd of CACHE_DIR, created if need be, or None if it can't be used."""
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        dir_fd = os.open(CACHE_DIR, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    except OSError:
+        return None
+    if not _trusted(os.fstat(dir_fd)):
+        os.close(dir_fd)
+        return None
+    return dir_fd
+
+def load_cached(path, build, tag = ""):
+    """Returns build(path), cached on disk as JSON and keyed by the mtime and size of path, so
+    that repeated launches can skip parsing/generating. build must return plain data surviving a
+    JSON round trip. The cache is best effort: if it cannot be read or written, or could have been
+    written by another user, build(path) is simply used."""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    stamp = [stat.st_mtime_ns, stat.st_size, tag]
+    name = hashlib.sha1((path + tag).encode("utf-8")).hexdigest() + ".json"
+
+    dir_fd = _open_cache_dir()
+    if dir_fd == None:
+        return build(path)
+    try:
+        try:
+            fd = os.open(name, os.O_RDONLY | os.O_NOFOLLOW, dir_fd=dir_fd)
+            with open(fd, "r") as cache:
+                if _trusted(os.fstat(fd)):
+                    cached_stamp, value = json.load(cache)
+                    if cached_stamp == stamp:
+                        return value
+        except (OSError, ValueError):
+            pass
+
+        value = build(path)
+        try:
+            tmp = "{}.{}".format(name, os.getpid())
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600, dir_fd=dir_fd)
+            with open(fd, "w") as cache:
+                json.dump([stamp, value], cache)
+            os.replace(tmp, name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+        except OSError:
+            pass
+        return value
+    finally:
+        os.close(dir_fd)
@@ -2,8 +2,10 @@
 
 import argparse
 
-from generator.consts import PROBE_NAME_KEY, PROBE_ARGS_KEY, ARG_NAME_KEY, ARG_TYPE_KEY, INT_TYPE
+from catalog import load_catalog
 from probes import ProbeHit, ProbeHistory, TimeTable, USDTThread, USDTArg
+from sink import add_output_args, open_sink
+from targets import add_target_args, open_targets
 from sys import exit
 from signal import signal, SIGINT
 from threading import Event
@@ -11,33 +13,55 @@ from util import WorkerThread, Timer, StartStopTimer
 
 #####################################################################################
 
+# the report is rendered on this tick (or on demand by render()), never per hit
+RENDER_INTERVAL = 1
+
 class WiredTimeTable(TimeTable):
-    def __init__(self, view):
+    def __init__(self, view, render_interval = RENDER_INTERVAL):
         TimeTable.__init__(self, view)
         self.on_add = self._callback_gen(view)
+        self.view = view
         self.timers = dict()
         self.probe_intervals = WiredTimeTable.get_wiredtiger_probe_roots()
         self.probes = WiredTimeTable.get_wiredtiger_probes()
         for probe_int in self.probe_intervals:
             self.timers[probe_int] = dict()
+        self.last_probe = None
+        self.last_hit = None
+        self._rendered_version = 0
+        self._renderer = WorkerThread(self.render, render_interval)
 
     def add(self, probe, hit):
         key = probe.replace("_start", "").replace("_end", "")
-        if hit.tid not in self.timers[key]:
-            self.timers[key][hit.tid] = StartStopTimer(key + "_start", key + "_end")
-        self.timers[key][hit.tid].tick(hit)
+        with self.lock:
+            if hit.tid not in self.timers[key]:
+                self.timers[key][hit.tid] = StartStopTimer(key + "_start", key + "_end")
+            self.timers[key][hit.tid].tick(hit)
         super().add(probe, hit)
 
     def _callback_gen(self, view):
         def process_callback(probe, hit):
-            out = "Last probe hit: {}\n".format(probe)
-            for field in hit.args:
-                out += "{}: {}\n".format(field, hit.args[field])
+            self.last_probe = probe
+            self.last_hit = hit
+        return process_callback
+
+    def render(self, force = False):
+        """ Renders the report if anything was hit since it was last rendered. """
+        with self.lock:
+            if self.version == self._rendered_version and not force:
+                return
+            self._rendered_version = self.version
+            if self.last_probe == None:
+                return
+
+            out = "Last probe hit: {}\n".format(self.last_probe)
+            for field in self.last_hit.args:
+                out += "{}: {}\n".format(field, self.last_hit.args[field])
             out += "\n"
-            key = probe.replace("_start", "").replace("_end", "")
+            key = self.last_probe.replace("_start", "").replace("_end", "")
             for k in self.timers:
                 for tid in self.timers[k]:
-                    h = self.get(key+"_start").last_hit(tid)
+                    h = self.get(key+"_start").last_hit(tid) if self.has(key+"_start") else None
                     if h == None:
                         continue
                     out += "{}[{}:{}]\n".format(k, h.comm, tid)
@@ -45,13 +69,24 @@ class WiredTimeTable(TimeTable):
                 if len(self.timers[k].values()) > 1:
                     timer = Timer.combine(self.timers[k].values())
                     out += "{} stats for all threads:\n".format(k) + str(timer) + '\n'
-            if __name__ == '__main__':
-                print(out)
-                print(str(self))
-            else:
-                view.erase()
-                view.add_line(out)
-        return process_callback
+            summary = str(self)
+
+        if self.view == None:
+            print(out)
+            print(summary)
+        else:
+            self.view.erase()
+            self.view.add_line(out)
+
+    def start(self):
+        """ Starts rendering, once there is a worker polling the probes. """
+        self._renderer.start()
+
+    def close(self):
+        self._renderer.should_work = False
+        if self._renderer.is_alive():
+            self._renderer.join()
+        self.render()
 
     def get_wiredtiger_probe_roots():
         return ["WiredTiger_findRecord",
@@ -60,18 +95,9 @@ class WiredTimeTable(TimeTable):
                 "WiredTiger_updateRecord"]
 
     def get_wiredtiger_probes():
-        probes = [{PROBE_NAME_KEY: "WiredTiger_findRecord_start"},
-                  {PROBE_NAME_KEY: "WiredTiger_findRecord_end"},
-                  {PROBE_NAME_KEY: "WiredTiger_deleteRecord_start"},
-                  {PROBE_NAME_KEY: "WiredTiger_deleteRecord_end"},
-                  {PROBE_NAME_KEY: "WiredTiger_updateRecord_start",
-                   PROBE_ARGS_KEY: [{ARG_TYPE_KEY: INT_TYPE, ARG_NAME_KEY: "length"}]},
-                  {PROBE_NAME_KEY: "WiredTiger_updateRecord_end",
-                   PROBE_ARGS_KEY: [{ARG_TYPE_KEY: INT_TYPE, ARG_NAME_KEY: "length"}]},
-                  {PROBE_NAME_KEY: "WiredTiger_insertRecords_start",
-                   PROBE_ARGS_KEY: [{ARG_TYPE_KEY: INT_TYPE, ARG_NAME_KEY: "count"}]},
-                  {PROBE_NAME_KEY: "WiredTiger_insertRecords_end",
-                   PROBE_ARGS_KEY: [{ARG_TYPE_KEY: INT_TYPE, ARG_NAME_KEY: "count"}]}]
+        # see catalog.json
+        probes = load_catalog().specs([root + suffix for root in WiredTimeTable.get_wiredtiger_probe_roots()
+                                       for suffix in ["_start", "_end"]])
         return probes
 
 #####################################################################################
@@ -80,6 +106,9 @@ def sigint_handler_gen(worker):
     def handler(signal, frame):
         worker.should_work = False
         worker.join()
+        worker.time_table.close()
+        if worker.time_table.sink != None:
+            worker.time_table.sink.close()
         print("\nDone.")
         exit(0)
     return handler
@@ -88,15 +117,15 @@ def sigint_handler_gen(worker):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Gather timing data from WiredTiger.")
-    parser.add_argument('pid',
-                        metavar='pid',
-                        type=int,
-                        nargs=1,
-                        help='pid of process emitting probes')
+    add_target_args(parser)
+    add_output_args(parser)
     args = parser.parse_args()
+    targets = open_targets(parser, args)
 
     time_table = WiredTimeTable(None)
-    worker = USDTThread(args.pid[0], time_table.probes, time_table)
+    time_table.sink = open_sink(args)
+    worker = USDTThread(targets, time_table.probes, time_table)
+    time_table.start()
     worker.start()
     print("Listening to WiredTiger probes.")
 